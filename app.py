@@ -1,24 +1,291 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session, make_response, g, has_request_context, has_app_context
+from flask.logging import default_handler
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+from sqlalchemy import event, select, insert, bindparam, func, literal, union_all, and_, or_, tuple_
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import joinedload, load_only
+from sqlalchemy.exc import IntegrityError
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, date
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from datetime import datetime, date, timedelta
+from functools import wraps
+from collections import OrderedDict, defaultdict
+from logging.handlers import QueueHandler, QueueListener
+import glob
+import atexit
+import gzip
+import mimetypes
+import posixpath
+import re
+import click
+import hashlib
+import itertools
+import json
+import random
+import secrets
+import shutil
+import threading
+import time
+import unicodedata
 import os
 import logging
+import copy
+import queue
+
+import migrate_db
+
+def normalize_database_url(url):
+    if url.startswith('postgres://'):
+        url = url.replace('postgres://', 'postgresql://', 1)
+    return url
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here-change-in-production')
-database_url = os.environ.get('DATABASE_URL', 'sqlite:///customer_supplier.db')
-if database_url.startswith('postgres://'):
-    database_url = database_url.replace('postgres://', 'postgresql://', 1)
+database_url = normalize_database_url(os.environ.get('DATABASE_URL', 'sqlite:///customer_supplier.db'))
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_BINDS'] = {}
+# Optional separate database for documents archived by the year-end close
+archive_database_url = os.environ.get('ARCHIVE_DATABASE_URL')
+if archive_database_url:
+    app.config['SQLALCHEMY_BINDS']['archive'] = normalize_database_url(archive_database_url)
+ARCHIVE_BIND = 'archive' if archive_database_url else None
+# Optional read replicas (comma separated) serving the read-only pages in REPLICA_ENDPOINTS
+REPLICA_BINDS = []
+for index, replica_url in enumerate(url.strip() for url in os.environ.get('REPLICA_DATABASE_URLS', '').split(',')):
+    if replica_url:
+        app.config['SQLALCHEMY_BINDS'][f'replica_{index}'] = normalize_database_url(replica_url)
+        REPLICA_BINDS.append(f'replica_{index}')
+# Optional per-branch databases ("cairo=postgresql://...,alex=postgresql://..."). Each branch keeps its
+# own parties and documents, numbered with the branch code (INV-CAIRO-2025-000001); users stay on
+# the main database and every branch gets a copy of them, at startup and whenever one is saved.
+# Leave ARCHIVE_DATABASE_URL unset in this mode so each branch archives into its own database.
+BRANCH_BINDS = OrderedDict()
+for branch_setting in os.environ.get('BRANCH_DATABASE_URLS', '').split(','):
+    branch_key, _, branch_url = (part.strip() for part in branch_setting.partition('='))
+    if branch_key and branch_url:
+        app.config['SQLALCHEMY_BINDS'][f'branch_{branch_key}'] = normalize_database_url(branch_url)
+        BRANCH_BINDS[branch_key] = f'branch_{branch_key}'
+# Set by check_db.py: open every database read-only and skip the startup schema and data writes
+DATABASE_READ_ONLY = os.environ.get('DATABASE_READ_ONLY') == '1'
+
+def read_only_engine_options(url):
+    """Engine options opening url read-only: a mode=ro URI on SQLite, read-only transactions on PostgreSQL."""
+    parsed = make_url(url)
+    if parsed.get_backend_name() == 'postgresql':
+        return {'url': url, 'connect_args': {'options': '-c default_transaction_read_only=on'}}
+    if parsed.get_backend_name() == 'sqlite' and parsed.database not in (None, '', ':memory:') \
+            and not parsed.query.get('uri'):
+        return {'url': parsed.set(database=f'file:{parsed.database}').update_query_dict({'mode': 'ro', 'uri': 'true'})}
+    return {'url': url}
+
+if DATABASE_READ_ONLY:
+    app.config['SQLALCHEMY_BINDS'] = {key: read_only_engine_options(url)
+                                      for key, url in app.config['SQLALCHEMY_BINDS'].items()}
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = read_only_engine_options(database_url)
+    app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_ENGINE_OPTIONS'].pop('url')
+# After a write, the user's reads stay on the primary for this long to hide replication lag
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+# Mixed into ETags so a deploy with changed templates invalidates browser copies
+app.config['ETAG_SALT'] = os.environ.get('ETAG_SALT', str(int(os.path.getmtime(__file__))))
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
-app.logger.setLevel(logging.DEBUG)
-
-db = SQLAlchemy(app)
+# Request threads only put records on a queue; a listener thread formats and writes them,
+# so a slow stderr or log collector never stalls a posting.
+#   LOG_LEVEL          root level (default INFO)
+#   LOG_LEVELS         per-logger levels, e.g. "sqlalchemy.engine=INFO,werkzeug=WARNING"
+#   LOG_FORMAT         "text" or "json" (one JSON object per line)
+#   LOG_SAMPLE_RATES   share of requests per endpoint whose records below WARNING are kept,
+#                      e.g. "asset=0,dashboard=0.1"; WARNING and above are always kept
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+# Records waiting for the listener; when it cannot keep up, new records are dropped, not waited on
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Dropped records are reported with a warning at most this often, and once more at exit
+LOG_DROP_REPORT_SECONDS = int(os.environ.get('LOG_DROP_REPORT_SECONDS', 60))
+# SQLAlchemy logs every statement at INFO, so it stays quiet unless LOG_LEVELS asks for it
+DEFAULT_LOG_LEVELS = {'sqlalchemy': 'WARNING'}
+
+def parse_log_settings(value):
+    """'name=value,name=value' -> {name: value}."""
+    settings = {}
+    for item in (value or '').split(','):
+        name, _, setting = item.partition('=')
+        if name.strip() and setting.strip():
+            settings[name.strip()] = setting.strip()
+    return settings
+
+LOG_LEVELS = {**DEFAULT_LOG_LEVELS, **parse_log_settings(os.environ.get('LOG_LEVELS'))}
+LOG_SAMPLE_RATES = {endpoint: float(rate) for endpoint, rate in parse_log_settings(os.environ.get('LOG_SAMPLE_RATES')).items()}
+# Attributes every LogRecord has; anything else was passed through extra= and goes into JSON output
+STANDARD_LOG_RECORD_KEYS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in STANDARD_LOG_RECORD_KEYS)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class RequestLogFilter(logging.Filter):
+    """Tags records with the current endpoint and applies LOG_SAMPLE_RATES.
+
+    The sampling decision is taken once per request, so a kept request keeps all its records.
+    """
+    def filter(self, record):
+        if not has_request_context():
+            record.endpoint = '-'
+            return True
+        record.endpoint = request.endpoint or '-'
+        if record.levelno >= logging.WARNING or record.endpoint not in LOG_SAMPLE_RATES:
+            return True
+        if 'log_sampled' not in g:
+            g.log_sampled = random.random() < LOG_SAMPLE_RATES[record.endpoint]
+        return g.log_sampled
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that never waits for the listener and leaves formatting to its thread."""
+    dropped = 0
+
+    def prepare(self, record):
+        # Only merge the arguments now, while they still hold the values being logged
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+class DropReportingQueueListener(QueueListener):
+    """QueueListener that writes a warning with the number of records NonBlockingQueueHandler
+    dropped, from its own thread once it catches up, and when it stops."""
+    def __init__(self, queue, *handlers, **kwargs):
+        super().__init__(queue, *handlers, **kwargs)
+        # A forked child inherits the parent's count; the parent reports those
+        self.reported = NonBlockingQueueHandler.dropped
+        self.last_report = 0.0
+
+    def handle(self, record):
+        super().handle(record)
+        if time.monotonic() - self.last_report >= LOG_DROP_REPORT_SECONDS:
+            self.report_dropped()
+
+    def report_dropped(self):
+        dropped = NonBlockingQueueHandler.dropped - self.reported
+        if dropped <= 0:
+            return
+        self.reported += dropped
+        self.last_report = time.monotonic()
+        record = logging.LogRecord('app.logging', logging.WARNING, __file__, 0,
+                                   '%d log records dropped, the log queue was full (LOG_QUEUE_SIZE=%d)',
+                                   (dropped, LOG_QUEUE_SIZE), None)
+        record.endpoint = '-'
+        record.dropped = dropped
+        super().handle(record)
+
+    def stop(self):
+        super().stop()
+        self.report_dropped()
+
+def configure_logging():
+    output = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(endpoint)s] %(message)s'))
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RequestLogFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(level.upper())
+    # Records reach the root queue handler; Flask's own stderr handler would write synchronously
+    app.logger.removeHandler(default_handler)
+
+    def start_listener():
+        listener = DropReportingQueueListener(queue_handler.queue, output, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+
+    def restart_listener_in_child():
+        # Threads do not survive fork (gunicorn --preload, process pools). The inherited queue
+        # still holds records the parent will write, so the child starts over with its own.
+        queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+        start_listener()
+
+    start_listener()
+    os.register_at_fork(after_in_child=restart_listener_in_child)
+
+configure_logging()
+request_logger = logging.getLogger('app.request')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # Counted per request, also when test clients share one app context across requests
+    g.query_count = 0
+    g.pop('query_branches', None)
+
+@app.after_request
+def log_request(response):
+    if request_logger.isEnabledFor(logging.INFO) and 'request_started' in g:
+        request_logger.info('%s %s %s', request.method, request.path, response.status_code, extra={
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - g.request_started) * 1000, 1),
+            'queries': g.get('query_count', 0),
+            'user_id': acting_user_id(),
+        })
+    return response
+
+# Tables that stay on the main database when a branch database is selected
+SHARED_TABLES = {'user'}
+
+def current_branch_bind():
+    """Bind key of the branch database in use (None = the main database)."""
+    return g.get('branch_bind') if has_app_context() else None
+
+def use_branch(branch):
+    """Point the current app context at a branch database; for CLI commands and background threads."""
+    if branch is None and not BRANCH_BINDS:
+        return
+    if branch not in BRANCH_BINDS:
+        raise click.ClickException(f'--branch must be one of: {", ".join(BRANCH_BINDS)}' if BRANCH_BINDS
+                                   else 'No branch databases are configured (BRANCH_DATABASE_URLS).')
+    g.branch, g.branch_bind = branch, BRANCH_BINDS[branch]
+
+branch_option = click.option('--branch', help='Branch database to work in; required when BRANCH_DATABASE_URLS is set.')
+
+class RoutingSession(FlaskSQLAlchemySession):
+    """Session that sends default-bind statements to the selected branch database, and the
+    default-bind reads of replica-routed requests to a read replica."""
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is None and has_app_context() and g.get('branch_bind') and engine is self._db.engines[None]:
+            if mapper is None or mapper.local_table.name not in SHARED_TABLES:
+                return self._db.engines[g.branch_bind]
+            return engine
+        if bind is None and not self._flushing and has_request_context() and g.get('replica_bind'):
+            if engine is self._db.engines[None]:
+                return self._db.engines[g.replica_bind]
+        return engine
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 
 # Login manager setup
 login_manager = LoginManager()
@@ -36,6 +303,8 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(120), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Branch database the user works in; users without one may switch between branches
+    branch = db.Column(db.String(50))
 
 class Customer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -44,6 +313,8 @@ class Customer(db.Model):
     address = db.Column(db.Text)
     email = db.Column(db.String(100))
     balance = db.Column(db.Float, default=0.0)
+    # Highest balance sales invoices may take the customer to; None = no limit
+    credit_limit = db.Column(db.Float)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -101,6 +372,1109 @@ class Payment(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+class DataVersion(db.Model):
+    """Per-table change counter used to build ETag/Last-Modified headers."""
+    table_name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class IdempotencyRecord(db.Model):
+    """Stored response of a write request, replayed when the same key is sent again."""
+    key = db.Column(db.String(100), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    request_hash = db.Column(db.String(40), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    response_body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class NumberSequence(db.Model):
+    """Counter row per document series and year; next_value is the next number to issue."""
+    series = db.Column(db.String(50), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False, default=1)
+
+class NumberSequenceGap(db.Model):
+    """Numbers reserved by a worker in block mode but never issued."""
+    id = db.Column(db.Integer, primary_key=True)
+    series = db.Column(db.String(50), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    first_value = db.Column(db.Integer, nullable=False)
+    last_value = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class FiscalYearClose(db.Model):
+    year = db.Column(db.Integer, primary_key=True)
+    closed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    closed_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    archived_rows = db.Column(db.Integer, default=0)
+
+class FiscalYearCloseProgress(db.Model):
+    """Resume point of a year-end close that has not finished: the last party closed per party type."""
+    year = db.Column(db.Integer, primary_key=True)
+    party_type = db.Column(db.String(20), primary_key=True)
+    last_party_id = db.Column(db.Integer, nullable=False, default=0)
+    archived_rows = db.Column(db.Integer, nullable=False, default=0)
+
+class OpeningBalance(db.Model):
+    """Per-party balance and cumulative totals carried into a fiscal year by the year-end close."""
+    party_type = db.Column(db.String(20), primary_key=True)
+    party_id = db.Column(db.Integer, primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    balance = db.Column(db.Float, nullable=False, default=0.0)
+    total_debit = db.Column(db.Float, nullable=False, default=0.0)
+    total_credit = db.Column(db.Float, nullable=False, default=0.0)
+
+class ChangeEvent(db.Model):
+    """Append-only log of postings, edits and deletes, read by consumers in (txid, sequence) order."""
+    sequence = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(50), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(10), nullable=False)
+    party_type = db.Column(db.String(20))
+    party_id = db.Column(db.Integer)
+    old_amount = db.Column(db.Float)
+    new_amount = db.Column(db.Float)
+    user_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Writing transaction (txid_current()) on PostgreSQL; 0 on SQLite, whose writers never overlap
+    txid = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    __table_args__ = (db.Index('ix_change_event_entity_sequence', 'entity', 'sequence'),)
+
+def make_archive_table(model, party_column, date_column):
+    """Same columns as the document table, without foreign keys, indexed for statements."""
+    name = f'{model.__tablename__}_archive'
+    columns = [db.Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+               for column in model.__table__.columns]
+    return db.Table(name, *columns, db.Index(f'ix_{name}_{party_column}', party_column, date_column),
+                    bind_key=ARCHIVE_BIND)
+
+ARCHIVE_TABLES = {
+    'sales_invoice': make_archive_table(SalesInvoice, 'customer_id', 'invoice_date'),
+    'purchase_invoice': make_archive_table(PurchaseInvoice, 'supplier_id', 'invoice_date'),
+    'collection': make_archive_table(Collection, 'customer_id', 'collection_date'),
+    'payment': make_archive_table(Payment, 'supplier_id', 'payment_date'),
+}
+
+# Tables whose changes invalidate cached pages
+VERSIONED_TABLES = ('customer', 'supplier', 'sales_invoice', 'purchase_invoice', 'collection', 'payment')
+
+@event.listens_for(db.session, 'after_flush')
+def bump_data_versions(session, flush_context):
+    """Bump the version row of every table touched by this flush (same transaction)."""
+    touched = {obj.__tablename__ for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+               if getattr(obj, '__tablename__', None) in VERSIONED_TABLES}
+    touched |= session.info.pop('pending_versions', set())
+    touch_data_versions(session.connection(), touched)
+
+def touch_data_versions(connection, tables):
+    """Bump the version rows of the given tables. Call directly after Core-level bulk writes."""
+    if tables and has_request_context():
+        g.wrote_primary = True
+    now = datetime.utcnow()
+    for table_name in sorted(tables):
+        connection.execute(
+            DataVersion.__table__.update()
+            .where(DataVersion.table_name == table_name)
+            .values(version=DataVersion.version + 1, updated_at=now)
+        )
+
+def get_data_versions(tables, branches=None):
+    """Return {table_name: (version, updated_at)} for the given tables in one query.
+
+    With branches, the versions of those branch databases are summed and the latest
+    stamp is kept, so a change in any of them changes the result.
+    """
+    query = select(DataVersion.table_name, DataVersion.version, DataVersion.updated_at)\
+        .where(DataVersion.table_name.in_(tables))
+    if not branches:
+        return {row.table_name: (row.version, row.updated_at) for row in db.session.execute(query)}
+    versions = {}
+    for branch in branches:
+        for row in db.session.execute(query, bind_arguments={'bind': db.engines[BRANCH_BINDS[branch]]}):
+            version, stamp = versions.get(row.table_name, (0, None))
+            versions[row.table_name] = (version + row.version, max(filter(None, (stamp, row.updated_at)), default=None))
+    return versions
+
+def conditional_view(*tables):
+    """Serve 304 Not Modified when none of the given tables changed since the client's copy.
+
+    The ETag is built from the table versions, the endpoint arguments and the
+    logged-in user, so a matching request skips both the queries and the render.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Pending flash messages are part of the page, always render them
+            if '_flashes' in session:
+                return view(*args, **kwargs)
+
+            versions = get_data_versions(tables, report_branches())
+            # Views keying their own caches on the versions reuse these
+            g.data_versions = versions
+            fingerprint = '|'.join(
+                [app.config['ETAG_SALT'], request.endpoint, repr(sorted(kwargs.items())),
+                 request.query_string.decode('latin-1'), str(current_user.get_id()), str(g.get('branch'))] +
+                [f'{name}:{versions.get(name, (0, None))[0]}' for name in tables]
+            )
+            etag = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+            stamps = [stamp for _, stamp in versions.values() if stamp is not None]
+            last_modified = max(stamps).replace(microsecond=0) if stamps else None
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = (last_modified is not None and request.if_modified_since is not None
+                                and last_modified <= request.if_modified_since.replace(tzinfo=None))
+            if not_modified:
+                response = app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+# Rendered document cache
+class RenderCache:
+    """LRU cache of rendered documents (HTML/PDF) with an optional on-disk tier.
+
+    Entries are keyed by document kind, id and a content version, so a stale
+    entry is never served even when another worker changed the document.
+    """
+    def __init__(self, max_entries=512, disk_dir=None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, kind, doc_id, party_id, version, fmt):
+        return os.path.join(self.disk_dir, f'{kind}_{doc_id}_{party_id}_{version}.{fmt}')
+
+    def get(self, kind, doc_id, party_id, version, fmt='html'):
+        key = (kind, doc_id, fmt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[2]
+        if self.disk_dir:
+            path = self._disk_path(kind, doc_id, party_id, version, fmt)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    payload = f.read()
+                if fmt == 'html':
+                    payload = payload.decode('utf-8')
+                self._remember(key, version, party_id, payload)
+                return payload
+        return None
+
+    def put(self, kind, doc_id, party_id, version, payload, fmt='html'):
+        self._remember((kind, doc_id, fmt), version, party_id, payload)
+        if self.disk_dir:
+            path = self._disk_path(kind, doc_id, party_id, version, fmt)
+            data = payload.encode('utf-8') if isinstance(payload, str) else payload
+            # Write then rename so concurrent readers never see a partial file
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def _remember(self, key, version, party_id, payload):
+        with self._lock:
+            self._entries[key] = (version, party_id, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def evict(self, kind, doc_id):
+        """Drop every cached format of one document."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == kind and k[1] == doc_id]:
+                del self._entries[key]
+        self._evict_files(f'{kind}_{doc_id}_*')
+
+    def evict_party(self, kinds, party_id):
+        """Drop the cached documents of one customer/supplier (their header shows party data)."""
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if k[0] in kinds and entry[1] == party_id]:
+                del self._entries[key]
+        for kind in kinds:
+            self._evict_files(f'{kind}_*_{party_id}_*')
+
+    def _evict_files(self, pattern):
+        if not self.disk_dir:
+            return
+        for path in glob.glob(os.path.join(self.disk_dir, pattern)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+render_cache = RenderCache(
+    max_entries=int(os.environ.get('RENDER_CACHE_SIZE', 512)),
+    disk_dir=os.environ.get('RENDER_CACHE_DIR') or None
+)
+
+# Document kinds printed for each party table
+PARTY_DOCUMENT_KINDS = {
+    'customer': ('sales_invoice', 'collection'),
+    'supplier': ('purchase_invoice', 'payment'),
+}
+
+# Party columns that never appear on printed documents
+UNPRINTED_COLUMNS = ('balance',)
+
+def document_version(*rows):
+    """Short content hash of the given rows, used as the cache version of a rendered document."""
+    values = [repr([getattr(row, column.key) for column in row.__table__.columns
+                    if column.key not in UNPRINTED_COLUMNS]) for row in rows]
+    return hashlib.sha1('|'.join(values).encode('utf-8')).hexdigest()[:16]
+
+def render_document(kind, document, party, template, **context):
+    """Render a print template through the render cache."""
+    version = document_version(document, party)
+    html = render_cache.get(kind, document.id, party.id, version)
+    if html is None:
+        html = render_template(template, **context)
+        render_cache.put(kind, document.id, party.id, version, html)
+    return html
+
+@event.listens_for(db.session, 'after_flush')
+def collect_render_evictions(session, flush_context):
+    """Remember which cached documents this transaction touches."""
+    pending = session.info.setdefault('render_evictions', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        table_name = getattr(obj, '__tablename__', None)
+        if table_name in PARTY_DOCUMENT_KINDS:
+            # Balance updates from postings do not change any printed document
+            state = db.inspect(obj)
+            if obj in session.deleted or any(attr.history.has_changes() for attr in state.attrs
+                                             if attr.key not in UNPRINTED_COLUMNS):
+                pending.add(('party', table_name, obj.id))
+        elif table_name in VERSIONED_TABLES:
+            pending.add(('document', table_name, obj.id))
+
+@event.listens_for(db.session, 'after_commit')
+def apply_render_evictions(session):
+    for scope, table_name, obj_id in session.info.pop('render_evictions', ()):
+        if scope == 'party':
+            render_cache.evict_party(PARTY_DOCUMENT_KINDS[table_name], obj_id)
+        else:
+            render_cache.evict(table_name, obj_id)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_render_evictions(session):
+    session.info.pop('render_evictions', None)
+
+# Document number sequences
+SEQUENCE_PREFIXES = {
+    'sales_invoice': os.environ.get('SALES_INVOICE_PREFIX', 'INV'),
+    'purchase_invoice': os.environ.get('PURCHASE_INVOICE_PREFIX', 'PUR'),
+}
+SEQUENCE_FORMAT = '{prefix}-{year}-{number:06d}'
+# 1 = gapless: the counter is bumped in the posting's own transaction and rolls back with it.
+# >1 = each worker reserves blocks of numbers in a short separate transaction, so postings
+# never wait on each other; unused tails are recorded in number_sequence_gap on exit
+# (a number taken by a posting that later rolls back is still skipped in this mode).
+SEQUENCE_BLOCK_SIZE = int(os.environ.get('SEQUENCE_BLOCK_SIZE', 1))
+
+def reserve_sequence_values(connection, series, year, count):
+    """Atomically advance a counter row by count and return the first reserved value."""
+    table = NumberSequence.__table__
+    bump = table.update()\
+        .where(table.c.series == series, table.c.year == year)\
+        .values(next_value=table.c.next_value + count)\
+        .returning(table.c.next_value)
+    next_value = connection.execute(bump).scalar()
+    if next_value is None:
+        # First number of the series this year; a concurrent creator makes the insert fail
+        try:
+            with connection.begin_nested():
+                connection.execute(table.insert().values(series=series, year=year, next_value=1 + count))
+            return 1
+        except IntegrityError:
+            next_value = connection.execute(bump).scalar()
+    return next_value - count
+
+class SequenceBlockAllocator:
+    """Per-worker cache of reserved number blocks, used when SEQUENCE_BLOCK_SIZE > 1.
+
+    Blocks are kept per database, so every branch database numbers its documents on its own.
+    """
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def allocate(self, series, year, count):
+        with self._lock:
+            bind = current_branch_bind()
+            values = []
+            while len(values) < count:
+                start, end = self._blocks.get((bind, series, year), (1, 0))
+                if start > end:
+                    size = max(self.block_size, count - len(values))
+                    with db.engines[bind].begin() as connection:
+                        start = reserve_sequence_values(connection, series, year, size)
+                    end = start + size - 1
+                taken = min(end - start + 1, count - len(values))
+                values.extend(range(start, start + taken))
+                self._blocks[(bind, series, year)] = (start + taken, end)
+            return values
+
+    def record_unused(self):
+        """Write the unissued tail of every reserved block as a gap row."""
+        gaps = defaultdict(list)
+        with self._lock:
+            for (bind, series, year), (start, end) in self._blocks.items():
+                if start <= end:
+                    gaps[bind].append({'series': series, 'year': year, 'first_value': start, 'last_value': end})
+            self._blocks.clear()
+        for bind, rows in gaps.items():
+            with db.engines[bind].begin() as connection:
+                connection.execute(NumberSequenceGap.__table__.insert(), rows)
+
+sequence_blocks = SequenceBlockAllocator(SEQUENCE_BLOCK_SIZE)
+
+@atexit.register
+def release_sequence_blocks():
+    if SEQUENCE_BLOCK_SIZE > 1:
+        try:
+            with app.app_context():
+                sequence_blocks.record_unused()
+        except Exception as e:
+            app.logger.error(f"Could not record unused sequence numbers: {str(e)}")
+
+def allocate_document_numbers(series, count=1, year=None):
+    """Issue count consecutive document numbers for a series, formatted with prefix and year."""
+    year = year or date.today().year
+    if SEQUENCE_BLOCK_SIZE > 1:
+        values = sequence_blocks.allocate(series, year, count)
+    else:
+        start = reserve_sequence_values(db.session.connection(), series, year, count)
+        values = range(start, start + count)
+    prefix = SEQUENCE_PREFIXES[series]
+    branch = g.get('branch') if has_app_context() else None
+    if branch:
+        # Every branch database counts from 1; the branch code keeps the numbers apart
+        prefix = f'{prefix}-{branch.upper()}'
+    return [SEQUENCE_FORMAT.format(prefix=prefix, year=year, number=value) for value in values]
+
+# Fiscal year closing
+# party type -> (party model, debit model, debit date column, credit model, credit date column)
+LEDGERS = {
+    'customer': (Customer, SalesInvoice, 'invoice_date', Collection, 'collection_date'),
+    'supplier': (Supplier, PurchaseInvoice, 'invoice_date', Payment, 'payment_date'),
+}
+
+def last_closed_year():
+    return db.session.query(func.max(FiscalYearClose.year)).scalar()
+
+def current_opening_year(party_type, party_id):
+    """Correlated subquery for the year of a party's newest opening balance.
+
+    After a close every party with history opens the year after it; while a close is still
+    running, the parties it has done open the new year and the others the previous one.
+    """
+    latest = OpeningBalance.__table__.alias('latest_opening')
+    return select(func.max(latest.c.year)).where(latest.c.party_type == party_type,
+                                                 latest.c.party_id == party_id).scalar_subquery()
+
+def party_opening_balance(party_type, party_id):
+    """Opening balance row of one party for the current open period, or None."""
+    return OpeningBalance.query.filter(OpeningBalance.party_type == party_type,
+                                       OpeningBalance.party_id == party_id,
+                                       OpeningBalance.year == current_opening_year(party_type, party_id)).first()
+
+def archived_documents(model, party_key, party_id):
+    """Archived rows of one party, attribute-compatible with the live model for templates."""
+    archive = ARCHIVE_TABLES[model.__tablename__]
+    return db.session.execute(select(archive).where(archive.c[party_key] == party_id),
+                              bind_arguments=archive_bind_arguments()).all()
+
+def archive_bind_arguments():
+    """Session.execute bind arguments for statements on the archive tables."""
+    return {'bind': db.engines[ARCHIVE_BIND]} if ARCHIVE_BIND else {}
+
+def archive_documents(model, party_key, condition, batch_size):
+    """Move the rows of a document table matching condition into its archive table, in id batches.
+
+    Returns the number of rows moved and {party id: total amount} of them, so the snapshot
+    covers exactly the documents archived.
+    """
+    table = model.__table__
+    archive = ARCHIVE_TABLES[model.__tablename__]
+    totals = defaultdict(float)
+    moved = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(select(table.c.id, table.c[party_key], table.c.amount)
+                                  .where(condition, table.c.id > last_id).order_by(table.c.id).limit(batch_size)).all()
+        if not rows:
+            return moved, totals
+        ids = [row.id for row in rows]
+        for _, party_id, amount in rows:
+            totals[party_id] += amount
+        if ARCHIVE_BIND:
+            # Separate database: copy and commit there first, skipping rows a failed run already copied
+            rows = db.session.execute(select(table).where(table.c.id.in_(ids))).mappings().all()
+            with db.engines[ARCHIVE_BIND].begin() as connection:
+                existing = set(connection.execute(select(archive.c.id).where(archive.c.id.in_(ids))).scalars())
+                new_rows = [dict(row) for row in rows if row['id'] not in existing]
+                if new_rows:
+                    connection.execute(archive.insert(), new_rows)
+        else:
+            db.session.execute(archive.insert().from_select(list(table.c.keys()),
+                                                            select(table).where(table.c.id.in_(ids))))
+        db.session.execute(table.delete().where(table.c.id.in_(ids)))
+        moved += len(ids)
+        last_id = ids[-1]
+
+def close_party_batches(party_ids, counts, batch_size):
+    """Split sorted party ids into runs holding about batch_size documents each."""
+    batch, rows = [], 0
+    for party_id in party_ids:
+        batch.append(party_id)
+        rows += max(counts.get(party_id, 0), 1)
+        if rows >= batch_size:
+            yield batch
+            batch, rows = [], 0
+    if batch:
+        yield batch
+
+def close_fiscal_year(year, user_id=None, batch_size=5000):
+    """Snapshot every party's balance into year + 1 and archive all documents dated up to year-end.
+
+    Parties are closed in id order, in batches of about batch_size documents. Each batch
+    commits its opening balances, its archived documents and its FiscalYearCloseProgress
+    row together, so statements stay consistent while the close runs and an interrupted
+    close resumes after its last batch when run again. Documents back-dated into an already
+    closed year are still live, so they are simply swept into the next snapshot. Returns the
+    number of archived rows.
+    """
+    last_year = last_closed_year()
+    if last_year is not None and year <= last_year:
+        raise ValueError(f'Fiscal year {year} is already closed (last closed year: {last_year})')
+    running = db.session.query(FiscalYearCloseProgress.year).filter(FiscalYearCloseProgress.year != year).first()
+    if running is not None:
+        raise ValueError(f'The close of fiscal year {running.year} has not finished; run it again first')
+    year_end = date(year, 12, 31)
+    for party_type, (_, debit_model, debit_date, credit_model, credit_date) in LEDGERS.items():
+        party_key = f'{party_type}_id'
+        ledgers = ((debit_model, debit_date), (credit_model, credit_date))
+        progress = db.session.get(FiscalYearCloseProgress, (year, party_type))
+        start = progress.last_party_id if progress else 0
+        previous = {}
+        if last_year is not None:
+            # Plain rows: ORM objects would expire, and reload one by one, at every batch commit
+            previous = {row.party_id: row for row in db.session.execute(
+                select(OpeningBalance.party_id, OpeningBalance.total_debit, OpeningBalance.total_credit)
+                .where(OpeningBalance.party_type == party_type, OpeningBalance.year == last_year + 1,
+                       OpeningBalance.party_id > start))}
+        counts = defaultdict(int)
+        for model, date_column in ledgers:
+            party_column = model.__table__.c[party_key]
+            for party_id, rows in db.session.query(party_column, func.count()).filter(
+                    getattr(model, date_column) <= year_end, party_column > start).group_by(party_column):
+                counts[party_id] += rows
+
+        for batch in close_party_batches(sorted(set(previous) | set(counts)), counts, batch_size):
+            # Written before the documents are read, so on SQLite the batch holds the write lock while
+            # it moves them; elsewhere the snapshot is summed from the moved rows themselves
+            progress = db.session.merge(FiscalYearCloseProgress(year=year, party_type=party_type,
+                                                                last_party_id=batch[-1]))
+            db.session.flush()
+            totals, archived = [], 0
+            for model, date_column in ledgers:
+                party_column = model.__table__.c[party_key]
+                moved, moved_totals = archive_documents(
+                    model, party_key, and_(getattr(model, date_column) <= year_end,
+                                           party_column.between(batch[0], batch[-1])), batch_size)
+                archived += moved
+                totals.append(moved_totals)
+            debits, credits = totals
+            for party_id in set(previous).intersection(batch) | set(debits) | set(credits):
+                carried = previous.get(party_id)
+                total_debit = (carried.total_debit if carried else 0.0) + debits.get(party_id, 0.0)
+                total_credit = (carried.total_credit if carried else 0.0) + credits.get(party_id, 0.0)
+                db.session.add(OpeningBalance(party_type=party_type, party_id=party_id, year=year + 1,
+                                              balance=total_debit - total_credit,
+                                              total_debit=total_debit, total_credit=total_credit))
+            progress.archived_rows = (progress.archived_rows or 0) + archived
+            touch_data_versions(db.session.connection(), [model.__tablename__ for model, _ in ledgers])
+            db.session.commit()
+
+    progress_rows = FiscalYearCloseProgress.query.filter_by(year=year).all()
+    archived = sum(row.archived_rows for row in progress_rows)
+    for row in progress_rows:
+        db.session.delete(row)
+    db.session.add(FiscalYearClose(year=year, closed_by=user_id, archived_rows=archived))
+    # Archived documents leave the live tables without per-row events
+    record_change_events(db.session.connection(), [{'entity': 'fiscal_year', 'entity_id': year, 'action': 'close',
+                                                    'new_amount': archived, 'user_id': user_id}])
+    db.session.commit()
+    return archived
+
+@app.cli.command('close-year')
+@click.argument('year', type=int)
+@click.option('--batch-size', default=5000, show_default=True, help='Documents archived per committed batch.')
+@branch_option
+def close_year_command(year, batch_size, branch):
+    """Close a fiscal year: write opening balances and archive its documents. Run it again to
+    finish a close that was interrupted."""
+    use_branch(branch)
+    archived = close_fiscal_year(year, batch_size=batch_size)
+    print(f'Fiscal year {year} closed, {archived} documents archived.')
+
+# Change event log
+# Sequences are numbered by the database, so concurrent postings never wait on each other,
+# but they then commit out of sequence order. On PostgreSQL each event records its
+# transaction id and the feed only serves transactions older than the oldest one still
+# running (the snapshot xmin), in (txid, sequence) order, so a cursor never passes an event
+# that commits later. SQLite runs one writer at a time, so there sequence order is commit order.
+# document table -> party type; parties log their balance as the event amount
+EVENT_DOCUMENT_PARTIES = {model.__tablename__: party_type
+                          for party_type, (_, debit_model, _, credit_model, _) in LEDGERS.items()
+                          for model in (debit_model, credit_model)}
+CHANGE_FEED_PAGE_SIZE = 500
+CHANGE_FEED_MAX_PAGE_SIZE = 5000
+
+def acting_user_id():
+    """Id of the request's logged-in user, without loading it (safe inside flush events)."""
+    user = g.get('_login_user') if has_request_context() else None
+    return int(user.get_id()) if user is not None and user.get_id() is not None else None
+
+def record_change_events(connection, events):
+    """Append events (dicts of ChangeEvent columns); the database numbers them in order."""
+    if not events:
+        return
+    now = datetime.utcnow()
+    user_id = acting_user_id()
+    statement = insert(ChangeEvent.__table__)
+    if connection.dialect.name == 'postgresql':
+        statement = statement.values(txid=func.txid_current())
+    connection.execute(statement, [
+        {'party_type': None, 'party_id': None, 'old_amount': None, 'new_amount': None, 'user_id': user_id,
+         **event, 'created_at': now}
+        for event in events
+    ])
+
+def change_feed_cursor(txid, sequence):
+    """Feed position as given to consumers: "<txid>.<sequence>", or the bare sequence on SQLite."""
+    return f'{txid}.{sequence}' if txid else str(sequence)
+
+def parse_change_feed_cursor(value):
+    txid, _, sequence = value.rpartition('.')
+    return int(txid or 0), int(sequence)
+
+# Feed order (migrate_db.py adds it to databases created before it)
+db.Index('ix_change_event_txid_sequence', ChangeEvent.txid, ChangeEvent.sequence)
+
+def change_event(obj, action):
+    table_name = obj.__tablename__
+    if table_name in EVENT_DOCUMENT_PARTIES:
+        party_type = EVENT_DOCUMENT_PARTIES[table_name]
+        party_id, column = getattr(obj, f'{party_type}_id'), 'amount'
+    else:
+        party_type, party_id, column = table_name, obj.id, 'balance'
+    current = getattr(obj, column)
+    previous = db.inspect(obj).attrs[column].history.deleted
+    old_amount = previous[0] if previous else current
+    return {'entity': table_name, 'entity_id': obj.id, 'action': action, 'party_type': party_type,
+            'party_id': party_id, 'old_amount': None if action == 'create' else old_amount,
+            'new_amount': None if action == 'delete' else current}
+
+@event.listens_for(db.session, 'after_flush')
+def log_change_events(session, flush_context):
+    """Append one event per created, modified or deleted party/document row (same transaction)."""
+    events = session.info.pop('pending_events', [])
+    for action, objects in (('create', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objects:
+            if getattr(obj, '__tablename__', None) not in VERSIONED_TABLES:
+                continue
+            if action == 'update' and not session.is_modified(obj, include_collections=False):
+                continue
+            events.append(change_event(obj, action))
+    record_change_events(session.connection(), events)
+
+def defer_change(session, table_name, change):
+    """Queue the version bump and event of a Core-level write for the session's next flush,
+    so they share its data-version and event statements."""
+    session.info.setdefault('pending_versions', set()).add(table_name)
+    session.info.setdefault('pending_events', []).append(change)
+
+@event.listens_for(db.session, 'before_commit')
+def write_deferred_changes(session):
+    if 'pending_versions' in session.info:
+        session.flush()
+    # Nothing was left to flush, so no flush picked them up
+    if 'pending_versions' in session.info:
+        touch_data_versions(session.connection(), session.info.pop('pending_versions'))
+        record_change_events(session.connection(), session.info.pop('pending_events', []))
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_deferred_changes(session):
+    session.info.pop('pending_versions', None)
+    session.info.pop('pending_events', None)
+    session.info.pop('branch_users', None)
+
+# Query loading profiles
+# Named eager-loading options per page, so templates never lazy-load one party per row.
+LOAD_PROFILES = {
+    'sales_invoice_list': lambda: (
+        load_only(SalesInvoice.id, SalesInvoice.invoice_number, SalesInvoice.customer_id, SalesInvoice.amount,
+                  SalesInvoice.invoice_date, SalesInvoice.description),
+        joinedload(SalesInvoice.customer).load_only(Customer.id, Customer.name),
+    ),
+    'purchase_invoice_list': lambda: (
+        load_only(PurchaseInvoice.id, PurchaseInvoice.invoice_number, PurchaseInvoice.supplier_id, PurchaseInvoice.amount,
+                  PurchaseInvoice.invoice_date, PurchaseInvoice.description),
+        joinedload(PurchaseInvoice.supplier).load_only(Supplier.id, Supplier.name),
+    ),
+    'collection_list': lambda: (
+        load_only(Collection.id, Collection.customer_id, Collection.amount, Collection.collection_date, Collection.notes),
+        joinedload(Collection.customer).load_only(Customer.id, Customer.name),
+    ),
+    'payment_list': lambda: (
+        load_only(Payment.id, Payment.supplier_id, Payment.amount, Payment.payment_date, Payment.notes),
+        joinedload(Payment.supplier).load_only(Supplier.id, Supplier.name),
+    ),
+    # View, edit, print and delete routes use the document and its whole party row
+    'sales_invoice_detail': lambda: (joinedload(SalesInvoice.customer),),
+    'purchase_invoice_detail': lambda: (joinedload(PurchaseInvoice.supplier),),
+    'collection_detail': lambda: (joinedload(Collection.customer),),
+    'payment_detail': lambda: (joinedload(Payment.supplier),),
+    # Party drop-downs on the posting forms
+    'customer_options': lambda: (load_only(Customer.id, Customer.name, Customer.balance),),
+    'supplier_options': lambda: (load_only(Supplier.id, Supplier.name, Supplier.balance),),
+}
+
+def load_profile(name):
+    """Return the loader options of a named profile, for Query.options(*...)."""
+    return LOAD_PROFILES[name]()
+
+def party_totals(model, party_key):
+    """Return {party_id: total amount} of one document table, including closed fiscal years."""
+    party_column = getattr(model, party_key)
+    totals = dict(db.session.query(party_column, func.sum(model.amount)).group_by(party_column).all())
+    # Add what earlier fiscal years carried forward before their documents were archived
+    for party_type, (_, debit_model, _, credit_model, _) in LEDGERS.items():
+        if model in (debit_model, credit_model):
+            carried_column = OpeningBalance.total_debit if model is debit_model else OpeningBalance.total_credit
+            carried = db.session.query(OpeningBalance.party_id, carried_column)\
+                .filter(OpeningBalance.party_type == party_type,
+                        OpeningBalance.year == current_opening_year(party_type, OpeningBalance.party_id))
+            for party_id, amount in carried:
+                totals[party_id] = totals.get(party_id, 0) + amount
+    return totals
+
+# Query budgets
+# Maximum SQL statements per request for pages that list or print documents. The
+# count must not grow with the number of rows; TESTING (or ENFORCE_QUERY_BUDGETS)
+# turns an overrun into an error, otherwise it is logged. Cross-branch reports get
+# the budget once per branch they read (see fan_out_branches).
+QUERY_BUDGETS = {
+    'dashboard': 10,
+    'customers': 3,
+    'suppliers': 3,
+    'sales_invoices': 3,
+    'purchase_invoices': 3,
+    'collections': 3,
+    'payments': 3,
+    'view_customer': 3,
+    'view_supplier': 3,
+    'view_sales_invoice': 3,
+    'view_purchase_invoice': 3,
+    'view_collection': 3,
+    'view_payment': 3,
+    'print_sales_invoice': 3,
+    'print_purchase_invoice': 3,
+    'print_collection_receipt': 3,
+    'print_payment_receipt': 3,
+    'customer_statement': 7,
+    'supplier_statement': 7,
+    'customer_reports': 7,
+    'analytics': 7,
+    'supplier_reports': 7,
+    'add_sales_invoice': 3,
+    'add_purchase_invoice': 3,
+    'add_collection': 3,
+    'add_payment': 3,
+}
+app.config['ENFORCE_QUERY_BUDGETS'] = os.environ.get('ENFORCE_QUERY_BUDGETS') == '1'
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_request_queries(conn, cursor, statement, parameters, context, executemany):
+    # g lives on the app context, so fan_out_branches threads count into their own g
+    if has_app_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+@app.after_request
+def check_query_budget(response):
+    budget = QUERY_BUDGETS.get(request.endpoint)
+    if budget is not None:
+        budget *= g.get('query_branches', 1)
+    query_count = g.get('query_count', 0)
+    if app.config['TESTING']:
+        response.headers['X-Query-Count'] = str(query_count)
+    if budget is not None and request.method == 'GET' and query_count > budget:
+        message = f'{request.endpoint} issued {query_count} queries (budget {budget})'
+        if app.config['TESTING'] or app.config['ENFORCE_QUERY_BUDGETS']:
+            raise AssertionError(message)
+        app.logger.warning(message)
+    return response
+
+# Response compression
+COMPRESS_MIMETYPES = {'text/html', 'application/json'}
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        import brotli
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+def choose_content_encoding():
+    accepted = request.accept_encodings
+    if accepted['br']:
+        try:
+            import brotli  # noqa: F401
+            return 'br'
+        except ImportError:
+            pass
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in COMPRESS_MIMETYPES or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = choose_content_encoding()
+    if encoding is None:
+        return response
+    response.set_data(compress_body(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    # A strong ETag names one exact byte sequence; the compressed body is a different one
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+# Static assets
+# Vendored third-party files under static/vendor are served from /assets with the
+# content hash in the file name, so browsers can cache them indefinitely.
+ASSET_DIR = 'vendor'
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+CSS_URL_PATTERN = re.compile(r'url\((["\']?)([^)"\'?#]+)([^)"\']*)\1\)')
+
+def build_asset_manifest():
+    """Fingerprint the vendored files.
+
+    Returns ({logical name: hashed name}, {hashed name: (path, body)}). Stylesheets
+    and scripts are kept in memory as body, with relative url() references in CSS
+    rewritten to the hashed names of their targets; fonts and images have body None.
+    """
+    manifest, files = {}, {}
+    paths = glob.glob(os.path.join(app.static_folder, ASSET_DIR, '**', '*'), recursive=True)
+    # Stylesheets last, so the fonts and images they reference are already hashed
+    for path in sorted(paths, key=lambda p: (p.endswith('.css'), p)):
+        if not os.path.isfile(path) or path.endswith(('.map', '.txt')):
+            continue
+        name = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+        with open(path, 'rb') as f:
+            content = f.read()
+        body = content if name.endswith('.js') else None
+        if name.endswith('.css'):
+            directory = posixpath.dirname(name)
+
+            def rewrite(match):
+                quote, target, suffix = match.groups()
+                hashed = manifest.get(posixpath.normpath(posixpath.join(directory, target)))
+                if hashed is None:
+                    return match.group(0)
+                return f'url({quote}{posixpath.relpath(hashed, directory)}{suffix}{quote})'
+
+            body = CSS_URL_PATTERN.sub(rewrite, content.decode('utf-8')).encode('utf-8')
+            content = body
+        stem, ext = posixpath.splitext(name)
+        hashed = f'{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}'
+        manifest[name] = hashed
+        files[hashed] = (path, body)
+    return manifest, files
+
+asset_manifest, asset_files = build_asset_manifest()
+compressed_assets = {}
+
+@app.context_processor
+def inject_asset_url():
+    def asset_url(name):
+        hashed = asset_manifest.get(name)
+        if hashed is None:
+            return url_for('static', filename=name)
+        return url_for('asset', filename=hashed)
+    return {'asset_url': asset_url}
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    entry = asset_files.get(filename)
+    if entry is None:
+        return app.response_class(status=404)
+    path, body = entry
+    if body is None:
+        response = send_file(path, max_age=ASSET_MAX_AGE, conditional=True)
+    else:
+        response = app.response_class(body, mimetype=mimetypes.guess_type(path)[0])
+        response.vary.add('Accept-Encoding')
+        encoding = choose_content_encoding()
+        if encoding:
+            if (filename, encoding) not in compressed_assets:
+                compressed_assets[filename, encoding] = compress_body(body, encoding)
+            response.set_data(compressed_assets[filename, encoding])
+            response.headers['Content-Encoding'] = encoding
+        response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# Read replica routing
+# Read-only endpoints that may be served from a replica
+REPLICA_ENDPOINTS = {
+    'customer_reports', 'supplier_reports', 'customer_statement', 'supplier_statement',
+    'export_customers_excel', 'export_customers_pdf', 'export_suppliers_excel', 'export_suppliers_pdf',
+    'sales_invoices', 'purchase_invoices', 'collections', 'payments', 'customers', 'suppliers',
+    'view_customer', 'view_supplier', 'view_sales_invoice', 'view_purchase_invoice', 'view_collection', 'view_payment',
+    'print_sales_invoice', 'print_purchase_invoice', 'print_collection_receipt', 'print_payment_receipt',
+    'batch_print', 'analytics', 'api_list', 'api_get', 'api_events',
+}
+
+@app.before_request
+def choose_read_replica():
+    # Per request, also when test clients share one app context across requests
+    g.pop('replica_bind', None)
+    g.pop('wrote_primary', None)
+    if REPLICA_BINDS and request.endpoint in REPLICA_ENDPOINTS and session.get('read_primary_until', 0) < time.time():
+        g.replica_bind = random.choice(REPLICA_BINDS)
+
+@app.after_request
+def stick_to_primary_after_write(response):
+    if REPLICA_BINDS and g.get('wrote_primary'):
+        session['read_primary_until'] = time.time() + REPLICA_STICKY_SECONDS
+    return response
+
+# Branch databases
+# With BRANCH_DATABASE_URLS set, each request works in one branch database: the user's own
+# branch, or for users without one the branch last picked with switch_branch. Those users may
+# also open the customer/supplier reports across all branches (?branch=all).
+
+@app.before_request
+def choose_branch():
+    if not BRANCH_BINDS or not current_user.is_authenticated:
+        return
+    branch = current_user.branch or session.get('branch')
+    if current_user.branch and branch not in BRANCH_BINDS:
+        app.logger.error(f"User {current_user.username} belongs to unknown branch {branch}")
+        logout_user()
+        flash('الفرع المسجل لهذا المستخدم غير موجود', 'error')
+        return redirect(url_for('login'))
+    if branch not in BRANCH_BINDS:
+        branch = next(iter(BRANCH_BINDS))
+    g.branch, g.branch_bind = branch, BRANCH_BINDS[branch]
+
+def report_branches():
+    """Branches a cross-branch report covers, or None to report on the current branch only."""
+    if BRANCH_BINDS and request.args.get('branch') == 'all' and not current_user.branch:
+        return list(BRANCH_BINDS)
+    return None
+
+def fan_out_branches(function, branches):
+    """Call function once per branch in parallel threads; returns {branch: result} in branch order."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(branch):
+        with app.app_context():
+            use_branch(branch)
+            return function(), g.get('query_count', 0)
+    with ThreadPoolExecutor(max_workers=len(branches)) as pool:
+        results = list(pool.map(run, branches))
+    # The threads' statements count towards the request's query budget
+    g.query_count = g.get('query_count', 0) + sum(count for _, count in results)
+    g.query_branches = max(g.get('query_branches', 1), len(branches))
+    return {branch: result for branch, (result, _) in zip(branches, results)}
+
+def sync_branch_users(user_ids=None):
+    """Copy the users of the main database (all, or those in user_ids) into every branch
+    database, where documents reference them."""
+    table = User.__table__
+    query = select(table)
+    if user_ids is not None:
+        query = query.where(table.c.id.in_(user_ids))
+    with db.engine.connect() as connection:
+        users = [dict(row._mapping) for row in connection.execute(query)]
+    for bind in BRANCH_BINDS.values():
+        with db.engines[bind].begin() as connection:
+            existing = set(connection.execute(select(table.c.id)).scalars())
+            new = [user for user in users if user['id'] not in existing]
+            if new:
+                connection.execute(table.insert(), new)
+            changed = [{'user_id': user['id'], **{key: value for key, value in user.items() if key != 'id'}}
+                       for user in users if user['id'] in existing]
+            if changed:
+                connection.execute(table.update().where(table.c.id == bindparam('user_id')), changed)
+
+@event.listens_for(db.session, 'after_flush')
+def collect_branch_users(session, flush_context):
+    """Remember the users a flush created or changed, to copy them into the branches on commit."""
+    if BRANCH_BINDS:
+        user_ids = {obj.id for obj in itertools.chain(session.new, session.dirty) if isinstance(obj, User)}
+        if user_ids:
+            session.info.setdefault('branch_users', set()).update(user_ids)
+
+@event.listens_for(db.session, 'after_commit')
+def copy_branch_users(session):
+    user_ids = session.info.pop('branch_users', None)
+    if user_ids:
+        sync_branch_users(user_ids)
+
+@app.route('/switch_branch/<branch>')
+@login_required
+def switch_branch(branch):
+    if branch not in BRANCH_BINDS or current_user.branch:
+        flash('لا يمكن التبديل إلى هذا الفرع', 'error')
+        return redirect(url_for('dashboard'))
+    session['branch'] = branch
+    # Only local paths, never another site
+    next_url = request.args.get('next', '')
+    if not next_url.startswith('/') or next_url.startswith('//'):
+        next_url = url_for('dashboard')
+    return redirect(next_url)
+
+@app.context_processor
+def inject_branches():
+    return {'branches': list(BRANCH_BINDS), 'current_branch': g.get('branch')}
+
+# Duplicate submission protection
+IDEMPOTENCY_TTL = timedelta(hours=int(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24)))
+
+class ExpiringStore:
+    """Small thread-safe LRU mapping whose entries expire after a fixed TTL."""
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < datetime.utcnow():
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (datetime.utcnow() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+# (user id, form token) -> redirect location of the processed submission
+form_results = ExpiringStore(IDEMPOTENCY_TTL)
+
+def issue_form_token():
+    """One-time token rendered into posting forms as the hidden form_token field."""
+    return secrets.token_urlsafe(16)
+
+def purge_expired_idempotency_records():
+    """Delete stored responses older than IDEMPOTENCY_TTL; runs on a small share of writes."""
+    if random.random() < 0.01:
+        IdempotencyRecord.query.filter(IdempotencyRecord.created_at < datetime.utcnow() - IDEMPOTENCY_TTL)\
+            .delete(synchronize_session=False)
+
+def replay_form_submission(token, check_db=False):
+    """Return where an already processed submission of this form redirected to, or None."""
+    if not token:
+        return None
+    location = form_results.get((current_user.id, token))
+    if location is None and check_db:
+        record = db.session.get(IdempotencyRecord, (f'form:{token}', current_user.id))
+        if record is not None:
+            location = record.response_body
+            form_results.set((current_user.id, token), location)
+    return location
+
+def commit_form_submission(token, location):
+    """Commit the pending posting together with its form token.
+
+    The token row is unique per user, so a concurrent duplicate of the same
+    submission fails at commit. Returns the earlier submission's location in
+    that case (after rolling back), otherwise None.
+    """
+    if token:
+        purge_expired_idempotency_records()
+        db.session.add(IdempotencyRecord(key=f'form:{token}', user_id=current_user.id, request_hash=request.endpoint,
+                                         status_code=303, response_body=location))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        previous = replay_form_submission(token, check_db=True)
+        if previous is None:
+            raise
+        return previous
+    if token:
+        form_results.set((current_user.id, token), location)
+    return None
+
+# Credit limits
+def charge_customer(customer_id, amount):
+    """Add amount to a customer's balance unless that takes it over their credit limit.
+
+    The limit check and the increment are one conditional UPDATE, so the posting needs no
+    read of the customer row and concurrent postings can never pass the limit together.
+    Runs in the caller's transaction. Returns the new balance, or None when the customer
+    does not exist or the limit would be exceeded.
+    """
+    table = Customer.__table__
+    condition = table.c.id == customer_id
+    if amount > 0:
+        condition = and_(condition, or_(table.c.credit_limit.is_(None),
+                                        table.c.balance + amount <= table.c.credit_limit))
+    new_balance = db.session.execute(
+        table.update().where(condition).values(balance=table.c.balance + amount).returning(table.c.balance)
+    ).scalar()
+    if new_balance is not None:
+        defer_change(db.session, 'customer', {'entity': 'customer', 'entity_id': customer_id, 'action': 'update',
+                                              'party_type': 'customer', 'party_id': customer_id,
+                                              'old_amount': new_balance - amount, 'new_amount': new_balance})
+    return new_balance
+
+def credit_limit_message(customer_id):
+    """Why charge_customer refused a posting; only read on that (rare) path."""
+    customer = db.session.execute(select(Customer.balance, Customer.credit_limit)
+                                  .where(Customer.id == customer_id)).first()
+    if customer is None:
+        return 'العميل غير موجود'
+    available = max(customer.credit_limit - customer.balance, 0)
+    return (f'تتجاوز هذه الفاتورة حد الائتمان للعميل (الحد: {customer.credit_limit:,.2f} ج.م، '
+            f'الرصيد الحالي: {customer.balance:,.2f} ج.م، المتاح: {available:,.2f} ج.م)')
+
 # Routes
 @app.route('/')
 @login_required
@@ -116,8 +1490,8 @@ def dashboard():
     recent_purchases = PurchaseInvoice.query.order_by(PurchaseInvoice.created_at.desc()).limit(5).all()
     
     # Calculate balances
-    total_customer_balance = sum(customer.balance for customer in Customer.query.all())
-    total_supplier_balance = sum(supplier.balance for supplier in Supplier.query.all())
+    total_customer_balance = db.session.query(func.coalesce(func.sum(Customer.balance), 0)).scalar()
+    total_supplier_balance = db.session.query(func.coalesce(func.sum(Supplier.balance), 0)).scalar()
     
     return render_template('dashboard.html', 
                          total_customers=total_customers,
@@ -165,7 +1539,8 @@ def add_customer():
             name=request.form['name'],
             phone=request.form.get('phone'),
             address=request.form.get('address'),
-            email=request.form.get('email')
+            email=request.form.get('email'),
+            credit_limit=request.form.get('credit_limit', type=float)
         )
         db.session.add(customer)
         db.session.commit()
@@ -176,6 +1551,7 @@ def add_customer():
 
 @app.route('/view_customer/<int:id>')
 @login_required
+@conditional_view('customer')
 def view_customer(id):
     customer = Customer.query.get_or_404(id)
     return render_template('view_customer.html', customer=customer)
@@ -190,6 +1566,7 @@ def edit_customer(id):
         customer.phone = request.form.get('phone')
         customer.address = request.form.get('address')
         customer.email = request.form.get('email')
+        customer.credit_limit = request.form.get('credit_limit', type=float)
         
         db.session.commit()
         flash('تم تحديث بيانات العميل بنجاح', 'success')
@@ -201,10 +1578,16 @@ def edit_customer(id):
 @login_required
 def delete_customer(id):
     try:
-        customer = Customer.query.get_or_404(id)
-        db.session.delete(customer)
+        # cascade=1 also deletes the customer's documents, archived documents and opening balances
+        delete_api_records('customers', ids=[id], cascade=request.form.get('cascade') == '1')
         db.session.commit()
         return jsonify({'success': True})
+    except ApiError as e:
+        db.session.rollback()
+        if e.status_code == 409:
+            return jsonify({'success': False, 'has_history': True,
+                            'message': 'لا يمكن حذف العميل لوجود فواتير أو تحصيلات مسجلة'})
+        return jsonify({'success': False, 'message': e.message})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -234,6 +1617,7 @@ def add_supplier():
 
 @app.route('/view_supplier/<int:id>')
 @login_required
+@conditional_view('supplier')
 def view_supplier(id):
     supplier = Supplier.query.get_or_404(id)
     return render_template('view_supplier.html', supplier=supplier)
@@ -259,10 +1643,16 @@ def edit_supplier(id):
 @login_required
 def delete_supplier(id):
     try:
-        supplier = Supplier.query.get_or_404(id)
-        db.session.delete(supplier)
+        # cascade=1 also deletes the supplier's documents, archived documents and opening balances
+        delete_api_records('suppliers', ids=[id], cascade=request.form.get('cascade') == '1')
         db.session.commit()
         return jsonify({'success': True})
+    except ApiError as e:
+        db.session.rollback()
+        if e.status_code == 409:
+            return jsonify({'success': False, 'has_history': True,
+                            'message': 'لا يمكن حذف المورد لوجود فواتير أو مدفوعات مسجلة'})
+        return jsonify({'success': False, 'message': e.message})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -270,32 +1660,44 @@ def delete_supplier(id):
 @app.route('/sales_invoices')
 @login_required
 def sales_invoices():
-    invoices = SalesInvoice.query.order_by(SalesInvoice.created_at.desc()).all()
+    invoices = SalesInvoice.query.options(*load_profile('sales_invoice_list')).order_by(SalesInvoice.created_at.desc()).all()
     return render_template('sales_invoices.html', invoices=invoices)
 
 @app.route('/add_sales_invoice', methods=['GET', 'POST'])
 @login_required
 def add_sales_invoice():
     if request.method == 'POST':
+        invoice_date = datetime.strptime(request.form['invoice_date'], '%Y-%m-%d').date()
+        customer_id = int(request.form['customer_id'])
+        amount = float(request.form['amount'])
+        
+        # Number before the balance UPDATE: in block mode the allocator reserves blocks in its
+        # own transaction, which SQLite refuses once this one holds the write lock
+        invoice_number = request.form.get('invoice_number', '').strip()
+        if not invoice_number:
+            invoice_number = allocate_document_numbers('sales_invoice', year=invoice_date.year)[0]
+        
+        # Update customer balance, within the credit limit
+        if charge_customer(customer_id, amount) is None:
+            message = credit_limit_message(customer_id)
+            db.session.rollback()
+            flash(message, 'error')
+            return redirect(url_for('add_sales_invoice'))
+        
         invoice = SalesInvoice(
-            invoice_number=request.form['invoice_number'],
-            customer_id=request.form['customer_id'],
-            amount=float(request.form['amount']),
+            invoice_number=invoice_number,
+            customer_id=customer_id,
+            amount=amount,
             description=request.form.get('description'),
-            invoice_date=datetime.strptime(request.form['invoice_date'], '%Y-%m-%d').date(),
+            invoice_date=invoice_date,
             created_by=current_user.id
         )
-        
-        # Update customer balance
-        customer = Customer.query.get(invoice.customer_id)
-        customer.balance += invoice.amount
-        
         db.session.add(invoice)
         db.session.commit()
         flash('تم إضافة فاتورة المبيعات بنجاح', 'success')
         return redirect(url_for('sales_invoices'))
     
-    customers = Customer.query.all()
+    customers = Customer.query.options(*load_profile('customer_options')).all()
     return render_template('add_sales_invoice.html', customers=customers)
 
 
@@ -303,7 +1705,7 @@ def add_sales_invoice():
 @login_required
 def delete_sales_invoice(id):
     try:
-        invoice = SalesInvoice.query.get_or_404(id)
+        invoice = SalesInvoice.query.options(*load_profile('sales_invoice_detail')).get_or_404(id)
         customer = invoice.customer
         
         # Reverse customer balance
@@ -322,19 +1724,23 @@ def delete_sales_invoice(id):
 @app.route('/purchase_invoices')
 @login_required
 def purchase_invoices():
-    invoices = PurchaseInvoice.query.order_by(PurchaseInvoice.created_at.desc()).all()
+    invoices = PurchaseInvoice.query.options(*load_profile('purchase_invoice_list')).order_by(PurchaseInvoice.created_at.desc()).all()
     return render_template('purchase_invoices.html', invoices=invoices)
 
 @app.route('/add_purchase_invoice', methods=['GET', 'POST'])
 @login_required
 def add_purchase_invoice():
     if request.method == 'POST':
+        invoice_date = datetime.strptime(request.form['invoice_date'], '%Y-%m-%d').date()
+        invoice_number = request.form.get('invoice_number', '').strip()
+        if not invoice_number:
+            invoice_number = allocate_document_numbers('purchase_invoice', year=invoice_date.year)[0]
         invoice = PurchaseInvoice(
-            invoice_number=request.form['invoice_number'],
+            invoice_number=invoice_number,
             supplier_id=request.form['supplier_id'],
             amount=float(request.form['amount']),
             description=request.form.get('description'),
-            invoice_date=datetime.strptime(request.form['invoice_date'], '%Y-%m-%d').date(),
+            invoice_date=invoice_date,
             created_by=current_user.id
         )
         
@@ -347,7 +1753,7 @@ def add_purchase_invoice():
         flash('تم إضافة فاتورة المشتريات بنجاح', 'success')
         return redirect(url_for('purchase_invoices'))
     
-    suppliers = Supplier.query.all()
+    suppliers = Supplier.query.options(*load_profile('supplier_options')).all()
     return render_template('add_purchase_invoice.html', suppliers=suppliers)
 
 
@@ -355,7 +1761,7 @@ def add_purchase_invoice():
 @login_required
 def delete_purchase_invoice(id):
     try:
-        invoice = PurchaseInvoice.query.get_or_404(id)
+        invoice = PurchaseInvoice.query.options(*load_profile('purchase_invoice_detail')).get_or_404(id)
         supplier = invoice.supplier
         
         # Reverse supplier balance
@@ -374,23 +1780,24 @@ def delete_purchase_invoice(id):
 @app.route('/collections')
 @login_required
 def collections():
-    collections = Collection.query.order_by(Collection.created_at.desc()).all()
+    collections = Collection.query.options(*load_profile('collection_list')).order_by(Collection.created_at.desc()).all()
     return render_template('collections.html', collections=collections)
 
 @app.route('/add_collection', methods=['GET', 'POST'])
 @login_required
 def add_collection():
     if request.method == 'POST':
+        form_token = request.form.get('form_token')
+        previous = replay_form_submission(form_token)
+        if previous:
+            flash('تم حفظ هذا التحصيل مسبقاً ولم يتم تكراره', 'info')
+            return redirect(previous)
         try:
-            app.logger.debug(f"Form data: {request.form}")
-            
             customer_id = request.form.get('customer_id')
             amount = request.form.get('amount')
             collection_date = request.form.get('collection_date')
             notes = request.form.get('notes', '')
             
-            app.logger.debug(f"Customer ID: {customer_id}, Amount: {amount}, Date: {collection_date}")
-            
             if not customer_id or not amount or not collection_date:
                 flash('جميع الحقول المطلوبة يجب ملؤها', 'error')
                 return redirect(url_for('add_collection'))
@@ -407,27 +1814,29 @@ def add_collection():
             customer = Customer.query.get(collection.customer_id)
             if customer:
                 customer.balance -= collection.amount
-                app.logger.debug(f"Updated customer {customer.name} balance to {customer.balance}")
             
             db.session.add(collection)
-            db.session.commit()
+            previous = commit_form_submission(form_token, url_for('collections'))
+            if previous:
+                flash('تم حفظ هذا التحصيل مسبقاً ولم يتم تكراره', 'info')
+                return redirect(previous)
             flash('تم إضافة التحصيل بنجاح', 'success')
             return redirect(url_for('collections'))
         except Exception as e:
-            app.logger.error(f"Error adding collection: {str(e)}")
+            app.logger.exception('Error adding collection')
             db.session.rollback()
             flash(f'حدث خطأ في إضافة التحصيل: {str(e)}', 'error')
             return redirect(url_for('add_collection'))
     
-    customers = Customer.query.all()
-    return render_template('add_collection.html', customers=customers, today=date.today())
+    customers = Customer.query.options(*load_profile('customer_options')).all()
+    return render_template('add_collection.html', customers=customers, today=date.today(), form_token=issue_form_token())
 
 
 @app.route('/delete_collection/<int:id>', methods=['POST'])
 @login_required
 def delete_collection(id):
     try:
-        collection = Collection.query.get_or_404(id)
+        collection = Collection.query.options(*load_profile('collection_detail')).get_or_404(id)
         customer = collection.customer
         
         # Reverse customer balance
@@ -446,23 +1855,24 @@ def delete_collection(id):
 @app.route('/payments')
 @login_required
 def payments():
-    payments = Payment.query.order_by(Payment.created_at.desc()).all()
+    payments = Payment.query.options(*load_profile('payment_list')).order_by(Payment.created_at.desc()).all()
     return render_template('payments.html', payments=payments)
 
 @app.route('/add_payment', methods=['GET', 'POST'])
 @login_required
 def add_payment():
     if request.method == 'POST':
+        form_token = request.form.get('form_token')
+        previous = replay_form_submission(form_token)
+        if previous:
+            flash('تم حفظ هذا الدفع مسبقاً ولم يتم تكراره', 'info')
+            return redirect(previous)
         try:
-            app.logger.debug(f"Payment form data: {request.form}")
-            
             supplier_id = request.form.get('supplier_id')
             amount = request.form.get('amount')
             payment_date = request.form.get('payment_date')
             notes = request.form.get('notes', '')
             
-            app.logger.debug(f"Supplier ID: {supplier_id}, Amount: {amount}, Date: {payment_date}")
-            
             if not supplier_id or not amount or not payment_date:
                 flash('جميع الحقول المطلوبة يجب ملؤها', 'error')
                 return redirect(url_for('add_payment'))
@@ -479,20 +1889,22 @@ def add_payment():
             supplier = Supplier.query.get(payment.supplier_id)
             if supplier:
                 supplier.balance -= payment.amount
-                app.logger.debug(f"Updated supplier {supplier.name} balance to {supplier.balance}")
             
             db.session.add(payment)
-            db.session.commit()
+            previous = commit_form_submission(form_token, url_for('payments'))
+            if previous:
+                flash('تم حفظ هذا الدفع مسبقاً ولم يتم تكراره', 'info')
+                return redirect(previous)
             flash('تم إضافة الدفع بنجاح', 'success')
             return redirect(url_for('payments'))
         except Exception as e:
-            app.logger.error(f"Error adding payment: {str(e)}")
+            app.logger.exception('Error adding payment')
             db.session.rollback()
             flash(f'حدث خطأ في إضافة الدفع: {str(e)}', 'error')
             return redirect(url_for('add_payment'))
     
-    suppliers = Supplier.query.all()
-    return render_template('add_payment.html', suppliers=suppliers, today=date.today())
+    suppliers = Supplier.query.options(*load_profile('supplier_options')).all()
+    return render_template('add_payment.html', suppliers=suppliers, today=date.today(), form_token=issue_form_token())
 
 
 
@@ -500,7 +1912,7 @@ def add_payment():
 @login_required
 def delete_payment(id):
     try:
-        payment = Payment.query.get_or_404(id)
+        payment = Payment.query.options(*load_profile('payment_detail')).get_or_404(id)
         supplier = payment.supplier
         
         # Reverse supplier balance
@@ -518,6 +1930,7 @@ def delete_payment(id):
 # Customer statement
 @app.route('/customer_statement/<int:customer_id>')
 @login_required
+@conditional_view('customer', 'sales_invoice', 'collection')
 def customer_statement(customer_id):
     customer = Customer.query.get_or_404(customer_id)
     
@@ -527,14 +1940,26 @@ def customer_statement(customer_id):
     # Get all collections for this customer
     collections = Collection.query.filter_by(customer_id=customer_id).order_by(Collection.collection_date.desc()).all()
     
+    # Start from the year-end snapshot unless the archived detail is requested
+    show_archived = request.args.get('archived') == '1'
+    opening = None
+    if show_archived:
+        sales_invoices = sales_invoices + archived_documents(SalesInvoice, 'customer_id', customer_id)
+        collections = collections + archived_documents(Collection, 'customer_id', customer_id)
+    else:
+        opening = party_opening_balance('customer', customer_id)
+    
     return render_template('customer_statement.html', 
                          customer=customer, 
-                         sales_invoices=sales_invoices, 
-                         collections=collections)
+                         invoices=sales_invoices, 
+                         collections=collections,
+                         opening=opening,
+                         show_archived=show_archived)
 
 # Supplier statement
 @app.route('/supplier_statement/<int:supplier_id>')
 @login_required
+@conditional_view('supplier', 'purchase_invoice', 'payment')
 def supplier_statement(supplier_id):
     supplier = Supplier.query.get_or_404(supplier_id)
     
@@ -544,48 +1969,81 @@ def supplier_statement(supplier_id):
     # Get all payments for this supplier
     payments = Payment.query.filter_by(supplier_id=supplier_id).order_by(Payment.payment_date.desc()).all()
     
+    # Start from the year-end snapshot unless the archived detail is requested
+    show_archived = request.args.get('archived') == '1'
+    opening = None
+    if show_archived:
+        purchase_invoices = purchase_invoices + archived_documents(PurchaseInvoice, 'supplier_id', supplier_id)
+        payments = payments + archived_documents(Payment, 'supplier_id', supplier_id)
+    else:
+        opening = party_opening_balance('supplier', supplier_id)
+    
     return render_template('supplier_statement.html', 
                          supplier=supplier, 
-                         purchase_invoices=purchase_invoices, 
-                         payments=payments)
+                         invoices=purchase_invoices, 
+                         payments=payments,
+                         opening=opening,
+                         show_archived=show_archived)
 
 # Customer Reports
 @app.route('/customer_reports')
 @login_required
+@conditional_view('customer', 'sales_invoice', 'collection')
 def customer_reports():
+    branches = report_branches()
+    if branches:
+        results = fan_out_branches(customer_report_rows, branches)
+        customer_data = [dict(row, branch=branch) for branch, rows in results.items() for row in rows]
+    else:
+        customer_data = customer_report_rows()
+    return render_template('customer_reports.html', customer_data=customer_data, all_branches=bool(branches))
+
+def customer_report_rows():
     customers = Customer.query.all()
+    invoice_totals = party_totals(SalesInvoice, 'customer_id')
+    collection_totals = party_totals(Collection, 'customer_id')
     customer_data = []
     
     for customer in customers:
-        total_invoices = sum(invoice.amount for invoice in customer.sales_invoices)
-        total_collections = sum(collection.amount for collection in customer.collections)
+        total_invoices = invoice_totals.get(customer.id, 0)
+        total_collections = collection_totals.get(customer.id, 0)
         customer_data.append({
             'customer': customer,
             'total_invoices': total_invoices,
             'total_collections': total_collections,
             'balance': customer.balance
         })
-    
-    return render_template('customer_reports.html', customer_data=customer_data)
+    return customer_data
 
 # Supplier Reports
 @app.route('/supplier_reports')
 @login_required
+@conditional_view('supplier', 'purchase_invoice', 'payment')
 def supplier_reports():
+    branches = report_branches()
+    if branches:
+        results = fan_out_branches(supplier_report_rows, branches)
+        supplier_data = [dict(row, branch=branch) for branch, rows in results.items() for row in rows]
+    else:
+        supplier_data = supplier_report_rows()
+    return render_template('supplier_reports.html', supplier_data=supplier_data, all_branches=bool(branches))
+
+def supplier_report_rows():
     suppliers = Supplier.query.all()
+    invoice_totals = party_totals(PurchaseInvoice, 'supplier_id')
+    payment_totals = party_totals(Payment, 'supplier_id')
     supplier_data = []
     
     for supplier in suppliers:
-        total_invoices = sum(invoice.amount for invoice in supplier.purchase_invoices)
-        total_payments = sum(payment.amount for payment in supplier.payments)
+        total_invoices = invoice_totals.get(supplier.id, 0)
+        total_payments = payment_totals.get(supplier.id, 0)
         supplier_data.append({
             'supplier': supplier,
             'total_invoices': total_invoices,
             'total_payments': total_payments,
             'balance': supplier.balance
         })
-    
-    return render_template('supplier_reports.html', supplier_data=supplier_data)
+    return supplier_data
 
 # Export Customer Reports to Excel
 @app.route('/export_customers_excel')
@@ -596,11 +2054,13 @@ def export_customers_excel():
         from io import BytesIO
         
         customers = Customer.query.all()
+        invoice_totals = party_totals(SalesInvoice, 'customer_id')
+        collection_totals = party_totals(Collection, 'customer_id')
         customer_data = []
         
         for customer in customers:
-            total_invoices = sum(invoice.amount for invoice in customer.sales_invoices)
-            total_collections = sum(collection.amount for collection in customer.collections)
+            total_invoices = invoice_totals.get(customer.id, 0)
+            total_collections = collection_totals.get(customer.id, 0)
             customer_data.append({
                 'الرقم': customer.id,
                 'اسم العميل': customer.name,
@@ -647,11 +2107,13 @@ def export_customers_pdf():
         from io import BytesIO
         
         customers = Customer.query.all()
+        invoice_totals = party_totals(SalesInvoice, 'customer_id')
+        collection_totals = party_totals(Collection, 'customer_id')
         customer_data = []
         
         for customer in customers:
-            total_invoices = sum(invoice.amount for invoice in customer.sales_invoices)
-            total_collections = sum(collection.amount for collection in customer.collections)
+            total_invoices = invoice_totals.get(customer.id, 0)
+            total_collections = collection_totals.get(customer.id, 0)
             customer_data.append([
                 str(customer.id),
                 customer.name,
@@ -727,11 +2189,13 @@ def export_suppliers_excel():
         from io import BytesIO
         
         suppliers = Supplier.query.all()
+        invoice_totals = party_totals(PurchaseInvoice, 'supplier_id')
+        payment_totals = party_totals(Payment, 'supplier_id')
         supplier_data = []
         
         for supplier in suppliers:
-            total_invoices = sum(invoice.amount for invoice in supplier.purchase_invoices)
-            total_payments = sum(payment.amount for payment in supplier.payments)
+            total_invoices = invoice_totals.get(supplier.id, 0)
+            total_payments = payment_totals.get(supplier.id, 0)
             supplier_data.append({
                 'الرقم': supplier.id,
                 'اسم المورد': supplier.name,
@@ -767,55 +2231,66 @@ def export_suppliers_excel():
 # View Sales Invoice
 @app.route('/view_sales_invoice/<int:invoice_id>')
 @login_required
+@conditional_view('sales_invoice', 'customer')
 def view_sales_invoice(invoice_id):
-    invoice = SalesInvoice.query.get_or_404(invoice_id)
+    invoice = SalesInvoice.query.options(*load_profile('sales_invoice_detail')).get_or_404(invoice_id)
     return render_template('view_sales_invoice.html', invoice=invoice)
 
 # Edit Sales Invoice
 @app.route('/edit_sales_invoice/<int:invoice_id>', methods=['GET', 'POST'])
 @login_required
 def edit_sales_invoice(invoice_id):
-    invoice = SalesInvoice.query.get_or_404(invoice_id)
+    invoice = SalesInvoice.query.options(*load_profile('sales_invoice_detail')).get_or_404(invoice_id)
     
     if request.method == 'POST':
+        old_customer_id, old_amount = invoice.customer_id, invoice.amount
+        customer_id = int(request.form['customer_id'])
+        amount = float(request.form['amount'])
+        
+        # Move the old amount off the balance and charge the new one, within the credit limit
+        charges = [(customer_id, amount - old_amount)] if customer_id == old_customer_id \
+            else [(old_customer_id, -old_amount), (customer_id, amount)]
+        for charged_id, difference in charges:
+            if difference and charge_customer(charged_id, difference) is None:
+                message = credit_limit_message(charged_id)
+                db.session.rollback()
+                flash(message, 'error')
+                return redirect(url_for('edit_sales_invoice', invoice_id=invoice_id))
+        
         invoice.invoice_number = request.form['invoice_number']
-        invoice.customer_id = request.form['customer_id']
-        invoice.amount = float(request.form['amount'])
+        invoice.customer_id = customer_id
+        invoice.amount = amount
         invoice.invoice_date = datetime.strptime(request.form['invoice_date'], '%Y-%m-%d').date()
         invoice.description = request.form.get('description', '')
         
-        # Update customer balance
-        old_amount = invoice.amount
-        new_amount = float(request.form['amount'])
-        difference = new_amount - old_amount
-        invoice.customer.balance += difference
-        
         db.session.commit()
         flash('تم تحديث الفاتورة بنجاح!', 'success')
         return redirect(url_for('sales_invoices'))
     
-    customers = Customer.query.all()
+    customers = Customer.query.options(*load_profile('customer_options')).all()
     return render_template('edit_sales_invoice.html', invoice=invoice, customers=customers)
 
 # Print Sales Invoice
 @app.route('/print_sales_invoice/<int:invoice_id>')
 @login_required
+@conditional_view('sales_invoice', 'customer')
 def print_sales_invoice(invoice_id):
-    invoice = SalesInvoice.query.get_or_404(invoice_id)
-    return render_template('print_sales_invoice.html', invoice=invoice)
+    invoice = SalesInvoice.query.options(*load_profile('sales_invoice_detail')).get_or_404(invoice_id)
+    return render_document('sales_invoice', invoice, invoice.customer, 'print_sales_invoice.html', invoice=invoice)
 
 # View Purchase Invoice
 @app.route('/view_purchase_invoice/<int:invoice_id>')
 @login_required
+@conditional_view('purchase_invoice', 'supplier')
 def view_purchase_invoice(invoice_id):
-    invoice = PurchaseInvoice.query.get_or_404(invoice_id)
+    invoice = PurchaseInvoice.query.options(*load_profile('purchase_invoice_detail')).get_or_404(invoice_id)
     return render_template('view_purchase_invoice.html', invoice=invoice)
 
 # Edit Purchase Invoice
 @app.route('/edit_purchase_invoice/<int:invoice_id>', methods=['GET', 'POST'])
 @login_required
 def edit_purchase_invoice(invoice_id):
-    invoice = PurchaseInvoice.query.get_or_404(invoice_id)
+    invoice = PurchaseInvoice.query.options(*load_profile('purchase_invoice_detail')).get_or_404(invoice_id)
     
     if request.method == 'POST':
         invoice.invoice_number = request.form['invoice_number']
@@ -834,28 +2309,30 @@ def edit_purchase_invoice(invoice_id):
         flash('تم تحديث الفاتورة بنجاح!', 'success')
         return redirect(url_for('purchase_invoices'))
     
-    suppliers = Supplier.query.all()
+    suppliers = Supplier.query.options(*load_profile('supplier_options')).all()
     return render_template('edit_purchase_invoice.html', invoice=invoice, suppliers=suppliers)
 
 # Print Purchase Invoice
 @app.route('/print_purchase_invoice/<int:invoice_id>')
 @login_required
+@conditional_view('purchase_invoice', 'supplier')
 def print_purchase_invoice(invoice_id):
-    invoice = PurchaseInvoice.query.get_or_404(invoice_id)
-    return render_template('print_purchase_invoice.html', invoice=invoice)
+    invoice = PurchaseInvoice.query.options(*load_profile('purchase_invoice_detail')).get_or_404(invoice_id)
+    return render_document('purchase_invoice', invoice, invoice.supplier, 'print_purchase_invoice.html', invoice=invoice)
 
 # View Collection
 @app.route('/view_collection/<int:collection_id>')
 @login_required
+@conditional_view('collection', 'customer')
 def view_collection(collection_id):
-    collection = Collection.query.get_or_404(collection_id)
+    collection = Collection.query.options(*load_profile('collection_detail')).get_or_404(collection_id)
     return render_template('view_collection.html', collection=collection)
 
 # Edit Collection
 @app.route('/edit_collection/<int:collection_id>', methods=['GET', 'POST'])
 @login_required
 def edit_collection(collection_id):
-    collection = Collection.query.get_or_404(collection_id)
+    collection = Collection.query.options(*load_profile('collection_detail')).get_or_404(collection_id)
     
     if request.method == 'POST':
         old_amount = collection.amount
@@ -873,28 +2350,30 @@ def edit_collection(collection_id):
         flash('تم تحديث التحصيل بنجاح!', 'success')
         return redirect(url_for('collections'))
     
-    customers = Customer.query.all()
+    customers = Customer.query.options(*load_profile('customer_options')).all()
     return render_template('edit_collection.html', collection=collection, customers=customers)
 
 # Print Collection Receipt
 @app.route('/print_collection_receipt/<int:collection_id>')
 @login_required
+@conditional_view('collection', 'customer')
 def print_collection_receipt(collection_id):
-    collection = Collection.query.get_or_404(collection_id)
-    return render_template('print_collection_receipt.html', collection=collection)
+    collection = Collection.query.options(*load_profile('collection_detail')).get_or_404(collection_id)
+    return render_document('collection', collection, collection.customer, 'print_collection_receipt.html', collection=collection)
 
 # View Payment
 @app.route('/view_payment/<int:payment_id>')
 @login_required
+@conditional_view('payment', 'supplier')
 def view_payment(payment_id):
-    payment = Payment.query.get_or_404(payment_id)
+    payment = Payment.query.options(*load_profile('payment_detail')).get_or_404(payment_id)
     return render_template('view_payment.html', payment=payment)
 
 # Edit Payment
 @app.route('/edit_payment/<int:payment_id>', methods=['GET', 'POST'])
 @login_required
 def edit_payment(payment_id):
-    payment = Payment.query.get_or_404(payment_id)
+    payment = Payment.query.options(*load_profile('payment_detail')).get_or_404(payment_id)
     
     if request.method == 'POST':
         old_amount = payment.amount
@@ -912,15 +2391,16 @@ def edit_payment(payment_id):
         flash('تم تحديث المدفوع بنجاح!', 'success')
         return redirect(url_for('payments'))
     
-    suppliers = Supplier.query.all()
+    suppliers = Supplier.query.options(*load_profile('supplier_options')).all()
     return render_template('edit_payment.html', payment=payment, suppliers=suppliers)
 
 # Print Payment Receipt
 @app.route('/print_payment_receipt/<int:payment_id>')
 @login_required
+@conditional_view('payment', 'supplier')
 def print_payment_receipt(payment_id):
-    payment = Payment.query.get_or_404(payment_id)
-    return render_template('print_payment_receipt.html', payment=payment)
+    payment = Payment.query.options(*load_profile('payment_detail')).get_or_404(payment_id)
+    return render_document('payment', payment, payment.supplier, 'print_payment_receipt.html', payment=payment)
 
 # Export Supplier Reports to PDF
 @app.route('/export_suppliers_pdf')
@@ -934,11 +2414,13 @@ def export_suppliers_pdf():
         from io import BytesIO
         
         suppliers = Supplier.query.all()
+        invoice_totals = party_totals(PurchaseInvoice, 'supplier_id')
+        payment_totals = party_totals(Payment, 'supplier_id')
         supplier_data = []
         
         for supplier in suppliers:
-            total_invoices = sum(invoice.amount for invoice in supplier.purchase_invoices)
-            total_payments = sum(payment.amount for payment in supplier.payments)
+            total_invoices = invoice_totals.get(supplier.id, 0)
+            total_payments = payment_totals.get(supplier.id, 0)
             supplier_data.append([
                 str(supplier.id),
                 supplier.name,
@@ -1005,6 +2487,1556 @@ def export_suppliers_pdf():
         flash(f'حدث خطأ في تصدير PDF: {str(e)}', 'error')
         return redirect(url_for('supplier_reports'))
 
+# Analytics
+# flow -> (model, date column); sales/collections drive DSO, purchases/payments drive DPO
+ANALYTICS_FLOWS = OrderedDict([
+    ('sales', (SalesInvoice, 'invoice_date')),
+    ('collections', (Collection, 'collection_date')),
+    ('purchases', (PurchaseInvoice, 'invoice_date')),
+    ('payments', (Payment, 'payment_date')),
+])
+# Covering (date, amount) indexes so monthly bucketing scans the index only (migrate_db.py
+# adds them, and the statement indexes, to databases created before them)
+ANALYTICS_INDEXES = [db.Index(f'ix_{model.__tablename__}_{date_column}_amount',
+                              getattr(model, date_column), model.amount)
+                     for model, date_column in ANALYTICS_FLOWS.values()]
+# Trailing window used for the monthly DSO/DPO figures
+ANALYTICS_DSO_MONTHS = 3
+ANALYTICS_CACHE_TTL = timedelta(seconds=int(os.environ.get('ANALYTICS_CACHE_SECONDS', 600)))
+# (period, top N, branch, data versions) -> computed summary
+analytics_cache = ExpiringStore(ANALYTICS_CACHE_TTL, max_entries=256)
+
+def month_bucket(column, dialect):
+    """SQL expression truncating a date column to its 'YYYY-MM' month."""
+    if dialect == 'postgresql':
+        return func.to_char(column, 'YYYY-MM')
+    return func.strftime('%Y-%m', column)
+
+def monthly_flow_totals(tables, dialect, date_from, bind_arguments=None):
+    """(flow, 'YYYY-MM', total) rows for every flow dated on or after date_from, in one UNION ALL query."""
+    parts = []
+    for flow, (table, date_column) in tables.items():
+        column = table.c[date_column]
+        bucket = month_bucket(column, dialect)
+        parts.append(select(literal(flow).label('flow'), bucket.label('month'), func.sum(table.c.amount).label('total'))
+                     .where(column >= date_from).group_by(bucket))
+    return db.session.execute(union_all(*parts), bind_arguments=bind_arguments).all()
+
+def analytics_summary(date_from, date_to, top):
+    """Monthly sales/collections/purchases/payments, receivables, payables, DSO/DPO and top debtors."""
+    import numpy as np
+    import pandas as pd
+
+    receivables, payables, closed_year = db.session.execute(select(
+        select(func.coalesce(func.sum(Customer.balance), 0)).scalar_subquery(),
+        select(func.coalesce(func.sum(Supplier.balance), 0)).scalar_subquery(),
+        select(func.max(FiscalYearClose.year)).scalar_subquery(),
+    )).one()
+
+    live = OrderedDict((flow, (model.__table__, date_column)) for flow, (model, date_column) in ANALYTICS_FLOWS.items())
+    rows = monthly_flow_totals(live, db.engines[current_branch_bind()].dialect.name, date_from)
+    if closed_year is not None and closed_year >= date_from.year:
+        archived = OrderedDict((flow, (ARCHIVE_TABLES[model.__tablename__], date_column))
+                               for flow, (model, date_column) in ANALYTICS_FLOWS.items())
+        archive_engine = db.engines[ARCHIVE_BIND or current_branch_bind()]
+        rows += monthly_flow_totals(archived, archive_engine.dialect.name, date_from, archive_bind_arguments())
+
+    start, end = pd.Period(date_from, freq='M'), pd.Period(date_to, freq='M')
+    frame = pd.DataFrame(rows, columns=['flow', 'month', 'total'])
+    frame['total'] = frame['total'].astype(float)
+    flows = frame.pivot_table(index='month', columns='flow', values='total', aggfunc='sum', fill_value=0.0)
+    flows.index = pd.PeriodIndex(flows.index, freq='M')
+    # Documents dated after the period still move today's balances back, so keep their months
+    last = max(end, flows.index.max()) if len(flows) else end
+    flows = flows.reindex(columns=list(ANALYTICS_FLOWS), fill_value=0.0) \
+                 .reindex(pd.period_range(start, last, freq='M'), fill_value=0.0)
+
+    # Balance at the end of each month = today's balance minus everything posted afterwards
+    receivable_change = flows['sales'] - flows['collections']
+    payable_change = flows['purchases'] - flows['payments']
+    flows['receivables'] = float(receivables) - (receivable_change.sum() - receivable_change.cumsum())
+    flows['payables'] = float(payables) - (payable_change.sum() - payable_change.cumsum())
+
+    days = pd.Series(flows.index.days_in_month, index=flows.index).rolling(ANALYTICS_DSO_MONTHS, min_periods=1).sum()
+    trailing_sales = flows['sales'].rolling(ANALYTICS_DSO_MONTHS, min_periods=1).sum()
+    trailing_purchases = flows['purchases'].rolling(ANALYTICS_DSO_MONTHS, min_periods=1).sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        flows['dso'] = np.where(trailing_sales > 0, flows['receivables'] / trailing_sales * days, np.nan)
+        flows['dpo'] = np.where(trailing_purchases > 0, flows['payables'] / trailing_purchases * days, np.nan)
+
+    period = flows.loc[start:end]
+    totals = period[list(ANALYTICS_FLOWS)].sum()
+    period_days = (date_to - date_from).days + 1
+
+    def ratio(numerator, denominator, scale=1.0):
+        return float(numerator / denominator * scale) if denominator > 0 else None
+
+    debtors = Customer.query.options(load_only(Customer.id, Customer.name, Customer.phone, Customer.balance))\
+        .filter(Customer.balance > 0).order_by(Customer.balance.desc()).limit(top).all()
+
+    return {
+        'months': [
+            {'month': str(month), **{key: (None if pd.isna(value) else float(value)) for key, value in values.items()}}
+            for month, values in period.to_dict('index').items()
+        ],
+        'totals': {flow: float(total) for flow, total in totals.items()},
+        'max_flow': float(period[['sales', 'collections']].to_numpy().max()) if len(period) else 0.0,
+        'receivables': float(period['receivables'].iloc[-1]),
+        'payables': float(period['payables'].iloc[-1]),
+        'dso': ratio(period['receivables'].iloc[-1], totals['sales'], period_days),
+        'dpo': ratio(period['payables'].iloc[-1], totals['purchases'], period_days),
+        'collection_rate': ratio(totals['collections'], totals['sales'], 100),
+        'top_debtors': [{'id': customer.id, 'name': customer.name, 'phone': customer.phone,
+                         'balance': customer.balance, 'share': ratio(customer.balance, float(receivables), 100)}
+                        for customer in debtors],
+    }
+
+def parse_period_date(value, default):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else default
+    except ValueError:
+        return default
+
+@app.route('/analytics')
+@login_required
+@conditional_view(*VERSIONED_TABLES)
+def analytics():
+    today = date.today()
+    year, month = divmod(today.year * 12 + today.month - 12, 12)
+    date_from = parse_period_date(request.args.get('date_from'), date(year, month + 1, 1))
+    date_to = parse_period_date(request.args.get('date_to'), today)
+    if date_from > date_to:
+        date_from, date_to = date_to, date_from
+    top = min(max(request.args.get('top', 10, type=int), 1), 100)
+
+    versions = g.get('data_versions') or get_data_versions(VERSIONED_TABLES)
+    key = (date_from, date_to, top, g.get('branch'), tuple(sorted(versions.items())))
+    summary = analytics_cache.get(key)
+    if summary is None:
+        try:
+            summary = analytics_summary(date_from, date_to, top)
+        except ImportError:
+            flash('مكتبة pandas غير مثبتة. يرجى تثبيتها لاستخدام التحليلات', 'error')
+            return redirect(url_for('dashboard'))
+        analytics_cache.set(key, summary)
+
+    return render_template('analytics.html', summary=summary, date_from=date_from, date_to=date_to, top=top)
+
+# Columnar snapshot export
+SNAPSHOT_TABLES = (Customer, Supplier, SalesInvoice, PurchaseInvoice, Collection, Payment)
+SNAPSHOT_WATERMARKS = '_watermarks.json'
+
+def snapshot_schema(table):
+    """Arrow schema matching the column types of a table."""
+    import pyarrow as pa
+    types = ((db.Integer, pa.int64()), (db.Float, pa.float64()), (db.DateTime, pa.timestamp('us')),
+             (db.Date, pa.date32()), (db.Boolean, pa.bool_()))
+    return pa.schema([
+        pa.field(column.name, next((arrow_type for sql_type, arrow_type in types if isinstance(column.type, sql_type)),
+                                   pa.string()))
+        for column in table.columns
+    ])
+
+def open_snapshot_writer(path, schema, file_format):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if file_format == 'parquet':
+        return pq.ParquetWriter(path, schema, compression='zstd')
+    return pa.ipc.new_file(path, schema)
+
+def after_watermark(table, watermark):
+    """Rows ordered after the (created_at, id) watermark; rows without created_at sort first."""
+    created_at, last_id = watermark
+    if created_at is None:
+        return or_(table.c.created_at.isnot(None), table.c.id > last_id)
+    return or_(table.c.created_at > created_at, and_(table.c.created_at == created_at, table.c.id > last_id))
+
+def export_table_snapshot(table, output_dir, watermark, run_id, batch_size, file_format, bind_arguments):
+    """Stream the rows of one table after watermark into created_month=YYYY-MM partitions.
+
+    Returns (rows exported, new watermark). Each partition touched by this run gets one
+    part-<run_id> file, written under a .tmp name and renamed once complete.
+    """
+    import pyarrow as pa
+    schema = snapshot_schema(table)
+    query = select(table).order_by(table.c.created_at.asc().nulls_first(), table.c.id)
+    if watermark is not None:
+        query = query.where(after_watermark(table, watermark))
+
+    exported = 0
+    writer = path = partition = None
+    result = db.session.execute(query.execution_options(yield_per=batch_size), bind_arguments=bind_arguments)
+    try:
+        for rows in result.partitions():
+            # Rows arrive in created_at order, so each month's rows are contiguous
+            for month, month_rows in itertools.groupby(
+                    rows, key=lambda row: row.created_at.strftime('%Y-%m') if row.created_at else 'unknown'):
+                if month != partition:
+                    if writer is not None:
+                        writer.close()
+                        os.replace(path + '.tmp', path)
+                    directory = os.path.join(output_dir, table.name, f'created_month={month}')
+                    os.makedirs(directory, exist_ok=True)
+                    path = os.path.join(directory, f'part-{run_id}.{file_format}')
+                    writer, partition = open_snapshot_writer(path + '.tmp', schema, file_format), month
+                columns = list(zip(*month_rows))
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+            exported += len(rows)
+            watermark = (rows[-1].created_at, rows[-1].id)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        os.replace(path + '.tmp', path)
+    return exported, watermark
+
+def export_snapshot(output_dir, full=False, batch_size=50000, file_format='parquet'):
+    """Export the six tables as partitioned Parquet/Arrow files, incrementally by created_at.
+
+    Only rows created after the previous run's watermark are written, so rows edited
+    after their export (balances, corrected documents) need a full export to refresh.
+    Returns {table name: rows exported}.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # Leftovers of an interrupted run; their rows are still after the saved watermark
+    for leftover in glob.glob(os.path.join(output_dir, '*', '*', '*.tmp')):
+        os.remove(leftover)
+    watermarks_path = os.path.join(output_dir, SNAPSHOT_WATERMARKS)
+    watermarks = {}
+    if os.path.exists(watermarks_path) and not full:
+        with open(watermarks_path) as f:
+            watermarks = json.load(f)
+
+    # Read from a replica when one is configured, keeping the export off the primary
+    bind_arguments = {'bind': db.engines[REPLICA_BINDS[0]]} if REPLICA_BINDS and not current_branch_bind() else None
+    run_id = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    counts = {}
+    for model in SNAPSHOT_TABLES:
+        table = model.__table__
+        saved = watermarks.get(table.name)
+        watermark = None
+        if saved is not None:
+            watermark = (datetime.fromisoformat(saved['created_at']) if saved['created_at'] else None, saved['id'])
+        elif os.path.isdir(os.path.join(output_dir, table.name)):
+            shutil.rmtree(os.path.join(output_dir, table.name))
+
+        exported, watermark = export_table_snapshot(table, output_dir, watermark, run_id, batch_size, file_format,
+                                                    bind_arguments)
+        counts[table.name] = exported
+        if watermark is not None:
+            watermarks[table.name] = {'created_at': watermark[0].isoformat() if watermark[0] else None,
+                                      'id': watermark[1], 'exported_at': datetime.utcnow().isoformat()}
+            with open(watermarks_path + '.tmp', 'w') as f:
+                json.dump(watermarks, f, indent=2)
+            os.replace(watermarks_path + '.tmp', watermarks_path)
+    db.session.rollback()
+    return counts
+
+@app.cli.command('export-snapshot')
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--full', is_flag=True, help='Ignore the saved watermarks and rewrite every table.')
+@click.option('--batch-size', default=50000, show_default=True, help='Rows per record batch.')
+@click.option('--format', 'file_format', type=click.Choice(['parquet', 'arrow']), default='parquet', show_default=True)
+@branch_option
+def export_snapshot_command(output_dir, full, batch_size, file_format, branch):
+    """Write an incremental columnar snapshot of all tables for offline analytics."""
+    use_branch(branch)
+    try:
+        counts = export_snapshot(output_dir, full=full, batch_size=batch_size, file_format=file_format)
+    except ImportError:
+        raise click.ClickException('pyarrow is required for snapshot exports.')
+    for table_name, exported in counts.items():
+        print(f'{table_name}: {exported} rows')
+
+# Batch printing
+# kind -> (model, party model, party foreign key, date column, title)
+PRINT_DOCUMENTS = {
+    'sales_invoice': (SalesInvoice, Customer, 'customer_id', 'invoice_date', 'فاتورة مبيعات'),
+    'purchase_invoice': (PurchaseInvoice, Supplier, 'supplier_id', 'invoice_date', 'فاتورة مشتريات'),
+    'collection': (Collection, Customer, 'customer_id', 'collection_date', 'إيصال تحصيل'),
+    'payment': (Payment, Supplier, 'supplier_id', 'payment_date', 'إيصال دفع'),
+}
+# kind -> (date label, amount label), as on the print templates
+PRINT_LABELS = {
+    'sales_invoice': ('تاريخ الفاتورة', 'إجمالي المبلغ'),
+    'purchase_invoice': ('تاريخ الفاتورة', 'إجمالي المبلغ'),
+    'collection': ('تاريخ التحصيل', 'المبلغ المحصل'),
+    'payment': ('تاريخ الدفع', 'المبلغ المدفوع'),
+}
+COMPANY_NAME = 'نظام إدارة العملاء والموردين'
+# Bumped when the PDF layout changes, so cached PDFs of unchanged documents are redrawn
+PDF_LAYOUT_VERSION = 2
+# Arabic-capable fonts used for PDFs unless PDF_FONT_PATH / PDF_BOLD_FONT_PATH name other TTFs
+PDF_FONT_DIR = os.path.join(app.static_folder, ASSET_DIR, 'dejavu')
+
+BATCH_PRINT_CHUNK_SIZE = 50
+_print_pool = None
+
+def get_print_pool():
+    """Process pool shared by batch print requests, created on first use."""
+    global _print_pool
+    if _print_pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+        _print_pool = ProcessPoolExecutor(max_workers=int(os.environ.get('BATCH_PRINT_WORKERS', os.cpu_count() or 2)))
+    return _print_pool
+
+def register_pdf_font():
+    """Register the document fonts with reportlab and return their (regular, bold) names."""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    if 'DocumentFont' not in pdfmetrics.getRegisteredFontNames():
+        regular = os.environ.get('PDF_FONT_PATH') or os.path.join(PDF_FONT_DIR, 'DejaVuSans.ttf')
+        bold = os.environ.get('PDF_BOLD_FONT_PATH') or (
+            regular if os.environ.get('PDF_FONT_PATH') else os.path.join(PDF_FONT_DIR, 'DejaVuSans-Bold.ttf'))
+        pdfmetrics.registerFont(TTFont('DocumentFont', regular))
+        pdfmetrics.registerFont(TTFont('DocumentFont-Bold', bold))
+    return 'DocumentFont', 'DocumentFont-Bold'
+
+def pdf_text(value):
+    """Arabic text shaped and in visual order; reportlab draws the characters it is given left to right."""
+    import arabic_reshaper
+    from bidi.algorithm import get_display
+    return get_display(arabic_reshaper.reshape(str(value)))
+
+def fit_pdf_text(value, font_name, size, width):
+    """pdf_text of value, shortened with an ellipsis until it fits width points."""
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+
+    value = str(value)
+    text = pdf_text(value)
+    while value and stringWidth(text, font_name, size) > width:
+        value = value[:-1]
+        text = pdf_text(value.rstrip() + '…')
+    return text
+
+def wrap_pdf_text(value, font_name, size, width):
+    """Split value into lines of at most width points, each shaped with pdf_text."""
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+
+    lines, line = [], ''
+    for word in str(value).split():
+        candidate = f'{line} {word}'.strip()
+        if line and stringWidth(pdf_text(candidate), font_name, size) > width:
+            lines.append(pdf_text(line))
+            candidate = word
+        line = candidate
+    if line:
+        lines.append(pdf_text(line))
+    return lines
+
+def draw_pdf_row(pdf, right, y, cells, widths, font_name, size=10, height=22, shaded=()):
+    """Draw one bordered table row right to left: cells[0] is the rightmost cell.
+
+    Cell indexes in shaded get the grey header background of the print templates.
+    Returns the y below the row.
+    """
+    x = right
+    for index, (value, width) in enumerate(zip(cells, widths)):
+        x -= width
+        if index in shaded:
+            pdf.setFillColorRGB(0.97, 0.98, 0.98)
+            pdf.rect(x, y - height, width, height, stroke=0, fill=1)
+        pdf.setFillColorRGB(0, 0, 0)
+        pdf.setStrokeColorRGB(0.87, 0.87, 0.87)
+        pdf.rect(x, y - height, width, height, stroke=1, fill=0)
+        pdf.setFont(font_name, size)
+        pdf.drawRightString(x + width - 6, y - height + 7, fit_pdf_text(value, font_name, size, width - 12))
+    return y - height
+
+def draw_pdf_header(pdf, fonts, title):
+    """Company name and document title over a rule, like the print templates. Returns the next y."""
+    width, height = pdf._pagesize
+    regular, bold = fonts
+    pdf.setFillColorRGB(0.2, 0.2, 0.2)
+    pdf.setFont(bold, 20)
+    pdf.drawCentredString(width / 2, height - 60, pdf_text(COMPANY_NAME))
+    pdf.setFillColorRGB(0.4, 0.4, 0.4)
+    pdf.setFont(regular, 16)
+    pdf.drawCentredString(width / 2, height - 85, pdf_text(title))
+    pdf.setLineWidth(2)
+    pdf.setStrokeColorRGB(0.2, 0.2, 0.2)
+    pdf.line(40, height - 100, width - 40, height - 100)
+    pdf.setLineWidth(1)
+    return height - 125
+
+def draw_pdf_footer(pdf, fonts, lines):
+    width, _ = pdf._pagesize
+    pdf.setStrokeColorRGB(0.87, 0.87, 0.87)
+    pdf.line(40, 80, width - 40, 80)
+    pdf.setFillColorRGB(0.4, 0.4, 0.4)
+    pdf.setFont(fonts[0], 9)
+    for offset, line in enumerate(lines):
+        pdf.drawCentredString(width / 2, 62 - offset * 14, pdf_text(line))
+    pdf.setFillColorRGB(0, 0, 0)
+
+def render_pdf_chunk(documents):
+    """Render plain document dicts to one single-page PDF each, laid out like the print
+    templates. Runs inside the print pool."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    from io import BytesIO
+
+    fonts = register_pdf_font()
+    regular, bold = fonts
+    results = []
+    width, height = A4
+    half = (width - 80 - 20) / 2
+    for document in documents:
+        buffer = BytesIO()
+        pdf = canvas.Canvas(buffer, pagesize=A4)
+        top = draw_pdf_header(pdf, fonts, document['title'])
+        # Document details on the right, party details on the left (the templates are right-to-left)
+        y_info = top
+        for label, value in document['info']:
+            y_info = draw_pdf_row(pdf, width - 40, y_info, (label, value), (half * 0.45, half * 0.55), regular,
+                                  shaded=(0,))
+        y_party = top
+        for label, value in document['party']:
+            y_party = draw_pdf_row(pdf, 40 + half, y_party, (label, value), (half * 0.45, half * 0.55), regular,
+                                   shaded=(0,))
+        y = min(y_info, y_party) - 30
+
+        pdf.setFillColorRGB(0.97, 0.98, 0.98)
+        pdf.setStrokeColorRGB(0.2, 0.2, 0.2)
+        pdf.rect(40, y - 70, width - 80, 70, stroke=1, fill=1)
+        pdf.setFillColorRGB(0, 0, 0)
+        pdf.setFont(regular, 13)
+        pdf.drawCentredString(width / 2, y - 25, pdf_text(document['amount_label']))
+        pdf.setFillColorRGB(0.16, 0.65, 0.27)
+        pdf.setFont(bold, 22)
+        pdf.drawCentredString(width / 2, y - 55, pdf_text(f"{document['amount']:,.2f} جنيه مصري"))
+        pdf.setFillColorRGB(0, 0, 0)
+        y -= 100
+
+        if document['text']:
+            pdf.setFont(bold, 11)
+            pdf.drawRightString(width - 40, y, pdf_text(document['text_label']))
+            pdf.setFont(regular, 10)
+            for line in wrap_pdf_text(document['text'], regular, 10, width - 80)[:12]:
+                y -= 16
+                pdf.drawRightString(width - 40, y, line)
+
+        draw_pdf_footer(pdf, fonts, [document['footer']])
+        pdf.showPage()
+        pdf.save()
+        results.append((document['id'], buffer.getvalue()))
+    return results
+
+def printable_document(kind, document, party):
+    """Flatten a document and its party into a picklable dict for the print pool."""
+    _, party_model, _, date_column, title = PRINT_DOCUMENTS[kind]
+    date_label, amount_label = PRINT_LABELS[kind]
+    party_word = 'العميل' if party_model is Customer else 'المورد'
+    invoice = hasattr(document, 'invoice_number')
+    return {
+        'id': document.id,
+        'title': title,
+        'info': [('رقم الفاتورة', document.invoice_number) if invoice else ('رقم الإيصال', document.id),
+                 (date_label, getattr(document, date_column).strftime('%Y-%m-%d'))],
+        'party': [(f'اسم {party_word}', party.name), (f'هاتف {party_word}', party.phone or '-'),
+                  (f'بريد {party_word}', party.email or '-')],
+        'amount_label': amount_label,
+        'amount': document.amount,
+        'text_label': 'وصف الفاتورة:' if invoice else 'ملاحظات:',
+        'text': document.description if invoice else document.notes,
+        'footer': f"تم إنشاء {'هذه الفاتورة' if invoice else 'هذا الإيصال'} بواسطة {COMPANY_NAME}",
+    }
+
+@app.route('/batch_print', methods=['GET', 'POST'])
+@login_required
+def batch_print():
+    if request.method == 'POST':
+        try:
+            from pypdf import PdfWriter
+            from io import BytesIO
+            import tempfile
+
+            kind = request.form['doc_type']
+            model, party_model, party_key, date_column, _ = PRINT_DOCUMENTS[kind]
+            query = db.session.query(model, party_model).join(party_model, getattr(model, party_key) == party_model.id)
+            if request.form.get('date_from'):
+                query = query.filter(getattr(model, date_column) >= datetime.strptime(request.form['date_from'], '%Y-%m-%d').date())
+            if request.form.get('date_to'):
+                query = query.filter(getattr(model, date_column) <= datetime.strptime(request.form['date_to'], '%Y-%m-%d').date())
+            party_id = request.form.get('customer_id' if party_model is Customer else 'supplier_id')
+            if party_id:
+                query = query.filter(party_model.id == int(party_id))
+            max_documents = int(os.environ.get('BATCH_PRINT_MAX', 5000))
+            rows = query.order_by(getattr(model, date_column), model.id).limit(max_documents + 1).all()
+
+            if not rows:
+                flash('لا توجد مستندات مطابقة للطباعة', 'error')
+                return redirect(url_for('batch_print'))
+            if len(rows) > max_documents:
+                flash(f'عدد المستندات يتجاوز الحد الأقصى ({max_documents}). يرجى تضييق نطاق البحث', 'error')
+                return redirect(url_for('batch_print'))
+
+            # Serve what we can from the render cache, render the rest in parallel
+            pages = {}
+            versions = {}
+            missing = []
+            for document, party in rows:
+                versions[document.id] = (party.id, f'{document_version(document, party)}p{PDF_LAYOUT_VERSION}')
+                pdf = render_cache.get(kind, document.id, party.id, versions[document.id][1], fmt='pdf')
+                if pdf is None:
+                    missing.append(printable_document(kind, document, party))
+                else:
+                    pages[document.id] = pdf
+
+            chunks = [missing[i:i + BATCH_PRINT_CHUNK_SIZE] for i in range(0, len(missing), BATCH_PRINT_CHUNK_SIZE)]
+            if len(chunks) > 1:
+                rendered = get_print_pool().map(render_pdf_chunk, chunks)
+            else:
+                rendered = map(render_pdf_chunk, chunks)
+            for chunk in rendered:
+                for document_id, pdf in chunk:
+                    party_id, version = versions[document_id]
+                    render_cache.put(kind, document_id, party_id, version, pdf, fmt='pdf')
+                    pages[document_id] = pdf
+
+            writer = PdfWriter()
+            for document, _ in rows:
+                writer.append(BytesIO(pages[document.id]))
+            output = tempfile.TemporaryFile()
+            writer.write(output)
+            output.seek(0)
+
+            return send_file(
+                output,
+                mimetype='application/pdf',
+                as_attachment=True,
+                download_name=f'{kind}_{datetime.now().strftime("%Y%m%d")}.pdf'
+            )
+        except ImportError:
+            flash('مكتبات pypdf أو reportlab أو arabic-reshaper أو python-bidi غير مثبتة. يرجى تثبيتها لاستخدام الطباعة المجمعة', 'error')
+            return redirect(url_for('batch_print'))
+        except Exception as e:
+            flash(f'حدث خطأ في الطباعة المجمعة: {str(e)}', 'error')
+            return redirect(url_for('batch_print'))
+
+    customers = Customer.query.options(*load_profile('customer_options')).all()
+    suppliers = Supplier.query.options(*load_profile('supplier_options')).all()
+    return render_template('batch_print.html', customers=customers, suppliers=suppliers)
+
+# Statement generation
+# Month-end statements for every party, rendered by a process pool. Each worker loads a
+# whole party-id range with two queries, and finished ranges are recorded in the outbox so
+# an interrupted run resumes where it stopped.
+STATEMENT_PROGRESS = '_progress.json'
+# (party, date) indexes on the live document tables, for statements and the per-range ledger query
+STATEMENT_INDEXES = [db.Index(f'ix_{model.__tablename__}_{party_type}_id_{date_column}',
+                              getattr(model, f'{party_type}_id'), getattr(model, date_column))
+                     for party_type, ledger in LEDGERS.items()
+                     for model, date_column in (ledger[1:3], ledger[3:5])]
+
+def statement_ranges(party_type, range_size):
+    """Split the party ids into [first id, last id] ranges of range_size parties each."""
+    party_model = LEDGERS[party_type][0]
+    ids = db.session.scalars(select(party_model.id).order_by(party_model.id)).all()
+    return [[ids[i], ids[min(i + range_size, len(ids)) - 1]] for i in range(0, len(ids), range_size)]
+
+def load_statement_range(party_type, first_id, last_id, as_of, bind_arguments=None):
+    """Statements of every party with an id in [first_id, last_id], from one party query and one ledger query.
+
+    Like the statement pages, each starts from the current opening balance and lists the
+    live documents, here only those dated up to as_of.
+    """
+    party_model, debit_model, debit_date, credit_model, credit_date = LEDGERS[party_type]
+    party_key = f'{party_type}_id'
+    opening = OpeningBalance.__table__
+    parties = db.session.execute(
+        select(party_model.id, party_model.name, party_model.phone, party_model.email,
+               opening.c.year, opening.c.balance.label('opening_balance'),
+               opening.c.total_debit.label('opening_debit'), opening.c.total_credit.label('opening_credit'))
+        .outerjoin(opening, and_(opening.c.party_type == party_type, opening.c.party_id == party_model.id,
+                                 opening.c.year == current_opening_year(party_type, party_model.id)))
+        .where(party_model.id.between(first_id, last_id))
+        .order_by(party_model.id), bind_arguments=bind_arguments).all()
+
+    parts = []
+    for position, (kind, model, date_column) in enumerate((('debit', debit_model, debit_date),
+                                                           ('credit', credit_model, credit_date))):
+        table = model.__table__
+        number = table.c.invoice_number if 'invoice_number' in table.c else literal(None, db.String)
+        text = table.c.description if 'description' in table.c else table.c.notes
+        parts.append(select(table.c[party_key].label('party_id'), table.c[date_column].label('date'),
+                            literal(position).label('position'), table.c.id, literal(kind).label('kind'),
+                            number.label('number'), text.label('text'), table.c.amount)
+                     .where(table.c[party_key].between(first_id, last_id), table.c[date_column] <= as_of))
+    # Same order as the statement pages: by date, invoices before receipts on the same day
+    ledger = union_all(*parts).subquery()
+    entries = defaultdict(list)
+    for row in db.session.execute(select(ledger).order_by(ledger.c.party_id, ledger.c.date, ledger.c.position,
+                                                          ledger.c.id), bind_arguments=bind_arguments):
+        entries[row.party_id].append(row)
+
+    statements = []
+    for party in parties:
+        opening_row = None
+        balance = total_debit = total_credit = 0.0
+        if party.year is not None:
+            opening_row = {'year': party.year, 'balance': party.opening_balance,
+                           'total_debit': party.opening_debit, 'total_credit': party.opening_credit}
+            balance, total_debit, total_credit = party.opening_balance, party.opening_debit, party.opening_credit
+        transactions = []
+        for entry in entries[party.id]:
+            debit = entry.amount if entry.kind == 'debit' else 0.0
+            credit = entry.amount if entry.kind == 'credit' else 0.0
+            balance += debit - credit
+            total_debit += debit
+            total_credit += credit
+            transactions.append({'date': entry.date, 'kind': entry.kind, 'number': entry.number, 'text': entry.text,
+                                 'debit': debit, 'credit': credit, 'balance': balance})
+        statements.append({'id': party.id, 'name': party.name, 'phone': party.phone, 'email': party.email,
+                           'opening': opening_row, 'transactions': transactions, 'total_debit': total_debit,
+                           'total_credit': total_credit, 'closing_balance': balance})
+    return statements
+
+def render_statement_pdf(party_type, statement, as_of, fonts, generated_at):
+    """Multi-page A4 PDF of one statement, laid out like print_statement.html."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    from io import BytesIO
+
+    width, height = A4
+    regular, bold = fonts
+    customer = party_type == 'customer'
+    title = 'كشف حساب العميل' if customer else 'كشف حساب المورد'
+    debit_label, credit_label = ('فاتورة مبيعات', 'تحصيل') if customer else ('فاتورة مشتريات', 'دفع')
+    # Right to left: date, type, description, debit, credit, balance
+    headings = ('التاريخ', 'النوع', 'الوصف', 'مدين', 'دائن', 'الرصيد')
+    widths = (68, 78, 159, 70, 70, 70)
+    half = (width - 80 - 20) / 2
+    buffer = BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=A4)
+
+    top = draw_pdf_header(pdf, fonts, title)
+    y_party = top
+    for label, value in (('الاسم', statement['name']), ('الهاتف', statement['phone'] or '-'),
+                         ('البريد الإلكتروني', statement['email'] or '-')):
+        y_party = draw_pdf_row(pdf, width - 40, y_party, (label, value), (half * 0.45, half * 0.55), regular,
+                               shaded=(0,))
+    y_period = top
+    for label, value in (('كشف حتى تاريخ', as_of.strftime('%Y-%m-%d')),
+                         ('الرصيد الختامي', f"{statement['closing_balance']:,.2f} ج.م")):
+        y_period = draw_pdf_row(pdf, 40 + half, y_period, (label, value), (half * 0.45, half * 0.55), regular,
+                                shaded=(0,))
+    y = min(y_party, y_period) - 25
+
+    def amount(value):
+        return f'{value:,.2f}' if value else ''
+
+    rows = []
+    if statement['opening']:
+        opening_row = statement['opening']
+        rows.append(((f"{opening_row['year']}-01-01", 'رصيد افتتاحي', 'رصيد مرحل من السنوات المالية المغلقة',
+                      f"{opening_row['total_debit']:,.2f}", f"{opening_row['total_credit']:,.2f}",
+                      f"{opening_row['balance']:,.2f}"), True))
+    for entry in statement['transactions']:
+        description = f"فاتورة رقم: {entry['number']}" if entry['number'] else ''
+        if entry['text']:
+            description = f"{description} - {entry['text']}" if description else entry['text']
+        rows.append(((entry['date'].strftime('%Y-%m-%d'), debit_label if entry['kind'] == 'debit' else credit_label,
+                      description, amount(entry['debit']), amount(entry['credit']), f"{entry['balance']:,.2f}"), False))
+    if not rows:
+        rows.append((('', '', 'لا توجد معاملات', '', '', ''), False))
+    rows.append((('', '', 'الإجمالي', f"{statement['total_debit']:,.2f}", f"{statement['total_credit']:,.2f}",
+                  f"{statement['closing_balance']:,.2f}"), True))
+
+    y = draw_pdf_row(pdf, width - 40, y, headings, widths, bold, size=9, shaded=range(6))
+    for cells, shaded in rows:
+        if y < 110:
+            draw_pdf_footer(pdf, fonts, [f'تم إنشاء هذا الكشف بواسطة {COMPANY_NAME}'])
+            pdf.showPage()
+            y = draw_pdf_row(pdf, width - 40, height - 50, headings, widths, bold, size=9, shaded=range(6))
+        y = draw_pdf_row(pdf, width - 40, y, cells, widths, bold if shaded else regular, size=8, height=18,
+                         shaded=range(6) if shaded else ())
+    draw_pdf_footer(pdf, fonts, [f'تم إنشاء هذا الكشف بواسطة {COMPANY_NAME}',
+                                 # LRE ... PDF keeps the timestamp left to right inside the Arabic line
+                                 f"تاريخ الإنشاء: \u202a{generated_at.strftime('%Y-%m-%d %H:%M')}\u202c"])
+    pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+def init_statement_worker():
+    """Forked workers must open their own connections instead of sharing the parent's pool."""
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+def generate_statement_range(party_type, first_id, last_id, output_dir, file_format, as_of, branch=None):
+    """Load, render and write the statements of one party-id range. Runs inside the statement pool."""
+    directory = os.path.join(output_dir, f'{party_type}s')
+    os.makedirs(directory, exist_ok=True)
+    fonts = register_pdf_font() if file_format == 'pdf' else None
+    generated_at = datetime.now()
+    with app.app_context():
+        use_branch(branch)
+        # Read from a replica when one is configured, keeping the job off the primary
+        bind_arguments = {'bind': db.engines[REPLICA_BINDS[0]]} if REPLICA_BINDS and branch is None else None
+        statements = load_statement_range(party_type, first_id, last_id, as_of, bind_arguments)
+        for statement in statements:
+            if file_format == 'pdf':
+                content = render_statement_pdf(party_type, statement, as_of, fonts, generated_at)
+            else:
+                content = render_template('print_statement.html', party_type=party_type, statement=statement,
+                                          as_of=as_of, generated_at=generated_at).encode('utf-8')
+            path = os.path.join(directory, f"{party_type}_{statement['id']}.{file_format}")
+            with open(path + '.tmp', 'wb') as f:
+                f.write(content)
+            os.replace(path + '.tmp', path)
+    return len(statements)
+
+def save_statement_progress(path, progress):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(progress, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+def generate_statements(output_dir, party_types=('customer', 'supplier'), file_format='html', as_of=None,
+                        range_size=500, workers=None, zip_path=None, restart=False):
+    """Write a statement file per party into output_dir/<party type>s/, resuming an interrupted run.
+
+    The party-id ranges are planned once and stored in the progress file together with the
+    run's options; a later call with the same options only renders the ranges not yet done.
+    Returns (statements written by this call, total ranges, ranges done before this call).
+    """
+    as_of = as_of or date.today()
+    branch = g.get('branch')
+    options = {'party_types': list(party_types), 'format': file_format, 'as_of': as_of.isoformat()}
+    if branch:
+        options['branch'] = branch
+    os.makedirs(output_dir, exist_ok=True)
+    progress_path = os.path.join(output_dir, STATEMENT_PROGRESS)
+    progress = None
+    if os.path.exists(progress_path) and not restart:
+        with open(progress_path) as f:
+            progress = json.load(f)
+        if progress['options'] != options:
+            raise ValueError(f"{output_dir} holds a run started with {progress['options']}; "
+                             'use another directory or restart it')
+    if progress is None:
+        ranges = [[party_type] + party_range for party_type in party_types
+                  for party_range in statement_ranges(party_type, range_size)]
+        progress = {'options': options, 'ranges': ranges, 'done': [], 'started_at': datetime.utcnow().isoformat()}
+        save_statement_progress(progress_path, progress)
+    db.session.rollback()
+
+    done = set(progress['done'])
+    pending = [index for index in range(len(progress['ranges'])) if index not in done]
+    written = 0
+    workers = workers or os.cpu_count() or 2
+    if pending:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending)), initializer=init_statement_worker) as pool:
+            futures = {pool.submit(generate_statement_range, *progress['ranges'][index], output_dir, file_format,
+                                   as_of, branch): index for index in pending}
+            for future in as_completed(futures):
+                written += future.result()
+                progress['done'].append(futures[future])
+                save_statement_progress(progress_path, progress)
+
+    if zip_path:
+        import zipfile
+        # PDFs are already compressed, HTML shrinks well
+        compression = zipfile.ZIP_STORED if file_format == 'pdf' else zipfile.ZIP_DEFLATED
+        with zipfile.ZipFile(zip_path + '.tmp', 'w', compression) as archive:
+            for party_type in party_types:
+                for path in sorted(glob.glob(os.path.join(output_dir, f'{party_type}s', f'*.{file_format}'))):
+                    archive.write(path, os.path.relpath(path, output_dir))
+        os.replace(zip_path + '.tmp', zip_path)
+    return written, len(progress['ranges']), len(done)
+
+@app.cli.command('generate-statements')
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--party', type=click.Choice(['customer', 'supplier', 'all']), default='all', show_default=True)
+@click.option('--format', 'file_format', type=click.Choice(['html', 'pdf']), default='html', show_default=True)
+@click.option('--as-of', type=click.DateTime(formats=['%Y-%m-%d']), help='Last document date included [default: today].')
+@click.option('--range-size', default=500, show_default=True, help='Parties loaded per query and per pool task.')
+@click.option('--workers', type=int, help='Worker processes [default: CPU count].')
+@click.option('--zip', 'zip_path', type=click.Path(dir_okay=False), help='Also pack the statements into this zip file.')
+@click.option('--restart', is_flag=True, help='Discard the saved progress and render every statement again.')
+@branch_option
+def generate_statements_command(output_dir, party, file_format, as_of, range_size, workers, zip_path, restart,
+                                branch):
+    """Render a statement for every customer and supplier into an outbox directory."""
+    use_branch(branch)
+    party_types = ('customer', 'supplier') if party == 'all' else (party,)
+    started = time.perf_counter()
+    try:
+        written, total, previously_done = generate_statements(
+            output_dir, party_types, file_format, as_of.date() if as_of else None, range_size, workers, zip_path,
+            restart)
+    except ImportError:
+        raise click.ClickException('reportlab, arabic-reshaper and python-bidi are required for PDF statements.')
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if previously_done:
+        print(f'Resumed: {previously_done} of {total} ranges were already done.')
+    print(f'{written} statements written in {time.perf_counter() - started:.1f}s.')
+    if zip_path:
+        print(f'Statements packed into {zip_path}.')
+
+# JSON API (v1)
+# resource -> (model, party model, party foreign key, balance sign)
+API_RESOURCES = {
+    'customers': (Customer, None, None, 0),
+    'suppliers': (Supplier, None, None, 0),
+    'sales_invoices': (SalesInvoice, Customer, 'customer_id', 1),
+    'purchase_invoices': (PurchaseInvoice, Supplier, 'supplier_id', 1),
+    'collections': (Collection, Customer, 'customer_id', -1),
+    'payments': (Payment, Supplier, 'supplier_id', -1),
+}
+# Columns maintained by the server
+API_READ_ONLY_COLUMNS = ('id', 'balance', 'created_at', 'created_by')
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+API_BULK_MAX = int(os.environ.get('API_BULK_MAX', 5000))
+API_BULK_DELETE_MAX = int(os.environ.get('API_BULK_DELETE_MAX', 50000))
+# Ids per IN (...) list, below every backend's bound parameter limit
+DELETE_CHUNK_SIZE = 900
+
+class ApiError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+@app.errorhandler(ApiError)
+def handle_api_error(error):
+    db.session.rollback()
+    return jsonify({'error': error.message}), error.status_code
+
+def api_login_required(view):
+    """Like login_required, but answers 401 JSON instead of redirecting to the login page."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return jsonify({'error': 'authentication required'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def get_api_resource(resource):
+    if resource not in API_RESOURCES:
+        raise ApiError(f'unknown resource: {resource}', 404)
+    return API_RESOURCES[resource]
+
+def serialize_value(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+def parse_api_item(model, item):
+    """Validate one JSON object against the model columns and convert it to column values."""
+    if not isinstance(item, dict):
+        raise ApiError('each item must be a JSON object')
+    values = {}
+    for column in model.__table__.columns:
+        if column.key in API_READ_ONLY_COLUMNS:
+            continue
+        raw = item.get(column.key)
+        if raw is None or raw == '':
+            if not column.nullable and column.default is None:
+                raise ApiError(f'{column.key} is required')
+            continue
+        try:
+            python_type = column.type.python_type
+            if python_type is date:
+                values[column.key] = datetime.strptime(raw, '%Y-%m-%d').date()
+            elif python_type in (int, float):
+                values[column.key] = python_type(raw)
+            else:
+                values[column.key] = str(raw)
+        except (TypeError, ValueError):
+            raise ApiError(f'invalid value for {column.key}: {raw!r}')
+    return values
+
+def create_api_records(resource, items):
+    """Insert items with one multi-row INSERT and one balance UPDATE per affected party.
+
+    Runs inside the caller's transaction; nothing is committed here.
+    """
+    model, party_model, party_key, sign = get_api_resource(resource)
+    # Number invoices that came without one from the series, in one counter update
+    if model.__tablename__ in SEQUENCE_PREFIXES:
+        unnumbered = defaultdict(list)
+        for item in items:
+            if isinstance(item, dict) and not item.get('invoice_number'):
+                try:
+                    year = datetime.strptime(item.get('invoice_date') or '', '%Y-%m-%d').year
+                except (TypeError, ValueError):
+                    year = date.today().year
+                unnumbered[year].append(item)
+        for year, year_items in unnumbered.items():
+            numbers = allocate_document_numbers(model.__tablename__, len(year_items), year=year)
+            for item, number in zip(year_items, numbers):
+                item['invoice_number'] = number
+
+    rows = []
+    for index, item in enumerate(items):
+        try:
+            row = parse_api_item(model, item)
+        except ApiError as e:
+            raise ApiError(f'item {index}: {e.message}', e.status_code)
+        if 'created_by' in model.__table__.columns:
+            row['created_by'] = current_user.id
+        rows.append(row)
+
+    if party_model is not None:
+        deltas = defaultdict(float)
+        for row in rows:
+            deltas[row[party_key]] += sign * row['amount']
+        # Each party's limit check and increment are one conditional UPDATE, as in charge_customer,
+        # so concurrent postings can never pass a credit limit together
+        party_table = party_model.__table__
+        balances = {}
+        refused = []
+        for party_id, delta in sorted(deltas.items()):
+            condition = party_table.c.id == party_id
+            if 'credit_limit' in party_table.c and delta > 0:
+                condition = and_(condition, or_(party_table.c.credit_limit.is_(None),
+                                                party_table.c.balance + delta <= party_table.c.credit_limit))
+            new_balance = db.session.execute(
+                party_table.update().where(condition).values(balance=party_table.c.balance + delta)
+                .returning(party_table.c.balance)).first()
+            if new_balance is None:
+                refused.append(party_id)
+            else:
+                balances[party_id] = new_balance[0]
+        if refused:
+            existing = set(db.session.scalars(select(party_model.id).where(party_model.id.in_(refused))))
+            if set(refused) - existing:
+                raise ApiError(f'unknown {party_key}: {sorted(set(refused) - existing)}', 422)
+            raise ApiError(f'credit limit exceeded for {party_key}: {refused}', 422)
+
+    try:
+        ids = list(db.session.scalars(insert(model).returning(model.id, sort_by_parameter_order=True), rows))
+    except IntegrityError as e:
+        raise ApiError(f'constraint violation: {e.orig}', 409)
+
+    touched = {model.__tablename__}
+    if party_model is None:
+        events = [{'entity': model.__tablename__, 'entity_id': id, 'action': 'create',
+                   'party_type': model.__tablename__, 'party_id': id, 'new_amount': 0.0} for id in ids]
+    else:
+        party_type = party_model.__tablename__
+        events = [{'entity': model.__tablename__, 'entity_id': id, 'action': 'create',
+                   'party_type': party_type, 'party_id': row[party_key], 'new_amount': row['amount']}
+                  for id, row in zip(ids, rows)]
+        events += [{'entity': party_type, 'entity_id': party_id, 'action': 'update', 'party_type': party_type,
+                    'party_id': party_id, 'old_amount': balances[party_id] - delta, 'new_amount': balances[party_id]}
+                   for party_id, delta in deltas.items()]
+        touched.add(party_type)
+    touch_data_versions(db.session.connection(), touched)
+    record_change_events(db.session.connection(), events)
+    return ids
+
+def id_chunks(ids):
+    return [ids[start:start + DELETE_CHUNK_SIZE] for start in range(0, len(ids), DELETE_CHUNK_SIZE)]
+
+def bulk_delete_condition(model, party_key, filters):
+    """WHERE clause of a bulk delete filter.
+
+    Keys: created_from/created_to (ISO datetimes) and created_by on every resource,
+    party_id and date_from/date_to (document date) on documents.
+    """
+    if not isinstance(filters, dict) or not filters:
+        raise ApiError('filter must be a non-empty JSON object')
+    table = model.__table__
+    allowed = {'created_from', 'created_to'}
+    if 'created_by' in table.c:
+        allowed.add('created_by')
+    if party_key is not None:
+        allowed |= {'party_id', 'date_from', 'date_to'}
+    unknown = set(filters) - allowed
+    if unknown:
+        raise ApiError(f'unknown filter keys: {sorted(unknown)}')
+
+    conditions = []
+    try:
+        if 'party_id' in filters:
+            conditions.append(table.c[party_key] == int(filters['party_id']))
+        if 'created_by' in filters:
+            conditions.append(table.c.created_by == int(filters['created_by']))
+        if 'created_from' in filters:
+            conditions.append(table.c.created_at >= datetime.fromisoformat(filters['created_from']))
+        if 'created_to' in filters:
+            conditions.append(table.c.created_at <= datetime.fromisoformat(filters['created_to']))
+        if 'date_from' in filters or 'date_to' in filters:
+            date_column = table.c[PRINT_DOCUMENTS[table.name][3]]
+            if 'date_from' in filters:
+                conditions.append(date_column >= datetime.strptime(filters['date_from'], '%Y-%m-%d').date())
+            if 'date_to' in filters:
+                conditions.append(date_column <= datetime.strptime(filters['date_to'], '%Y-%m-%d').date())
+    except (TypeError, ValueError):
+        raise ApiError('invalid filter value')
+    return and_(*conditions)
+
+def delete_api_records(resource, ids=None, filters=None, cascade=False):
+    """Delete the records matching ids (or filters) with set-based DELETEs.
+
+    Deleted documents are reversed with one aggregated balance UPDATE per affected party.
+    Parties that have documents or an opening balance are only deleted with cascade,
+    which removes their live and archived documents and opening balances as well.
+    Runs inside the caller's transaction; nothing is committed here.
+    """
+    model, party_model, party_key, sign = get_api_resource(resource)
+    table = model.__table__
+    columns = [table.c.id, table.c[party_key], table.c.amount] if party_model is not None \
+        else [table.c.id, table.c.balance]
+    if ids is not None:
+        rows = []
+        for chunk in id_chunks(sorted(set(ids))):
+            rows += db.session.execute(select(*columns).where(table.c.id.in_(chunk)).with_for_update()).all()
+        if len(rows) < len(set(ids)):
+            raise ApiError(f'not found: {sorted(set(ids) - {row.id for row in rows})}', 404)
+    else:
+        rows = db.session.execute(select(*columns).where(bulk_delete_condition(model, party_key, filters))
+                                  .order_by(table.c.id).limit(API_BULK_DELETE_MAX + 1).with_for_update()).all()
+        if len(rows) > API_BULK_DELETE_MAX:
+            raise ApiError(f'more than {API_BULK_DELETE_MAX} records match; narrow the filter', 413)
+    record_ids = [row.id for row in rows]
+    chunks = id_chunks(record_ids)
+    # Core statements bypass the flush hooks, so queue the render cache evictions by hand
+    evictions = db.session.info.setdefault('render_evictions', set())
+    touched = {table.name}
+    events = []
+    result = {'count': len(rows), 'documents': 0, 'parties': 0}
+
+    if party_model is not None:
+        party_type = party_model.__tablename__
+        deltas = defaultdict(float)
+        for row in rows:
+            deltas[row[1]] -= sign * row.amount
+            events.append({'entity': table.name, 'entity_id': row.id, 'action': 'delete', 'party_type': party_type,
+                           'party_id': row[1], 'old_amount': row.amount})
+            evictions.add(('document', table.name, row.id))
+        # Locked until commit so the logged old/new balances are exact
+        party_table = party_model.__table__
+        balances = {}
+        for chunk in id_chunks(sorted(deltas)):
+            balances.update(db.session.execute(select(party_table.c.id, party_table.c.balance)
+                                               .where(party_table.c.id.in_(chunk)).with_for_update()).all())
+        for chunk in chunks:
+            db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+        if deltas:
+            db.session.execute(
+                party_table.update()
+                .where(party_table.c.id == bindparam('party_id'))
+                .values(balance=party_table.c.balance + bindparam('delta')),
+                [{'party_id': party_id, 'delta': delta} for party_id, delta in deltas.items()]
+            )
+        events += [{'entity': party_type, 'entity_id': party_id, 'action': 'update', 'party_type': party_type,
+                    'party_id': party_id, 'old_amount': balances.get(party_id) or 0.0,
+                    'new_amount': (balances.get(party_id) or 0.0) + delta}
+                   for party_id, delta in deltas.items()]
+        touched.add(party_type)
+        result['parties'] = len(deltas)
+    else:
+        party_type = table.name
+        party_key = f'{party_type}_id'
+        _, debit_model, _, credit_model, _ = LEDGERS[party_type]
+        documents = []
+        for document_model in (debit_model, credit_model):
+            document_table = document_model.__table__
+            for chunk in chunks:
+                documents += [(document_table.name,) + tuple(row) for row in db.session.execute(
+                    select(document_table.c.id, document_table.c[party_key], document_table.c.amount)
+                    .where(document_table.c[party_key].in_(chunk))).all()]
+        opening = OpeningBalance.__table__
+        archives = [ARCHIVE_TABLES[document_model.__tablename__] for document_model in (debit_model, credit_model)]
+
+        def history_conditions(chunk):
+            """(table, condition, bind arguments) of the history that is not logged per row."""
+            yield opening, and_(opening.c.party_type == party_type, opening.c.party_id.in_(chunk)), {}
+            for archive in archives:
+                yield archive, archive.c[party_key].in_(chunk), archive_bind_arguments()
+
+        if not cascade and (documents or any(
+                db.session.execute(select(literal(1)).select_from(history_table).where(condition).limit(1),
+                                   bind_arguments=bind_arguments).first()
+                for chunk in chunks for history_table, condition, bind_arguments in history_conditions(chunk))):
+            raise ApiError(f'{party_type} has documents or an opening balance; '
+                           'delete with cascade to remove its history too', 409)
+
+        for document_model in (debit_model, credit_model):
+            document_table = document_model.__table__
+            for chunk in chunks:
+                db.session.execute(document_table.delete().where(document_table.c[party_key].in_(chunk)))
+            touched.add(document_table.name)
+        for chunk in chunks:
+            for history_table, condition, bind_arguments in history_conditions(chunk):
+                db.session.execute(history_table.delete().where(condition), bind_arguments=bind_arguments)
+        for chunk in chunks:
+            db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+
+        events += [{'entity': document_table_name, 'entity_id': id, 'action': 'delete', 'party_type': party_type,
+                    'party_id': party_id, 'old_amount': amount}
+                   for document_table_name, id, party_id, amount in documents]
+        events += [{'entity': party_type, 'entity_id': row.id, 'action': 'delete', 'party_type': party_type,
+                    'party_id': row.id, 'old_amount': row.balance} for row in rows]
+        evictions.update(('document', document_table_name, id) for document_table_name, id, _, _ in documents)
+        evictions.update(('party', party_type, id) for id in record_ids)
+        result['documents'] = len(documents)
+
+    touch_data_versions(db.session.connection(), touched)
+    record_change_events(db.session.connection(), events)
+    return result
+
+def run_idempotent(handler):
+    """Run a write handler once per Idempotency-Key; replays return the stored response.
+
+    The stored response is committed in the same transaction as the write, so a
+    key is never recorded for a write that did not happen (or vice versa).
+    """
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        body, status_code = handler()
+        db.session.commit()
+        return jsonify(body), status_code
+
+    request_hash = hashlib.sha1(request.get_data()).hexdigest()
+    record = db.session.get(IdempotencyRecord, (key, current_user.id))
+    if record is not None and record.created_at < datetime.utcnow() - IDEMPOTENCY_TTL:
+        db.session.delete(record)
+        db.session.flush()
+        record = None
+    if record is not None:
+        if record.request_hash != request_hash:
+            raise ApiError('Idempotency-Key was already used for a different request', 422)
+        response = app.response_class(record.response_body, status=record.status_code, mimetype='application/json')
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    body, status_code = handler()
+    response_body = app.json.dumps(body)
+    purge_expired_idempotency_records()
+    db.session.add(IdempotencyRecord(key=key, user_id=current_user.id, request_hash=request_hash,
+                                     status_code=status_code, response_body=response_body))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        raise ApiError('a request with this Idempotency-Key is already being processed', 409)
+    return app.response_class(response_body, status=status_code, mimetype='application/json')
+
+@app.route('/api/v1/<resource>', methods=['GET'])
+@api_login_required
+def api_list(resource):
+    """Keyset-paginated listing: ?after=<cursor>&limit=<n>&fields=a,b&party_id=<id>."""
+    model, party_model, party_key, _ = get_api_resource(resource)
+    columns = model.__table__.columns
+    if request.args.get('fields'):
+        names = ['id'] + [name for name in request.args['fields'].split(',') if name != 'id']
+        unknown = [name for name in names if name not in columns]
+        if unknown:
+            raise ApiError(f'unknown fields: {unknown}')
+        columns = [columns[name] for name in names]
+    else:
+        columns = list(columns)
+
+    try:
+        limit = min(int(request.args.get('limit', API_PAGE_SIZE)), API_MAX_PAGE_SIZE)
+        after = int(request.args.get('after', 0))
+        party_id = int(request.args['party_id']) if request.args.get('party_id') else None
+    except ValueError:
+        raise ApiError('limit, after and party_id must be integers')
+
+    query = select(*columns).where(model.id > after).order_by(model.id).limit(limit)
+    if party_model is not None and party_id is not None:
+        query = query.where(getattr(model, party_key) == party_id)
+    rows = db.session.execute(query).all()
+    keys = [column.key for column in columns]
+    data = [{key: serialize_value(value) for key, value in zip(keys, row)} for row in rows]
+    next_cursor = str(rows[-1][0]) if len(rows) == limit else None
+    return jsonify({'data': data, 'next_cursor': next_cursor})
+
+@app.route('/api/v1/events', methods=['GET'])
+@api_login_required
+def api_events():
+    """Change feed: ?after=<cursor>&limit=<n>&entity=<table>.
+
+    next_cursor is always the position of the last event seen (or after, when nothing is
+    new); consumers store it and poll again with it. has_more means another page is ready.
+    """
+    try:
+        limit = min(int(request.args.get('limit', CHANGE_FEED_PAGE_SIZE)), CHANGE_FEED_MAX_PAGE_SIZE)
+        after = parse_change_feed_cursor(request.args.get('after', '0'))
+    except ValueError:
+        raise ApiError('limit must be an integer and after a cursor returned by this feed')
+
+    table = ChangeEvent.__table__
+    query = select(table).where(tuple_(table.c.txid, table.c.sequence) > tuple_(*after))\
+        .order_by(table.c.txid, table.c.sequence).limit(limit)
+    if db.session.get_bind(db.inspect(ChangeEvent)).dialect.name == 'postgresql':
+        # Every transaction below the watermark has finished, so nothing can appear behind the cursor
+        query = query.where(table.c.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()))
+    if request.args.get('entity'):
+        query = query.where(table.c.entity == request.args['entity'])
+    rows = db.session.execute(query).all()
+    data = [{key: serialize_value(value) for key, value in row._mapping.items()} for row in rows]
+    next_cursor = change_feed_cursor(rows[-1].txid, rows[-1].sequence) if rows else change_feed_cursor(*after)
+    return jsonify({'data': data, 'next_cursor': next_cursor, 'has_more': len(rows) == limit})
+
+@app.route('/api/v1/<resource>/<int:id>', methods=['GET'])
+@api_login_required
+def api_get(resource, id):
+    model = get_api_resource(resource)[0]
+    obj = db.session.get(model, id)
+    if obj is None:
+        raise ApiError('not found', 404)
+    return jsonify({column.key: serialize_value(getattr(obj, column.key)) for column in model.__table__.columns})
+
+@app.route('/api/v1/<resource>', methods=['POST'])
+@api_login_required
+def api_create(resource):
+    item = request.get_json(silent=True)
+    if not isinstance(item, dict):
+        raise ApiError('request body must be a JSON object')
+    return run_idempotent(lambda: ({'id': create_api_records(resource, [item])[0]}, 201))
+
+@app.route('/api/v1/<resource>/bulk', methods=['POST'])
+@api_login_required
+def api_bulk_create(resource):
+    """Create up to API_BULK_MAX records in one transaction; body is a list or {"items": [...]}."""
+    payload = request.get_json(silent=True)
+    items = payload.get('items') if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not items:
+        raise ApiError('request body must be a non-empty JSON array or {"items": [...]}')
+    if len(items) > API_BULK_MAX:
+        raise ApiError(f'at most {API_BULK_MAX} items per request', 413)
+
+    def handler():
+        ids = create_api_records(resource, items)
+        return {'count': len(ids), 'ids': ids}, 201
+    return run_idempotent(handler)
+
+@app.route('/api/v1/<resource>/bulk_delete', methods=['POST'])
+@api_login_required
+def api_bulk_delete(resource):
+    """Delete records in one transaction; body is {"ids": [...]} or {"filter": {...}}, plus "cascade" for parties."""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or ('ids' in payload) == ('filter' in payload):
+        raise ApiError('request body must be a JSON object with either "ids" or "filter"')
+    ids = payload.get('ids')
+    if ids is not None:
+        if not isinstance(ids, list) or not ids or not all(isinstance(id, int) for id in ids):
+            raise ApiError('ids must be a non-empty array of integers')
+        if len(ids) > API_BULK_DELETE_MAX:
+            raise ApiError(f'at most {API_BULK_DELETE_MAX} ids per request', 413)
+    cascade = payload.get('cascade') is True
+    return run_idempotent(lambda: (delete_api_records(resource, ids=ids, filters=payload.get('filter'),
+                                                      cascade=cascade), 200))
+
+# Bank statement matching
+# Bank CSV lines are matched against parties and their open invoices through dict indexes
+# built once per import, reviewed, then posted as collections (money in) and payments (money out).
+BANK_COLUMN_ALIASES = {
+    'date': ('date', 'transaction date', 'value date', 'booking date', 'التاريخ', 'تاريخ العملية'),
+    'amount': ('amount', 'المبلغ'),
+    'credit': ('credit', 'deposit', 'دائن', 'إيداع'),
+    'debit': ('debit', 'withdrawal', 'مدين', 'سحب'),
+    'reference': ('reference', 'description', 'details', 'narrative', 'memo', 'المرجع', 'البيان', 'الوصف'),
+    'phone': ('phone', 'mobile', 'الهاتف', 'الموبايل'),
+}
+BANK_DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%Y/%m/%d')
+# Largest gap in days between an invoice and a bank line matched on amount alone
+BANK_DATE_WINDOW_DAYS = int(os.environ.get('BANK_MATCH_DATE_WINDOW_DAYS', 30))
+BANK_IMPORT_MAX_LINES = int(os.environ.get('BANK_IMPORT_MAX_LINES', 20000))
+# Seconds a reviewed statement stays postable
+BANK_REVIEW_MAX_AGE = int(os.environ.get('BANK_REVIEW_MAX_AGE_SECONDS', 86400))
+# Posted receipts carry the bank reference in their notes, so re-imported lines are recognised
+BANK_NOTE_PREFIX = 'تحويل بنكي: '
+# line direction -> (party type, receipt resource, receipt model, receipt date column)
+BANK_DIRECTIONS = {
+    'credit': ('customer', 'collections', Collection, 'collection_date'),
+    'debit': ('supplier', 'payments', Payment, 'payment_date'),
+}
+BANK_CONFIDENCE = {'high': 3, 'medium': 2, 'low': 1}
+# Phone numbers are compared on their last digits, ignoring country and trunk prefixes
+PHONE_KEY_DIGITS = 9
+PHONE_PATTERN = re.compile(r'\+?\d[\d\s-]{7,}\d')
+
+def parse_bank_amount(value):
+    text = (value or '').strip().replace(',', '').replace(' ', '')
+    if not text:
+        return None
+    if text.startswith('(') and text.endswith(')'):
+        return -float(text[1:-1])
+    return float(text)
+
+def parse_bank_date(value):
+    for date_format in BANK_DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).date()
+        except ValueError:
+            continue
+    raise ValueError(f'unrecognised date {value!r}')
+
+def parse_bank_csv(text):
+    """Bank lines as dicts (line, date, amount, reference, phone); a positive amount is money received."""
+    import csv
+    from io import StringIO
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(StringIO(text), dialect)
+    header = [name.strip().lower() for name in next(reader, [])]
+    columns = {}
+    for key, aliases in BANK_COLUMN_ALIASES.items():
+        index = next((index for index, name in enumerate(header) if name in aliases), None)
+        if index is not None:
+            columns[key] = index
+    if 'date' not in columns or not {'amount', 'credit', 'debit'} & set(columns):
+        raise ValueError('a date column and an amount (or credit/debit) column are required')
+
+    lines = []
+    for number, row in enumerate(reader, start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        cells = {key: row[index].strip() if index < len(row) else '' for key, index in columns.items()}
+        try:
+            if 'amount' in cells:
+                amount = parse_bank_amount(cells['amount']) or 0.0
+            else:
+                amount = abs(parse_bank_amount(cells.get('credit')) or 0.0) - abs(parse_bank_amount(cells.get('debit')) or 0.0)
+            line_date = parse_bank_date(cells['date'])
+        except ValueError as e:
+            raise ValueError(f'line {number}: {e}')
+        if round(amount, 2) == 0:
+            continue
+        if len(lines) == BANK_IMPORT_MAX_LINES:
+            raise ValueError(f'more than {BANK_IMPORT_MAX_LINES} lines')
+        lines.append({'line': number, 'date': line_date, 'amount': round(amount, 2),
+                      'reference': cells.get('reference', ''), 'phone': cells.get('phone', '')})
+    return lines
+
+def reference_key(text):
+    """Invoice number comparison key: INV-2025-000012 and inv 2025 000012 both give INV2025000012."""
+    return ''.join(ch for ch in text.upper() if ch.isalnum())
+
+def reference_keys(text):
+    """Keys of every run of up to three consecutive words in a bank reference."""
+    words = [reference_key(word) for word in re.split(r'[\s,;:/#()]+', text or '')]
+    words = [word for word in words if word]
+    return {''.join(words[start:start + length]) for start in range(len(words)) for length in (1, 2, 3)}
+
+def phone_key(value):
+    digits = ''.join(str(unicodedata.decimal(ch)) for ch in value or '' if ch.isdecimal())
+    return digits[-PHONE_KEY_DIGITS:] if len(digits) >= PHONE_KEY_DIGITS else None
+
+def amount_matches(amount, invoice):
+    return abs(amount - invoice['amount']) < 0.005 or abs(amount - invoice['open_amount']) < 0.005
+
+def build_bank_indexes(party_type):
+    """Hash indexes over one party type: open invoices by number, amount and party; parties by phone and balance."""
+    party_model, debit_model, debit_date, _, _ = LEDGERS[party_type]
+    party_column = getattr(debit_model, f'{party_type}_id')
+    date_column = getattr(debit_model, debit_date)
+    parties = db.session.execute(select(party_model.id, party_model.name, party_model.phone, party_model.balance)).all()
+    invoices = db.session.execute(
+        select(debit_model.id, debit_model.invoice_number, party_column.label('party_id'), debit_model.amount,
+               date_column.label('date'))
+        .join(party_model, party_model.id == party_column).where(party_model.balance > 0)
+        .order_by(party_column, date_column.desc(), debit_model.id.desc())).all()
+
+    indexes = {'names': {}, 'by_number': defaultdict(list), 'by_amount': defaultdict(list),
+               'by_party': defaultdict(list), 'by_phone': defaultdict(list), 'by_balance': defaultdict(list)}
+    balances = {}
+    for party in parties:
+        indexes['names'][party.id] = party.name
+        key = phone_key(party.phone)
+        if key:
+            indexes['by_phone'][key].append(party.id)
+        if (party.balance or 0) > 0.005:
+            balances[party.id] = party.balance
+            indexes['by_balance'][round(party.balance, 2)].append(party.id)
+    # Receipts settle the oldest invoices first, so an outstanding balance is made of the newest invoices
+    for party_id, party_invoices in itertools.groupby(invoices, key=lambda row: row.party_id):
+        remaining = balances[party_id]
+        for invoice in party_invoices:
+            if remaining <= 0.005:
+                break
+            entry = {'number': invoice.invoice_number, 'party_id': party_id, 'date': invoice.date,
+                     'amount': invoice.amount, 'open_amount': round(min(invoice.amount, remaining), 2)}
+            remaining -= invoice.amount
+            indexes['by_number'][reference_key(invoice.invoice_number)].append(entry)
+            indexes['by_party'][party_id].append(entry)
+            for amount in {round(entry['amount'], 2), entry['open_amount']}:
+                indexes['by_amount'][amount].append(entry)
+    return indexes
+
+def recorded_bank_receipts(model, date_column, date_from, date_to):
+    """(date, amount, notes) of the receipts already posted from bank lines between two dates."""
+    column = getattr(model, date_column)
+    return {(row[0], round(row[1], 2), row[2]) for row in db.session.execute(
+        select(column, model.amount, model.notes)
+        .where(column.between(date_from, date_to), model.notes.startswith(BANK_NOTE_PREFIX)))}
+
+def bank_review_serializer():
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='bank-import')
+
+def match_bank_lines(lines):
+    """Add direction, note, ranked candidates, the preselected candidate and a duplicate flag to each line."""
+    window = timedelta(days=BANK_DATE_WINDOW_DAYS)
+    indexes = {}
+    recorded = {}
+    for direction, (party_type, _, model, date_column) in BANK_DIRECTIONS.items():
+        dates = [line['date'] for line in lines if (line['amount'] > 0) == (direction == 'credit')]
+        if dates:
+            indexes[direction] = build_bank_indexes(party_type)
+            recorded[direction] = recorded_bank_receipts(model, date_column, min(dates), max(dates))
+
+    for line in lines:
+        direction = 'credit' if line['amount'] > 0 else 'debit'
+        index = indexes[direction]
+        amount = abs(line['amount'])
+        candidates = {}
+
+        def propose(party_id, invoice, rule, confidence):
+            key = (party_id, invoice['number'] if invoice else None)
+            current = candidates.get(key)
+            if current is None or BANK_CONFIDENCE[confidence] > BANK_CONFIDENCE[current['confidence']]:
+                candidates[key] = {'party_id': party_id, 'party_name': index['names'][party_id],
+                                   'invoice': key[1], 'rule': rule, 'confidence': confidence}
+
+        for key in reference_keys(line['reference']):
+            for invoice in index['by_number'].get(key, ()):
+                propose(invoice['party_id'], invoice, 'reference', 'high' if amount_matches(amount, invoice) else 'medium')
+        phones = [line['phone']] + PHONE_PATTERN.findall(line['reference'])
+        for key in filter(None, map(phone_key, phones)):
+            for party_id in index['by_phone'].get(key, ()):
+                invoice = next((entry for entry in index['by_party'][party_id] if amount_matches(amount, entry)), None)
+                propose(party_id, invoice, 'phone', 'high' if invoice else 'medium')
+        for invoice in index['by_amount'].get(round(amount, 2), ()):
+            if abs(invoice['date'] - line['date']) <= window:
+                propose(invoice['party_id'], invoice, 'amount', 'low')
+        for party_id in index['by_balance'].get(round(amount, 2), ()):
+            propose(party_id, None, 'balance', 'low')
+
+        note = f"{BANK_NOTE_PREFIX}{line['reference'] or line['line']}"
+        duplicate = (line['date'], round(amount, 2), note) in recorded[direction]
+        line.update(direction=direction, note=note, candidates=list(candidates.values()), duplicate=duplicate)
+
+    claim_bank_invoices(lines)
+    for line in lines:
+        # One candidate per party: its best invoice, earlier rules first on ties
+        best = {}
+        for candidate in sorted(line['candidates'], key=lambda candidate: -BANK_CONFIDENCE[candidate['confidence']]):
+            best.setdefault(candidate['party_id'], candidate)
+        ranked = list(best.values())
+        # A lone low-confidence candidate is still a useful proposal; several at the top are ambiguous
+        top = [candidate for candidate in ranked if candidate['confidence'] == ranked[0]['confidence']]
+        selected = 0 if ranked and not line['duplicate'] and len(top) == 1 else None
+        line.update(candidates=ranked, selected=selected,
+                    confidence=ranked[selected]['confidence'] if selected is not None else None)
+    return lines
+
+def claim_bank_invoices(lines):
+    """Leave each invoice among the candidates of one line only: the line it matches with the highest
+    confidence, lines not yet posted before recorded ones and earlier lines on ties."""
+    owners = {}
+    for position, line in enumerate(lines):
+        for candidate in line['candidates']:
+            if candidate['invoice']:
+                key = (line['direction'], candidate['invoice'])
+                claim = (line['duplicate'], -BANK_CONFIDENCE[candidate['confidence']], position)
+                owners[key] = min(owners.get(key, claim), claim)
+    for position, line in enumerate(lines):
+        line['candidates'] = [candidate for candidate in line['candidates'] if not candidate['invoice']
+                              or owners[(line['direction'], candidate['invoice'])][2] == position]
+
+@app.route('/bank_import', methods=['GET', 'POST'])
+@login_required
+def bank_import():
+    if request.method == 'POST':
+        upload = request.files.get('statement')
+        if not upload or not upload.filename:
+            flash('يرجى اختيار ملف كشف الحساب البنكي', 'error')
+            return redirect(url_for('bank_import'))
+        raw = upload.read()
+        try:
+            try:
+                text = raw.decode('utf-8-sig')
+            except UnicodeDecodeError:
+                text = raw.decode('cp1256')
+            lines = parse_bank_csv(text)
+        except (UnicodeDecodeError, ValueError) as e:
+            flash(f'تعذر قراءة ملف كشف الحساب: {str(e)}', 'error')
+            return redirect(url_for('bank_import'))
+        if not lines:
+            flash('لا توجد حركات في ملف كشف الحساب', 'error')
+            return redirect(url_for('bank_import'))
+
+        started = time.perf_counter()
+        match_bank_lines(lines)
+        elapsed = time.perf_counter() - started
+        # Everything needed to post a line travels with the review form, signed for this user and
+        # form token so an edited form cannot post other amounts, dates or parties
+        form_token = issue_form_token()
+        payload = bank_review_serializer().dumps({'user': current_user.id, 'form_token': form_token, 'lines': [
+            [line['direction'], line['date'].isoformat(), abs(line['amount']), line['note'],
+             [[candidate['party_id'], candidate['invoice']] for candidate in line['candidates']]]
+            for line in lines]})
+        counts = {'lines': len(lines), 'selected': sum(line['selected'] is not None for line in lines),
+                  'duplicates': sum(line['duplicate'] for line in lines),
+                  'unmatched': sum(not line['candidates'] for line in lines)}
+        return render_template('bank_import.html', lines=lines, payload=payload, counts=counts,
+                               elapsed=elapsed, filename=upload.filename, form_token=form_token)
+
+    return render_template('bank_import.html', lines=None)
+
+@app.route('/post_bank_matches', methods=['POST'])
+@login_required
+def post_bank_matches():
+    form_token = request.form.get('form_token')
+    previous = replay_form_submission(form_token)
+    if previous:
+        flash('تم ترحيل هذه الحركات مسبقاً ولم يتم تكرارها', 'info')
+        return redirect(previous)
+    try:
+        review = bank_review_serializer().loads(request.form['lines'], max_age=BANK_REVIEW_MAX_AGE)
+    except (KeyError, BadSignature):
+        review = None
+    if not review or review['user'] != current_user.id or review['form_token'] != form_token:
+        flash('انتهت صلاحية مراجعة كشف الحساب أو تم تعديلها، يرجى رفع الملف مرة أخرى', 'error')
+        return redirect(url_for('bank_import'))
+    try:
+        payload = review['lines']
+        choices = json.loads(request.form.get('choices') or '{}')
+        items = defaultdict(list)
+        invoices = set()
+        for index, candidate in choices.items():
+            index, candidate = int(index), int(candidate)
+            if not 0 <= index < len(payload) or not 0 <= candidate < len(payload[index][4]):
+                raise ValueError(f'no candidate {candidate} on line {index}')
+            direction, line_date, amount, note, candidates = payload[index]
+            party_type, resource, _, date_column = BANK_DIRECTIONS[direction]
+            party_id, invoice = candidates[candidate]
+            # One invoice settles at most one bank line
+            if invoice and (direction, invoice) in invoices:
+                flash(f'الفاتورة {invoice} مختارة لأكثر من حركة بنكية، يرجى اختيارها لحركة واحدة فقط', 'error')
+                return redirect(url_for('bank_import'))
+            invoices.add((direction, invoice))
+            items[resource].append({f'{party_type}_id': party_id, 'amount': amount,
+                                    date_column: line_date, 'notes': note})
+        if not items:
+            flash('لم يتم اختيار أي حركة للترحيل', 'error')
+            return redirect(url_for('bank_import'))
+
+        # One multi-row insert and one balance update per party for each receipt type
+        for resource, resource_items in items.items():
+            create_api_records(resource, resource_items)
+        previous = commit_form_submission(form_token, url_for('collections'))
+        if previous:
+            flash('تم ترحيل هذه الحركات مسبقاً ولم يتم تكرارها', 'info')
+            return redirect(previous)
+        flash(f"تم ترحيل {len(items['collections'])} تحصيل و {len(items['payments'])} دفعة من كشف الحساب البنكي", 'success')
+        return redirect(url_for('collections'))
+    except (KeyError, IndexError, TypeError, ValueError, ApiError) as e:
+        db.session.rollback()
+        flash(f'حدث خطأ في ترحيل الحركات: {str(e)}', 'error')
+        return redirect(url_for('bank_import'))
+
 # Backup
 @app.route('/backup')
 @login_required
@@ -1012,17 +4044,45 @@ def backup():
     return render_template('backup.html')
 
 # Initialize database and admin user
-with app.app_context():
-    db.create_all()
-    
-    # Create admin user if it doesn't exist
-    if not User.query.filter_by(username='admin').first():
-        admin_user = User(
-            username='admin',
-            password_hash=generate_password_hash('admin123')
-        )
-        db.session.add(admin_user)
-        db.session.commit()
+# Schema versions
+# create_all builds a new database with the current schema, recorded as having every
+# migration applied; existing tables change only through migrate_db.py.
+def prepare_schema(engine):
+    """Create missing tables, then refuse a database that still has migrations pending."""
+    fresh = not set(db.inspect(engine).get_table_names()) & set(db.metadata.tables)
+    db.metadata.create_all(engine)
+    if fresh:
+        migrate_db.stamp(engine)
+    pending = migrate_db.pending_migrations(engine)
+    if pending:
+        raise RuntimeError(f'{engine.url.render_as_string()} has pending schema migrations {pending}; '
+                           f'run python migrate_db.py --database-url <url> before starting the app')
+
+# Startup schema and data setup; check_db.py inspects databases as they are, so it skips this
+if not DATABASE_READ_ONLY:
+    with app.app_context():
+        for engine in [db.engine] + [db.engines[bind] for bind in BRANCH_BINDS.values()]:
+            # Branch databases hold every main-database table
+            prepare_schema(engine)
+            
+            # Seed the version rows used for HTTP caching
+            with engine.begin() as connection:
+                seeded = set(connection.execute(select(DataVersion.table_name)).scalars())
+                missing = [{'table_name': table_name} for table_name in VERSIONED_TABLES if table_name not in seeded]
+                if missing:
+                    connection.execute(DataVersion.__table__.insert(), missing)
+        db.create_all()
+        
+        # Create admin user if it doesn't exist
+        if not User.query.filter_by(username='admin').first():
+            admin_user = User(
+                username='admin',
+                password_hash=generate_password_hash('admin123')
+            )
+            db.session.add(admin_user)
+            db.session.commit()
+        if BRANCH_BINDS:
+            sync_branch_users()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,100 @@
+"""Posting throughput benchmark.
+
+Posts sales invoices through the add_sales_invoice page with Flask's test client and
+reports postings per second, latency percentiles and SQL statements per posting. It
+runs on a temporary SQLite file unless --database-url names a scratch database; it
+adds customers and invoices, so never point it at real data. Run it before and after
+a change to the posting path and compare the two reports.
+
+Usage:
+    python benchmark_postings.py                          2000 postings, 1 thread
+    python benchmark_postings.py --postings 20000 --threads 4
+    python benchmark_postings.py --credit-limit 1e9       give every customer a credit limit
+    python benchmark_postings.py --database-url postgresql://localhost/bench
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import date
+
+def percentile(values, share):
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+def run_benchmark(postings, customers, threads, warmup, credit_limit, seed):
+    from app import app, db, Customer
+
+    app.config['TESTING'] = True  # adds the X-Query-Count response header
+    with app.app_context():
+        rows = [{'name': f'Benchmark customer {index}', 'balance': 0.0} for index in range(customers)]
+        if credit_limit is not None:
+            for row in rows:
+                row['credit_limit'] = credit_limit
+        ids = list(db.session.scalars(db.insert(Customer).returning(Customer.id), rows))
+        db.session.commit()
+
+    today = date.today().isoformat()
+    latencies = []
+    statements = []
+    rejected = []
+    lock = threading.Lock()
+
+    def worker(count, worker_seed):
+        generator = random.Random(worker_seed)
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        measured, queries, refused = [], [], 0
+        for index in range(warmup + count):
+            form = {'customer_id': str(generator.choice(ids)), 'amount': f'{generator.uniform(1, 1000):.2f}',
+                    'invoice_date': today, 'invoice_number': ''}
+            started = time.perf_counter()
+            response = client.post('/add_sales_invoice', data=form)
+            elapsed = time.perf_counter() - started
+            if index < warmup:
+                continue
+            measured.append(elapsed)
+            queries.append(int(response.headers.get('X-Query-Count', 0)))
+            if not response.location or not response.location.endswith('/sales_invoices'):
+                refused += 1
+            # Drop the flash message so the session cookie stays small
+            client.get('/login')
+        with lock:
+            latencies.extend(measured)
+            statements.extend(queries)
+            rejected.append(refused)
+
+    shares = [postings // threads + (index < postings % threads) for index in range(threads)]
+    pool = [threading.Thread(target=worker, args=(share, seed + index)) for index, share in enumerate(shares)]
+    started = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    measured_wall = wall * postings / (postings + warmup * threads)
+    print(f'{postings} postings, {threads} thread(s), {customers} customers, '
+          f"credit limit {'none' if credit_limit is None else f'{credit_limit:,.2f}'}")
+    print(f'throughput: {postings / measured_wall:,.0f} postings/s')
+    print(f'latency ms: p50 {percentile(latencies, 0.5) * 1000:.2f}  p95 {percentile(latencies, 0.95) * 1000:.2f}  '
+          f'p99 {percentile(latencies, 0.99) * 1000:.2f}  max {latencies[-1] * 1000:.2f}')
+    print(f'SQL statements per posting: {sum(statements) / len(statements):.1f}')
+    print(f'rejected: {sum(rejected)}')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure sales invoice posting throughput and latency.')
+    parser.add_argument('--postings', type=int, default=2000, help='measured postings (default 2000)')
+    parser.add_argument('--customers', type=int, default=200, help='customers the postings are spread over (default 200)')
+    parser.add_argument('--threads', type=int, default=1, help='concurrent posting threads (default 1)')
+    parser.add_argument('--warmup', type=int, default=50, help='unmeasured postings per thread first (default 50)')
+    parser.add_argument('--credit-limit', type=float, help='credit limit given to every benchmark customer')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database-url', help='scratch database (default: a temporary SQLite file)')
+    args = parser.parse_args()
+
+    # The app reads DATABASE_URL on import
+    os.environ['DATABASE_URL'] = args.database_url or f'sqlite:///{tempfile.mkdtemp()}/benchmark.db'
+    run_benchmark(args.postings, args.customers, args.threads, args.warmup, args.credit_limit, args.seed)
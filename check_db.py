@@ -1,40 +1,283 @@
-import sqlite3
+"""Database diagnostics and maintenance.
 
-def check_database_structure():
-    """Check the actual structure of the database"""
-    conn = sqlite3.connect('customer_supplier.db')
-    cursor = conn.cursor()
-    
+Reports table structure, row counts, table/index sizes, free pages and
+fragmentation, and the query plan of every SQL statement the read-only pages
+issue, flagging full table scans and indexes no hot query uses. Works on
+SQLite and PostgreSQL; the database comes from DATABASE_URL, like the app.
+The plan capture loads the app with DATABASE_READ_ONLY=1, so it opens the
+databases read-only and skips the app's startup schema and data setup.
+
+Usage:
+    python check_db.py                            full report
+    python check_db.py --report sizes plans       selected sections
+    python check_db.py --analyze --optimize       maintenance (also --vacuum)
+"""
+import argparse
+import logging
+import os
+import re
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import event, inspect, text
+
+from migrate_db import connect, database_url
+
+REPORTS = ('structure', 'counts', 'sizes', 'fragmentation', 'plans')
+# Pages never requested by the plan capture: no data to read, or they change state
+SKIPPED_ENDPOINTS = {'static', 'asset', 'login', 'logout'}
+SQLITE_INDEX_PATTERN = re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+POSTGRES_INDEX_PATTERN = re.compile(r'Index (?:Only )?Scan (?:Backward )?using (\w+)')
+
+def print_header(title):
+    print(f"\n=== {title} ===")
+
+def report_structure(engine):
+    inspector = inspect(engine)
+    for table_name in inspector.get_table_names():
+        print_header(f"{table_name.upper()} TABLE STRUCTURE")
+        primary_key = set(inspector.get_pk_constraint(table_name)['constrained_columns'])
+        for col in inspector.get_columns(table_name):
+            print(f"Column: {col['name']}, Type: {col['type']}, NotNull: {int(not col['nullable'])}, "
+                  f"Default: {col['default']}, PK: {int(col['name'] in primary_key)}")
+        for index in inspector.get_indexes(table_name):
+            print(f"Index: {index['name']} ({', '.join(filter(None, index['column_names']))})"
+                  f"{' UNIQUE' if index['unique'] else ''}")
+
+def report_counts(engine):
+    print_header("ROW COUNTS")
+    preparer = engine.dialect.identifier_preparer
+    with engine.connect() as conn:
+        for table_name in inspect(engine).get_table_names():
+            count = conn.execute(text(f'SELECT COUNT(*) FROM {preparer.quote(table_name)}')).scalar()
+            print(f"{table_name:<32} {count:>12,}")
+
+def report_sizes(engine):
+    print_header("TABLE AND INDEX SIZES")
+    with engine.connect() as conn:
+        if engine.dialect.name == 'postgresql':
+            rows = conn.execute(text(
+                "SELECT c.relname, c.relkind, t.relname AS table_name, pg_relation_size(c.oid) AS bytes "
+                "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "LEFT JOIN pg_index i ON i.indexrelid = c.oid LEFT JOIN pg_class t ON t.oid = i.indrelid "
+                "WHERE n.nspname = current_schema() AND c.relkind IN ('r', 'i') ORDER BY bytes DESC")).all()
+            for name, kind, table_name, size in rows:
+                label = f"index on {table_name}" if kind == 'i' else 'table'
+                print(f"{name:<48} {label:<28} {size / 1024:>12,.1f} KB")
+            return
+        try:
+            rows = conn.execute(text(
+                "SELECT d.name, m.type, m.tbl_name, COUNT(*) AS pages, SUM(d.pgsize) AS bytes, "
+                "SUM(d.unused) AS unused FROM dbstat d LEFT JOIN sqlite_master m ON m.name = d.name "
+                "GROUP BY d.name ORDER BY bytes DESC")).all()
+        except Exception:
+            print("dbstat is not available in this SQLite build (needs SQLITE_ENABLE_DBSTAT_VTAB)")
+            return
+        for name, kind, table_name, pages, size, unused in rows:
+            label = f"index on {table_name}" if kind == 'index' else (kind or 'internal')
+            fill = (1 - unused / size) * 100 if size else 100.0
+            print(f"{name:<48} {label:<28} {pages:>8,} pages {size / 1024:>12,.1f} KB  {fill:5.1f}% full")
+
+def report_fragmentation(engine):
+    print_header("FREE SPACE AND FRAGMENTATION")
+    with engine.connect() as conn:
+        if engine.dialect.name == 'postgresql':
+            rows = conn.execute(text(
+                "SELECT relname, n_live_tup, n_dead_tup, last_vacuum, last_autovacuum, last_analyze, "
+                "last_autoanalyze FROM pg_stat_user_tables ORDER BY n_dead_tup DESC")).all()
+            for name, live, dead, vacuum, autovacuum, analyze, autoanalyze in rows:
+                dead_percent = dead / (live + dead) * 100 if live + dead else 0.0
+                print(f"{name:<32} live {live:>10,}  dead {dead:>10,} ({dead_percent:5.1f}%)  "
+                      f"vacuumed {max(filter(None, (vacuum, autovacuum)), default='never')}  "
+                      f"analyzed {max(filter(None, (analyze, autoanalyze)), default='never')}")
+            return
+        page_size = conn.execute(text('PRAGMA page_size')).scalar()
+        page_count = conn.execute(text('PRAGMA page_count')).scalar()
+        freelist = conn.execute(text('PRAGMA freelist_count')).scalar()
+        print(f"Page size: {page_size} bytes, pages: {page_count:,}, file: {page_size * page_count / 1024:,.1f} KB")
+        print(f"Free pages: {freelist:,} ({freelist / page_count * 100 if page_count else 0:.1f}%)"
+              f"{'  -> run --vacuum to reclaim' if page_count and freelist / page_count > 0.1 else ''}")
+        print(f"Statistics (sqlite_stat1): {'present' if inspect(engine).has_table('sqlite_stat1') else 'missing -> run --analyze'}")
+        # A b-tree page is out of sequence when it does not follow the previous page of the same tree
+        try:
+            rows = conn.execute(text('SELECT name, pageno FROM dbstat ORDER BY name, path'))
+        except Exception:
+            return
+        pages, jumps, previous = defaultdict(int), defaultdict(int), {}
+        for name, pageno in rows:
+            if name in previous and pageno != previous[name] + 1:
+                jumps[name] += 1
+            previous[name] = pageno
+            pages[name] += 1
+        for name in sorted(pages, key=lambda name: -jumps[name]):
+            if pages[name] > 1:
+                print(f"{name:<48} {jumps[name] / (pages[name] - 1) * 100:5.1f}% of {pages[name]:,} pages out of sequence")
+
+def report_missing_columns(engine, metadata):
+    """Print the app's columns the database does not have yet; pages reading them fail."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = [f'{table.name}.{column.name}' for table in metadata.sorted_tables if table.name in existing_tables
+               for column in table.columns
+               if column.name not in {existing['name'] for existing in inspector.get_columns(table.name)}]
+    if missing:
+        print(f"Columns missing from the database (start the app or run migrate_db.py): {', '.join(missing)}")
+
+def capture_route_queries():
+    """Request every read-only page once as the first user and return its distinct SELECTs.
+
+    Returns OrderedDict(statement -> (parameters, engine, [endpoints])). Parameterized
+    pages are requested for the first row of their table.
+    """
+    from flask import url_for
+    # Read-only engines, and no create_all, column, index or admin user writes on import
+    os.environ['DATABASE_READ_ONLY'] = '1'
+    from app import app, db, User, API_RESOURCES
+    # A failing page is reported below in one line; keep the app's tracebacks out of the report
+    logging.getLogger(app.logger.name).setLevel(logging.CRITICAL)
+
+    captured = OrderedDict()
+    current = {}
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            entry = captured.setdefault(statement, (parameters, conn.engine, []))
+            if current.get('endpoint') not in entry[2]:
+                entry[2].append(current.get('endpoint'))
+
+    with app.app_context():
+        report_missing_columns(db.engine, db.metadata)
+        # Only the id, so an unmigrated user table still works
+        user_id = db.session.query(User.id).order_by(User.id).limit(1).scalar()
+        first_ids = {}
+        for model, _, _, _ in API_RESOURCES.values():
+            first_ids[model.__tablename__] = db.session.query(model.id).order_by(model.id).limit(1).scalar()
+        db.session.remove()
+    if user_id is None:
+        print("No users in the database; cannot request the pages.")
+        return captured
+
+    def route_arguments(endpoint, arguments):
+        values = {}
+        for name in arguments:
+            if name == 'resource':
+                values[name] = 'customers' if endpoint == 'api_get' else 'sales_invoices'
+                continue
+            if name == 'invoice_id':
+                table_name = 'sales_invoice' if 'sales' in endpoint else 'purchase_invoice'
+            elif name == 'id':
+                table_name = 'customer' if endpoint == 'api_get' else endpoint.split('_', 1)[1]
+            else:
+                table_name = name[:-len('_id')]
+            if first_ids.get(table_name) is None:
+                return None
+            values[name] = first_ids[table_name]
+        return values
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', capture)
     try:
-        # Check sales_invoice table structure
-        print("=== SALES_INVOICE TABLE STRUCTURE ===")
-        cursor.execute("PRAGMA table_info(sales_invoice)")
-        columns = cursor.fetchall()
-        for col in columns:
-            print(f"Column: {col[1]}, Type: {col[2]}, NotNull: {col[3]}, Default: {col[4]}, PK: {col[5]}")
-        
-        print("\n=== PURCHASE_INVOICE TABLE STRUCTURE ===")
-        cursor.execute("PRAGMA table_info(purchase_invoice)")
-        columns = cursor.fetchall()
-        for col in columns:
-            print(f"Column: {col[1]}, Type: {col[2]}, NotNull: {col[3]}, Default: {col[4]}, PK: {col[5]}")
-            
-        print("\n=== COLLECTION TABLE STRUCTURE ===")
-        cursor.execute("PRAGMA table_info(collection)")
-        columns = cursor.fetchall()
-        for col in columns:
-            print(f"Column: {col[1]}, Type: {col[2]}, NotNull: {col[3]}, Default: {col[4]}, PK: {col[5]}")
-            
-        print("\n=== PAYMENT TABLE STRUCTURE ===")
-        cursor.execute("PRAGMA table_info(payment)")
-        columns = cursor.fetchall()
-        for col in columns:
-            print(f"Column: {col[1]}, Type: {col[2]}, NotNull: {col[3]}, Default: {col[4]}, PK: {col[5]}")
-            
-    except Exception as e:
-        print(f"Error: {e}")
+        for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.endpoint):
+            if 'GET' not in rule.methods or rule.endpoint in SKIPPED_ENDPOINTS:
+                continue
+            arguments = route_arguments(rule.endpoint, rule.arguments)
+            if arguments is None:
+                continue
+            current['endpoint'] = rule.endpoint
+            with app.test_request_context():
+                url = url_for(rule.endpoint, **arguments)
+            status = client.get(url).status_code
+            if status >= 500:
+                print(f"[{rule.endpoint}] request failed with status {status}; its queries are missing below")
     finally:
-        conn.close()
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', capture)
+    return captured
+
+def explain(conn, dialect, statement, parameters):
+    if dialect == 'postgresql':
+        rows = conn.exec_driver_sql(f'EXPLAIN (ANALYZE, BUFFERS) {statement}', parameters).all()
+        return [row[0] for row in rows]
+    rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+    return [row[-1] for row in rows]
+
+def is_full_scan(dialect, line):
+    if dialect == 'postgresql':
+        return 'Seq Scan on' in line
+    return line.startswith('SCAN ') and ' USING ' not in line
+
+def report_plans(engine):
+    print_header("QUERY PLANS OF THE READ-ONLY PAGES")
+    captured = capture_route_queries()
+    used_indexes = set()
+    full_scans = 0
+    for statement, (parameters, query_engine, endpoints) in captured.items():
+        # Explained on the engine that ran it (archive and replica binds included)
+        dialect = query_engine.dialect.name
+        index_pattern = POSTGRES_INDEX_PATTERN if dialect == 'postgresql' else SQLITE_INDEX_PATTERN
+        with query_engine.connect() as conn:
+            try:
+                plan = explain(conn, dialect, statement, parameters)
+            except Exception as e:
+                print(f"\n[{', '.join(endpoints)}] could not explain: {e}")
+                continue
+            finally:
+                conn.rollback()
+        flagged = [line for line in plan if is_full_scan(dialect, line.strip())]
+        full_scans += bool(flagged)
+        for line in plan:
+            used_indexes.update(index_pattern.findall(line))
+        print(f"\n{'FULL SCAN ' if flagged else ''}[{', '.join(endpoints)}]")
+        print(f"  {' '.join(statement.split())[:300]}")
+        for line in plan:
+            print(f"    {'!! ' if line in flagged else ''}{line}")
+
+    print_header("INDEX USAGE")
+    print(f"{len(captured)} distinct queries, {full_scans} with a full table scan")
+    inspector = inspect(engine)
+    for table_name in inspector.get_table_names():
+        for index in inspector.get_indexes(table_name):
+            status = 'used' if index['name'] in used_indexes else 'not used by any page query'
+            print(f"{index['name']:<48} {table_name:<28} {status}")
+
+def run_maintenance(engine, vacuum=False, analyze=False, optimize=False):
+    """VACUUM / ANALYZE / PRAGMA optimize (ANALYZE on PostgreSQL); these cannot run in a transaction."""
+    postgres = engine.dialect.name == 'postgresql'
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if vacuum:
+            print("Running VACUUM...")
+            conn.execute(text('VACUUM (ANALYZE)' if postgres else 'VACUUM'))
+        if analyze:
+            print("Running ANALYZE...")
+            conn.execute(text('ANALYZE'))
+        if optimize:
+            print("Running optimize...")
+            conn.execute(text('ANALYZE' if postgres else 'PRAGMA optimize'))
+    print("Maintenance completed.")
 
 if __name__ == "__main__":
-    check_database_structure()
+    parser = argparse.ArgumentParser(description='Database diagnostics and maintenance.')
+    parser.add_argument('--report', nargs='+', choices=REPORTS, help='sections to print (default: all)')
+    parser.add_argument('--vacuum', action='store_true', help='rebuild the file and reclaim free pages')
+    parser.add_argument('--analyze', action='store_true', help='refresh the planner statistics')
+    parser.add_argument('--optimize', action='store_true', help='PRAGMA optimize (ANALYZE on PostgreSQL)')
+    parser.add_argument('--database-url', help='defaults to DATABASE_URL, like the app')
+    args = parser.parse_args()
+
+    if args.database_url:
+        # The plan capture imports the app, which reads DATABASE_URL
+        os.environ['DATABASE_URL'] = args.database_url
+    engine = connect(args.database_url or database_url())
+    if args.vacuum or args.analyze or args.optimize:
+        run_maintenance(engine, vacuum=args.vacuum, analyze=args.analyze, optimize=args.optimize)
+        if not args.report:
+            raise SystemExit(0)
+    sections = {'structure': report_structure, 'counts': report_counts, 'sizes': report_sizes,
+                'fragmentation': report_fragmentation, 'plans': report_plans}
+    for name in args.report or REPORTS:
+        sections[name](engine)
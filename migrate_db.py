@@ -1,78 +1,429 @@
-import sqlite3
+"""Versioned schema migrations for SQLite and PostgreSQL.
+
+Every migration in MIGRATIONS runs once and is recorded in schema_migrations.
+Work that touches many rows (table rebuilds, backfills) runs in short
+primary-key batches with a pause in between, so the application keeps writing
+while a migration runs. Progress is saved after every batch, and a migration
+interrupted half-way resumes from its last batch on the next run. A table
+rebuild catches up the rows changed meanwhile from the change_event log, so
+tables the app does not log there (users, counters, caches) are rebuilt only
+with --offline, while the app is stopped.
+
+This is the only path that changes existing tables. The app creates a new
+database with the current schema and records every migration as applied; it
+refuses to start on an existing database with pending migrations.
+
+Usage:
+    python migrate_db.py                  apply pending migrations
+    python migrate_db.py --status         list applied and pending migrations
+    python migrate_db.py --batch-size 2000 --pause 0.2
+    python migrate_db.py --offline        the app is stopped; allow every table rebuild
+"""
+import argparse
 import os
+import time
+from datetime import datetime
+
+from sqlalchemy import (BigInteger, CheckConstraint, Column, DateTime, Float, ForeignKeyConstraint, Index, Integer,
+                        MetaData, String, Table, UniqueConstraint, create_engine, delete, event, func, insert, inspect,
+                        select, text, update)
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+bookkeeping = MetaData()
+schema_migrations = Table(
+    'schema_migrations', bookkeeping,
+    Column('version', Integer, primary_key=True),
+    Column('name', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+    Column('seconds', Float),
+)
+# Resume point of each batched task of a migration that has not finished yet
+migration_progress = Table(
+    'schema_migration_progress', bookkeeping,
+    Column('version', Integer, primary_key=True),
+    Column('task', String(200), primary_key=True),
+    Column('last_id', Integer, nullable=False),
+    Column('done', Integer, nullable=False, default=0),
+    Column('start_sequence', Integer),
+    Column('updated_at', DateTime),
+)
+
+def database_url():
+    """The app's database; relative SQLite paths live in instance/, as with Flask-SQLAlchemy."""
+    url = os.environ.get('DATABASE_URL', 'sqlite:///customer_supplier.db')
+    if url.startswith('postgres://'):
+        url = url.replace('postgres://', 'postgresql://', 1)
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and url.database and url.database != ':memory:' \
+            and not os.path.isabs(url.database):
+        url = url.set(database=os.path.join(BASE_DIR, 'instance', url.database))
+    return url
+
+# Tables whose every write the app records in change_event, by table name
+CHANGE_FEED_TABLES = {'customer', 'supplier', 'sales_invoice', 'purchase_invoice', 'collection', 'payment'}
+
+class Migrator:
+    """Schema operations available to migrations, bound to one engine.
+
+    offline means the app is stopped, so nothing writes while a table is rebuilt.
+    """
+    def __init__(self, engine, batch_size=5000, pause=0.05, offline=False):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+        self.batch_size = batch_size
+        self.pause = pause
+        self.offline = offline
+        self.version = None
+
+    def quote(self, name):
+        return self.engine.dialect.identifier_preparer.quote(name)
+
+    def table_names(self):
+        return [name for name in inspect(self.engine).get_table_names() if name not in bookkeeping.tables]
+
+    def columns(self, table_name):
+        return {column['name'] for column in inspect(self.engine).get_columns(table_name)}
+
+    def add_column(self, table_name, column):
+        """ALTER TABLE ... ADD COLUMN; a catalog-only change on both databases."""
+        if column.name in self.columns(table_name):
+            return
+        Table(table_name, MetaData(), column)
+        ddl = CreateColumn(column).compile(dialect=self.engine.dialect)
+        with self.engine.begin() as conn:
+            conn.execute(text(f'ALTER TABLE {self.quote(table_name)} ADD COLUMN {ddl}'))
+        print(f'  {table_name}: added column {column.name}')
+
+    def create_index(self, table_name, name, *columns, unique=False):
+        """CREATE INDEX (CONCURRENTLY on PostgreSQL, so writes are not blocked)."""
+        if name in {index['name'] for index in inspect(self.engine).get_indexes(table_name)}:
+            return
+        table = Table(table_name, MetaData(), autoload_with=self.engine)
+        index = Index(name, *(table.c[column] for column in columns), unique=unique,
+                      postgresql_concurrently=True)
+        if self.dialect == 'postgresql':
+            with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                index.create(conn)
+        else:
+            with self.engine.begin() as conn:
+                index.create(conn)
+        print(f'  {table_name}: created index {name}')
+
+    def drop_columns(self, table_name, names):
+        """Drop columns: a batched table rebuild on SQLite, ALTER TABLE DROP COLUMN elsewhere."""
+        names = [name for name in names if name in self.columns(table_name)]
+        if not names:
+            return
+        if self.dialect != 'sqlite':
+            with self.engine.begin() as conn:
+                for name in names:
+                    conn.execute(text(f'ALTER TABLE {self.quote(table_name)} DROP COLUMN {self.quote(name)}'))
+            print(f'  {table_name}: dropped {", ".join(names)}')
+        else:
+            self.rebuild_table(table_name, drop_columns=names)
+
+    def backfill(self, table_name, values, where=None):
+        """UPDATE table SET values [WHERE where] in primary-key batches; values maps column -> SQL text."""
+        table = Table(table_name, MetaData(), autoload_with=self.engine)
+        key = self.batch_key(table)
+        condition = text(where) if where else None
+        statement = update(table).values({name: text(expression) for name, expression in values.items()})
+        if condition is not None:
+            statement = statement.where(condition)
+
+        def copy_batch(conn, last_id, upper):
+            return conn.execute(statement.where(key > last_id, key <= upper)).rowcount
+
+        self.run_batches(f'backfill:{table_name}', table, key, copy_batch)
+        print(f'  {table_name}: backfilled {", ".join(values)}')
+
+    def rebuild_table(self, table_name, drop_columns=(), replace_columns=None):
+        """Recreate a table without drop_columns and with replace_columns ({name: Column}) swapped in.
+
+        Rows are copied in batches into _new_<table>. The final swap re-copies the
+        rows changed meanwhile (from the change_event log) and the rows added since
+        the last batch, then replaces the table and recreates its indexes, all in
+        one short transaction. Unique, check and foreign key constraints, server
+        defaults and indexes of the kept columns are preserved. SQLite only; other
+        databases change tables in place with ALTER (add_column, drop_columns).
+
+        Writes to tables outside CHANGE_FEED_TABLES are not in the log and would be lost,
+        so those tables are rebuilt only offline.
+        """
+        if self.dialect != 'sqlite':
+            raise RuntimeError(f'{table_name}: table rebuilds are SQLite-only; on {self.dialect} '
+                               'use the in-place ALTER operations (add_column, drop_columns)')
+        if not self.offline and (table_name not in CHANGE_FEED_TABLES or 'change_event' not in self.table_names()):
+            raise RuntimeError(f'{table_name}: writes to this table are not in the change feed, so a rebuild '
+                               'would lose those made while it runs; stop the app and rerun with --offline')
+        replace_columns = replace_columns or {}
+        metadata = MetaData()
+        # A resumed rebuild finds its half-filled _new_ table; define that one afresh
+        metadata.reflect(self.engine, only=lambda name, _: not name.startswith('_new_'))
+        old = metadata.tables[table_name]
+        kept = [column for column in old.columns if column.name not in drop_columns]
+        names = [column.name for column in kept]
+
+        new = Table(f'_new_{table_name}', metadata)
+        for column in kept:
+            new.append_column(replace_columns.get(column.name) or Column(
+                column.name, column.type, primary_key=column.primary_key, nullable=column.nullable,
+                server_default=column.server_default.arg if column.server_default is not None else None,
+                autoincrement=column.autoincrement))
+        for constraint in old.constraints:
+            columns = [column.name for column in getattr(constraint, 'columns', ())]
+            if any(name in drop_columns for name in columns):
+                continue
+            if isinstance(constraint, UniqueConstraint):
+                new.append_constraint(UniqueConstraint(*columns, name=constraint.name))
+            elif isinstance(constraint, ForeignKeyConstraint):
+                new.append_constraint(ForeignKeyConstraint(
+                    columns, [element.target_fullname for element in constraint.elements], name=constraint.name,
+                    ondelete=constraint.ondelete, onupdate=constraint.onupdate))
+            elif isinstance(constraint, CheckConstraint):
+                sqltext = str(constraint.sqltext)
+                # SQLite reflection can keep the table's closing parenthesis on the last CHECK
+                while sqltext.count(')') > sqltext.count('(') and sqltext.endswith(')'):
+                    sqltext = sqltext[:-1].rstrip()
+                if not any(name in sqltext for name in drop_columns):
+                    new.append_constraint(CheckConstraint(text(sqltext), name=constraint.name))
+        indexes = [(index.name, [column.name for column in index.columns], index.unique) for index in old.indexes
+                   if not any(column.name in drop_columns for column in index.columns)]
+
+        key = self.batch_key(old)
+        task = f'rebuild:{table_name}'
+        if self.progress(task) is None:
+            new.drop(self.engine, checkfirst=True)
+            new.create(self.engine)
 
-def remove_cancelled_columns():
-    """Remove is_cancelled related columns from all tables"""
-    db_path = 'customer_supplier.db'
-    
-    if not os.path.exists(db_path):
-        print("Database file not found!")
+        def copy_rows(conn, condition):
+            return conn.execute(insert(new).from_select(names, select(*(old.c[name] for name in names))
+                                                        .where(condition))).rowcount
+
+        state = self.run_batches(task, old, key, lambda conn, last_id, upper: copy_rows(
+            conn, (key > last_id) & (key <= upper)))
+
+        with self.engine.begin() as conn:
+            # The first statement is a write, so the database is locked against other
+            # writers before the catch-up reads anything
+            conn.execute(update(migration_progress)
+                         .where(migration_progress.c.version == self.version, migration_progress.c.task == task)
+                         .values(updated_at=datetime.utcnow()))
+            copy_rows(conn, key > state['last_id'])
+            if state['start_sequence'] is not None:
+                events = metadata.tables['change_event']
+                changed = select(events.c.entity_id).where(events.c.entity == table_name,
+                                                           events.c.sequence > state['start_sequence'])
+                conn.execute(delete(new).where(new.c[key.name].in_(changed)))
+                copy_rows(conn, key.in_(changed))
+            conn.execute(text(f'DROP TABLE {self.quote(table_name)}'))
+            for name, columns, unique in indexes:
+                Index(name, *(new.c[column] for column in columns), unique=unique).create(conn)
+            conn.execute(text(f'ALTER TABLE {self.quote(new.name)} RENAME TO {self.quote(table_name)}'))
+            conn.execute(delete(migration_progress).where(migration_progress.c.version == self.version,
+                                                          migration_progress.c.task == task))
+        print(f'  {table_name}: rebuilt' + (f' without {", ".join(drop_columns)}' if drop_columns else ''))
+
+    def batch_key(self, table):
+        key = list(table.primary_key.columns)
+        if len(key) != 1 or not isinstance(key[0].type, Integer):
+            raise ValueError(f'{table.name}: batched operations need a single integer primary key')
+        return key[0]
+
+    def progress(self, task):
+        with self.engine.connect() as conn:
+            row = conn.execute(select(migration_progress).where(migration_progress.c.version == self.version,
+                                                                migration_progress.c.task == task)).first()
+        return dict(row._mapping) if row else None
+
+    def run_batches(self, task, table, key, process):
+        """Call process(conn, last_id, upper) for successive key ranges of batch_size rows.
+
+        Each batch commits together with its progress row, so a rerun continues after
+        the last committed batch. Returns the final progress state.
+        """
+        state = self.progress(task)
+        if state is None:
+            start_sequence = None
+            if 'change_event' in inspect(self.engine).get_table_names():
+                with self.engine.connect() as conn:
+                    start_sequence = conn.execute(text('SELECT COALESCE(MAX(sequence), 0) FROM change_event')).scalar()
+            state = {'version': self.version, 'task': task, 'last_id': 0, 'done': 0,
+                     'start_sequence': start_sequence, 'updated_at': datetime.utcnow()}
+            with self.engine.begin() as conn:
+                conn.execute(insert(migration_progress).values(state))
+        else:
+            print(f'  {task}: resuming after id {state["last_id"]}')
+
+        with self.engine.connect() as conn:
+            total = conn.execute(select(func.count()).select_from(table)).scalar()
+        started = time.monotonic()
+        done_before = state['done']
+        while True:
+            with self.engine.begin() as conn:
+                window = select(key).where(key > state['last_id']).order_by(key).limit(self.batch_size).subquery()
+                upper = conn.execute(select(func.max(window.c[key.name]))).scalar()
+                if upper is None:
+                    break
+                state['done'] += process(conn, state['last_id'], upper) or 0
+                state['last_id'] = upper
+                conn.execute(update(migration_progress)
+                             .where(migration_progress.c.version == self.version, migration_progress.c.task == task)
+                             .values(last_id=upper, done=state['done'], updated_at=datetime.utcnow()))
+            rate = (state['done'] - done_before) / max(time.monotonic() - started, 1e-6)
+            percent = min(state['done'] / total * 100, 100.0) if total else 100.0
+            print(f'  {task}: {state["done"]}/{total} rows ({percent:.1f}%), {rate:,.0f} rows/s')
+            time.sleep(self.pause)
+        return state
+
+# version -> (name, function(migrator)); keep versions increasing and never renumber
+MIGRATIONS = {}
+
+def migration(version, name):
+    def decorator(function):
+        if version in MIGRATIONS:
+            raise ValueError(f'duplicate migration version {version}')
+        MIGRATIONS[version] = (name, function)
+        return function
+    return decorator
+
+CANCELLATION_COLUMNS = ('is_cancelled', 'cancelled_at', 'cancelled_by')
+
+@migration(1, 'Remove document cancellation columns')
+def remove_cancellation_columns(migrator):
+    for table_name in migrator.table_names():
+        columns = [name for name in CANCELLATION_COLUMNS if name in migrator.columns(table_name)]
+        if columns:
+            migrator.drop_columns(table_name, columns)
+
+@migration(2, 'Add user branch column')
+def add_user_branch(migrator):
+    if 'user' in migrator.table_names():
+        migrator.add_column('user', Column('branch', String(50)))
+
+@migration(3, 'Add customer credit limit')
+def add_customer_credit_limit(migrator):
+    if 'customer' in migrator.table_names():
+        migrator.add_column('customer', Column('credit_limit', Float))
+
+@migration(4, 'Number change events in the database')
+def number_change_events(migrator):
+    if 'change_event' not in migrator.table_names():
+        return
+    migrator.add_column('change_event', Column('txid', BigInteger, nullable=False, server_default='0'))
+    migrator.create_index('change_event', 'ix_change_event_txid_sequence', 'txid', 'sequence')
+    # SQLite integer primary keys number new rows already; PostgreSQL needs an identity
+    if migrator.dialect == 'postgresql':
+        with migrator.engine.begin() as conn:
+            if conn.execute(text("SELECT pg_get_serial_sequence('change_event', 'sequence')")).scalar() is None:
+                start = conn.execute(text('SELECT COALESCE(MAX(sequence), 0) + 1 FROM change_event')).scalar()
+                conn.execute(text('ALTER TABLE change_event ALTER COLUMN sequence '
+                                  f'ADD GENERATED BY DEFAULT AS IDENTITY (START WITH {int(start)})'))
+                print('  change_event: sequence numbered by the database')
+
+# table -> the (date, amount) index of the analytics page and the (party, date) index of statements
+REPORT_INDEXES = {
+    'sales_invoice': [('invoice_date', 'amount'), ('customer_id', 'invoice_date')],
+    'collection': [('collection_date', 'amount'), ('customer_id', 'collection_date')],
+    'purchase_invoice': [('invoice_date', 'amount'), ('supplier_id', 'invoice_date')],
+    'payment': [('payment_date', 'amount'), ('supplier_id', 'payment_date')],
+}
+
+@migration(5, 'Add analytics and statement indexes')
+def add_report_indexes(migrator):
+    for table_name, indexes in REPORT_INDEXES.items():
+        if table_name in migrator.table_names():
+            for columns in indexes:
+                migrator.create_index(table_name, f'ix_{table_name}_{"_".join(columns)}', *columns)
+
+def connect(url):
+    engine = create_engine(url)
+    if engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def configure_sqlite(dbapi_connection, connection_record):
+            # Wait for the app's short write transactions instead of failing, and keep
+            # DROP TABLE from cascading through foreign keys during a rebuild
+            dbapi_connection.execute('PRAGMA busy_timeout = 30000')
+            dbapi_connection.execute('PRAGMA foreign_keys = OFF')
+    return engine
+
+def applied_migrations(engine):
+    bookkeeping.create_all(engine)
+    with engine.connect() as conn:
+        return {row.version: row for row in conn.execute(select(schema_migrations))}
+
+def pending_migrations(engine):
+    applied = applied_migrations(engine)
+    return [version for version in sorted(MIGRATIONS) if version not in applied]
+
+def stamp(engine):
+    """Record every migration as applied without running it, for a database just created
+    with the current schema."""
+    rows = [{'version': version, 'name': MIGRATIONS[version][0], 'applied_at': datetime.utcnow(), 'seconds': 0.0}
+            for version in pending_migrations(engine)]
+    if not rows:
         return
-    
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
     try:
-        # Get all tables
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
-        
-        for table_name in tables:
-            table_name = table_name[0]
-            if table_name.startswith('sqlite_'):
-                continue
-                
-            print(f"Processing table: {table_name}")
-            
-            # Get table info
-            cursor.execute(f"PRAGMA table_info({table_name})")
-            columns = cursor.fetchall()
-            
-            # Check if table has cancellation columns
-            has_cancelled_columns = any(col[1] in ['is_cancelled', 'cancelled_at', 'cancelled_by'] for col in columns)
-            
-            if has_cancelled_columns:
-                print(f"  Found cancellation columns in {table_name}, removing...")
-                
-                # Create new table without cancellation columns
-                new_columns = []
-                for col in columns:
-                    col_name = col[1]
-                    if col_name not in ['is_cancelled', 'cancelled_at', 'cancelled_by']:
-                        col_type = col[2]
-                        col_notnull = "NOT NULL" if col[3] else ""
-                        col_default = f"DEFAULT {col[4]}" if col[4] is not None else ""
-                        col_pk = "PRIMARY KEY" if col[5] else ""
-                        
-                        col_def = f"{col_name} {col_type} {col_notnull} {col_default} {col_pk}".strip()
-                        new_columns.append(col_def)
-                
-                # Create temporary table
-                temp_table = f"{table_name}_temp"
-                create_sql = f"CREATE TABLE {temp_table} ({', '.join(new_columns)})"
-                cursor.execute(create_sql)
-                
-                # Copy data (excluding cancellation columns)
-                select_columns = [col[1] for col in columns if col[1] not in ['is_cancelled', 'cancelled_at', 'cancelled_by']]
-                copy_sql = f"INSERT INTO {temp_table} ({', '.join(select_columns)}) SELECT {', '.join(select_columns)} FROM {table_name}"
-                cursor.execute(copy_sql)
-                
-                # Drop original table and rename temp table
-                cursor.execute(f"DROP TABLE {table_name}")
-                cursor.execute(f"ALTER TABLE {temp_table} RENAME TO {table_name}")
-                
-                print(f"  Successfully cleaned {table_name}")
-            else:
-                print(f"  No cancellation columns found in {table_name}")
-        
-        conn.commit()
-        print("Database migration completed successfully!")
-        
-    except Exception as e:
-        conn.rollback()
-        print(f"Error during migration: {e}")
-    finally:
-        conn.close()
+        with engine.begin() as conn:
+            conn.execute(insert(schema_migrations), rows)
+    except IntegrityError:
+        # Another process creating the same database stamped it first
+        if pending_migrations(engine):
+            raise
+
+def migrate(engine, batch_size=5000, pause=0.05, offline=False):
+    """Apply every pending migration in version order. Returns the versions applied."""
+    applied = applied_migrations(engine)
+    migrator = Migrator(engine, batch_size=batch_size, pause=pause, offline=offline)
+    done = []
+    for version in sorted(MIGRATIONS):
+        if version in applied:
+            continue
+        name, function = MIGRATIONS[version]
+        print(f'Applying {version:04d} {name}')
+        started = time.monotonic()
+        migrator.version = version
+        function(migrator)
+        seconds = time.monotonic() - started
+        with engine.begin() as conn:
+            conn.execute(insert(schema_migrations).values(version=version, name=name,
+                                                          applied_at=datetime.utcnow(), seconds=seconds))
+        print(f'Applied {version:04d} in {seconds:.1f}s')
+        done.append(version)
+    if not done:
+        print('Database schema is up to date.')
+    return done
+
+def print_status(engine):
+    applied = applied_migrations(engine)
+    with engine.connect() as conn:
+        running = {(row.version, row.task): row for row in conn.execute(select(migration_progress))}
+    for version in sorted(MIGRATIONS):
+        name = MIGRATIONS[version][0]
+        if version in applied:
+            print(f'{version:04d} {name}: applied {applied[version].applied_at:%Y-%m-%d %H:%M}')
+        else:
+            print(f'{version:04d} {name}: pending')
+        for (running_version, task), row in running.items():
+            if running_version == version:
+                print(f'     {task}: interrupted after id {row.last_id} ({row.done} rows)')
 
 if __name__ == "__main__":
-    remove_cancelled_columns()
+    parser = argparse.ArgumentParser(description='Apply versioned schema migrations.')
+    parser.add_argument('--status', action='store_true', help='list applied and pending migrations')
+    parser.add_argument('--batch-size', type=int, default=5000, help='rows per batch (default 5000)')
+    parser.add_argument('--pause', type=float, default=0.05, help='seconds to sleep between batches (default 0.05)')
+    parser.add_argument('--offline', action='store_true',
+                        help='the app is stopped: allow rebuilds of tables not in the change feed')
+    parser.add_argument('--database-url', help='defaults to DATABASE_URL, like the app')
+    args = parser.parse_args()
+
+    engine = connect(args.database_url or database_url())
+    if args.status:
+        print_status(engine)
+    else:
+        migrate(engine, batch_size=args.batch_size, pause=args.pause, offline=args.offline)
@@ -0,0 +1,36 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app reads DATABASE_URL on import, so point it at a scratch SQLite file first
+os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/test.db'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module
+
+
+@pytest.fixture
+def app():
+    app_module.app.config['TESTING'] = True
+    with app_module.app.app_context():
+        yield app_module.app
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    return client
+
+
+@pytest.fixture
+def add_customer(client):
+    """Create a customer through the form and return its id."""
+    def add(name, credit_limit=''):
+        client.post('/add_customer', data={'name': name, 'credit_limit': credit_limit})
+        return app_module.db.session.execute(
+            app_module.select(app_module.Customer.id).where(app_module.Customer.name == name)
+        ).scalar_one()
+    return add
@@ -0,0 +1,56 @@
+from datetime import date
+
+import pytest
+
+import app as app_module
+from app import db, analytics_summary, Customer, Supplier
+
+
+def test_analytics_reads_the_data_versions_once(client, monkeypatch):
+    calls = []
+    get_data_versions = app_module.get_data_versions
+
+    def counting(*args, **kwargs):
+        calls.append(args)
+        return get_data_versions(*args, **kwargs)
+    monkeypatch.setattr(app_module, 'get_data_versions', counting)
+
+    assert client.get('/analytics').status_code == 200
+    assert len(calls) == 1
+
+
+def post(client, resource, **item):
+    assert client.post(f'/api/v1/{resource}', json=item).status_code == 201
+
+
+def test_monthly_aggregates_and_dso(client, add_customer):
+    # Dated after every other test's documents, so the 2040 months hold only these
+    customer_id = add_customer('Analytics customer')
+    supplier_id = client.post('/api/v1/suppliers', json={'name': 'Analytics supplier'}).get_json()['id']
+    for amount, day in ((300, '2040-01-15'), (600, '2040-02-10'), (900, '2040-03-05')):
+        post(client, 'sales_invoices', customer_id=customer_id, amount=amount, invoice_date=day)
+    post(client, 'collections', customer_id=customer_id, amount=200, collection_date='2040-02-20')
+    post(client, 'purchase_invoices', supplier_id=supplier_id, amount=400, invoice_date='2040-02-01')
+    post(client, 'payments', supplier_id=supplier_id, amount=100, payment_date='2040-03-01')
+    receivables = db.session.scalar(db.select(db.func.sum(Customer.balance)))
+    payables = db.session.scalar(db.select(db.func.sum(Supplier.balance)))
+
+    summary = analytics_summary(date(2040, 1, 1), date(2040, 3, 31), 10)
+
+    months = {month['month']: month for month in summary['months']}
+    assert list(months) == ['2040-01', '2040-02', '2040-03']
+    assert [months[month]['sales'] for month in months] == [300, 600, 900]
+    assert [months[month]['collections'] for month in months] == [0, 200, 0]
+    assert [months[month]['purchases'] for month in months] == [0, 400, 0]
+    assert [months[month]['payments'] for month in months] == [0, 0, 100]
+    # Month-end receivables: today's total less what was posted afterwards
+    assert [months[month]['receivables'] for month in months] == pytest.approx(
+        [receivables - 1300, receivables - 900, receivables])
+    # DSO over the trailing three months (2040 is a leap year)
+    assert months['2040-01']['dso'] == pytest.approx((receivables - 1300) / 300 * 31)
+    assert months['2040-03']['dso'] == pytest.approx(receivables / 1800 * 91)
+    assert months['2040-01']['dpo'] is None
+    assert summary['totals'] == {'sales': 1800, 'collections': 200, 'purchases': 400, 'payments': 100}
+    assert summary['dso'] == pytest.approx(receivables / 1800 * 91)
+    assert summary['dpo'] == pytest.approx(payables / 400 * 91)
+    assert summary['collection_rate'] == pytest.approx(200 / 1800 * 100)
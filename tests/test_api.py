@@ -0,0 +1,66 @@
+from app import db, Customer, SalesInvoice
+
+
+def invoice(customer_id, amount):
+    return {'customer_id': customer_id, 'amount': amount, 'invoice_date': '2025-03-01'}
+
+
+def customer_state(customer_id):
+    db.session.expire_all()
+    count = db.session.scalar(db.select(db.func.count()).where(SalesInvoice.customer_id == customer_id))
+    return db.session.get(Customer, customer_id).balance, count
+
+
+def test_bulk_create_posts_every_item(client, add_customer):
+    customer_id = add_customer('API bulk')
+
+    response = client.post('/api/v1/sales_invoices/bulk', json={'items': [invoice(customer_id, 10),
+                                                                          invoice(customer_id, 20),
+                                                                          invoice(customer_id, 30)]})
+
+    assert response.status_code == 201
+    body = response.get_json()
+    assert body['count'] == 3 and len(set(body['ids'])) == 3
+    assert customer_state(customer_id) == (60, 3)
+
+
+def test_replayed_idempotency_key_returns_the_stored_response(client, add_customer):
+    customer_id = add_customer('API replay')
+    headers = {'Idempotency-Key': 'replay-1'}
+
+    first = client.post('/api/v1/sales_invoices', json=invoice(customer_id, 40), headers=headers)
+    replay = client.post('/api/v1/sales_invoices', json=invoice(customer_id, 40), headers=headers)
+
+    assert first.status_code == replay.status_code == 201
+    assert replay.get_json() == first.get_json()
+    assert replay.headers['Idempotent-Replayed'] == 'true'
+    assert customer_state(customer_id) == (40, 1)
+
+
+def test_idempotency_key_reused_with_another_body_is_rejected(client, add_customer):
+    customer_id = add_customer('API reused key')
+    headers = {'Idempotency-Key': 'reused-1'}
+    client.post('/api/v1/sales_invoices', json=invoice(customer_id, 40), headers=headers)
+
+    response = client.post('/api/v1/sales_invoices', json=invoice(customer_id, 45), headers=headers)
+
+    assert response.status_code == 422
+    assert 'Idempotency-Key' in response.get_json()['error']
+    assert customer_state(customer_id) == (40, 1)
+
+
+def test_bulk_create_rolls_back_when_one_item_is_invalid(client, add_customer):
+    customer_id = add_customer('API invalid item')
+
+    response = client.post('/api/v1/sales_invoices/bulk', json=[invoice(customer_id, 10),
+                                                                invoice(customer_id, 'ten')],
+                           headers={'Idempotency-Key': 'invalid-1'})
+
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith('item 1:')
+    assert customer_state(customer_id) == (0, 0)
+    # The failed request did not record the key, so a corrected retry goes through
+    retry = client.post('/api/v1/sales_invoices/bulk', json=[invoice(customer_id, 10), invoice(customer_id, 10)],
+                        headers={'Idempotency-Key': 'invalid-1'})
+    assert retry.status_code == 201
+    assert customer_state(customer_id) == (20, 2)
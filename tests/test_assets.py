@@ -0,0 +1,41 @@
+import gzip
+import hashlib
+import re
+
+
+def asset_path(page, name):
+    stem, ext = name.rsplit('.', 1)
+    return re.search(rf'/assets/{re.escape(stem)}\.([0-9a-f]{{12}})\.{ext}', page).group(0)
+
+
+def test_pages_link_fingerprinted_assets(client):
+    page = client.get('/customers').get_data(as_text=True)
+    path = asset_path(page, 'vendor/bootstrap/js/bootstrap.min.js')
+
+    response = client.get(path)
+
+    assert response.status_code == 200
+    assert hashlib.sha256(response.data).hexdigest()[:12] == path.rsplit('.', 2)[1]
+    assert response.cache_control.immutable and response.cache_control.max_age == 365 * 24 * 60 * 60
+    # Stylesheets point at the fingerprinted fonts
+    stylesheet = client.get(asset_path(page, 'vendor/fontawesome/css/all.min.css')).get_data(as_text=True)
+    assert re.search(r'url\(\.\./webfonts/fa-solid-900\.[0-9a-f]{12}\.woff2\)', stylesheet)
+    assert client.get('/assets/vendor/bootstrap/js/bootstrap.min.js').status_code == 404
+
+
+def test_gzip_only_when_accepted(client):
+    page = client.get('/customers').get_data(as_text=True)
+    path = asset_path(page, 'vendor/bootstrap/css/bootstrap.min.css')
+
+    plain = client.get(path)
+    compressed = client.get(path, headers={'Accept-Encoding': 'gzip'})
+    plain_page = client.get('/customers')
+    compressed_page = client.get('/customers', headers={'Accept-Encoding': 'gzip, deflate'})
+
+    assert 'Content-Encoding' not in plain.headers
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.data) == plain.data
+    assert 'Content-Encoding' not in plain_page.headers
+    assert compressed_page.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed_page.data) == plain_page.data
+    assert 'Accept-Encoding' in compressed_page.headers['Vary']
@@ -0,0 +1,71 @@
+import json
+from datetime import date
+
+from app import db, bank_review_serializer, Collection, Customer, match_bank_lines
+
+
+def post_invoice(client, customer_id, amount, invoice_number):
+    client.post('/add_sales_invoice', data={'customer_id': str(customer_id), 'amount': str(amount),
+                                            'invoice_date': '2025-03-01', 'invoice_number': invoice_number})
+
+
+def bank_line(number, reference, amount):
+    return {'line': number, 'date': date(2025, 3, 5), 'amount': amount, 'reference': reference, 'phone': ''}
+
+
+def test_invoice_is_proposed_for_one_line_and_one_candidate_per_party(client, add_customer):
+    customer_id = add_customer('Bank once')
+    post_invoice(client, customer_id, 123.45, 'BANK-ONCE-1')
+
+    # The reference, amount and balance rules all find the same customer for each line
+    lines = match_bank_lines([bank_line(2, 'Payment BANK-ONCE-1', 123.45), bank_line(3, 'Payment BANK-ONCE-1', 123.45)])
+
+    first, second = lines
+    assert [(candidate['party_id'], candidate['invoice']) for candidate in first['candidates']] == [(customer_id, 'BANK-ONCE-1')]
+    assert first['selected'] == 0 and first['confidence'] == 'high'
+    assert all(candidate['invoice'] != 'BANK-ONCE-1' for candidate in second['candidates'])
+    assert len({candidate['party_id'] for candidate in second['candidates']}) == len(second['candidates'])
+
+
+def signed_review(lines, form_token='review-token'):
+    # As bank_import renders it for the admin user (id 1)
+    return bank_review_serializer().dumps({'user': 1, 'form_token': form_token, 'lines': lines})
+
+
+def test_bulk_accept_reusing_an_invoice_is_refused(client, add_customer):
+    customer_id = add_customer('Bank reused')
+    post_invoice(client, customer_id, 234.56, 'BANK-REUSED-1')
+    candidates = [[customer_id, 'BANK-REUSED-1']]
+    lines = [['credit', '2025-03-05', 234.56, f'تحويل بنكي: line {number}', candidates] for number in (2, 3)]
+    before = Collection.query.count()
+
+    response = client.post('/post_bank_matches', data={'lines': signed_review(lines), 'form_token': 'review-token',
+                                                      'choices': json.dumps({'0': '0', '1': '0'})})
+
+    assert response.location.endswith('/bank_import')
+    assert Collection.query.count() == before
+    with client.session_transaction() as session:
+        assert 'BANK-REUSED-1' in session['_flashes'][-1][1]
+
+
+def test_edited_review_is_refused(client, add_customer):
+    customer_id = add_customer('Bank edited')
+    lines = [['credit', '2025-03-05', 10.0, 'تحويل بنكي: line 2', [[customer_id, None]]]]
+    signed = signed_review(lines, form_token='edited-token')
+    edited = json.dumps([['credit', '2025-03-05', 10000.0, 'تحويل بنكي: line 2', [[customer_id, None]]]])
+    before = Collection.query.count()
+
+    for form in ({'lines': edited, 'form_token': 'edited-token'},
+                 {'lines': signed[:-2] + 'xx', 'form_token': 'edited-token'},
+                 {'lines': signed, 'form_token': 'another-token'},
+                 {'lines': signed, 'form_token': 'edited-token', 'choices': json.dumps({'0': '-1'})}):
+        response = client.post('/post_bank_matches', data={'choices': json.dumps({'0': '0'}), **form})
+        assert response.location.endswith('/bank_import')
+    assert Collection.query.count() == before
+
+    response = client.post('/post_bank_matches', data={'lines': signed, 'form_token': 'edited-token',
+                                                      'choices': json.dumps({'0': '0'})})
+    assert response.location.endswith('/collections')
+    db.session.expire_all()
+    assert Collection.query.count() == before + 1
+    assert db.session.get(Customer, customer_id).balance == -10
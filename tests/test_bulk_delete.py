@@ -0,0 +1,58 @@
+from app import db, ChangeEvent, Customer, SalesInvoice
+
+
+def post_invoices(client, items):
+    response = client.post('/api/v1/sales_invoices/bulk', json=[
+        {'customer_id': customer_id, 'amount': amount, 'invoice_date': '2025-03-01'} for customer_id, amount in items])
+    return response.get_json()['ids']
+
+
+def balance(customer_id):
+    db.session.expire_all()
+    return db.session.get(Customer, customer_id).balance
+
+
+def events_after(sequence):
+    return db.session.scalars(db.select(ChangeEvent).where(ChangeEvent.sequence > sequence)
+                              .order_by(ChangeEvent.sequence)).all()
+
+
+def test_bulk_delete_reverses_each_party_once(client, add_customer):
+    first, second = add_customer('Delete first'), add_customer('Delete second')
+    ids = post_invoices(client, [(first, 100), (first, 50), (second, 70), (second, 30)])
+    start = db.session.scalar(db.select(db.func.max(ChangeEvent.sequence)))
+
+    response = client.post('/api/v1/sales_invoices/bulk_delete', json={'ids': ids[:3]})
+
+    assert response.get_json() == {'count': 3, 'documents': 0, 'parties': 2}
+    assert (balance(first), balance(second)) == (0, 30)
+    assert db.session.scalars(db.select(SalesInvoice.id).where(SalesInvoice.id.in_(ids))).all() == [ids[3]]
+    events = events_after(start)
+    assert sorted((event.entity_id, event.old_amount) for event in events if event.entity == 'sales_invoice') == \
+        sorted(zip(ids[:3], (100, 50, 70)))
+    assert {(event.entity_id, event.old_amount, event.new_amount) for event in events if event.entity == 'customer'} == \
+        {(first, 150, 0), (second, 100, 30)}
+
+
+def test_bulk_delete_by_filter(client, add_customer):
+    kept, emptied = add_customer('Filter kept'), add_customer('Filter emptied')
+    post_invoices(client, [(kept, 40), (emptied, 25), (emptied, 35)])
+
+    response = client.post('/api/v1/sales_invoices/bulk_delete', json={'filter': {'party_id': emptied}})
+
+    assert response.get_json()['count'] == 2
+    assert (balance(kept), balance(emptied)) == (40, 0)
+
+
+def test_party_with_documents_is_deleted_only_with_cascade(client, add_customer):
+    customer_id = add_customer('Delete with history')
+    invoice_ids = post_invoices(client, [(customer_id, 80)])
+
+    refused = client.post(f'/delete_customer/{customer_id}').get_json()
+    assert refused['success'] is False and refused['has_history'] is True
+    assert db.session.get(Customer, customer_id) is not None
+
+    assert client.post(f'/delete_customer/{customer_id}', data={'cascade': '1'}).get_json() == {'success': True}
+    db.session.expire_all()
+    assert db.session.get(Customer, customer_id) is None
+    assert db.session.get(SalesInvoice, invoice_ids[0]) is None
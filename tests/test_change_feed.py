@@ -0,0 +1,26 @@
+def test_feed_pages_through_events_in_order(client, add_customer):
+    after = client.get('/api/v1/events?limit=5000').get_json()['next_cursor']
+    customer_id = add_customer('Feed customer')
+    for amount in (100, 200, 300):
+        client.post('/add_sales_invoice', data={'customer_id': str(customer_id), 'amount': str(amount),
+                                                'invoice_date': '2025-03-01', 'invoice_number': ''})
+
+    events, cursor = [], after
+    while True:
+        page = client.get(f'/api/v1/events?after={cursor}&limit=2').get_json()
+        events.extend(page['data'])
+        cursor = page['next_cursor']
+        if not page['has_more']:
+            break
+
+    assert [event['sequence'] for event in events] == sorted(event['sequence'] for event in events)
+    invoices = [event for event in events if event['entity'] == 'sales_invoice']
+    assert [event['new_amount'] for event in invoices] == [100, 200, 300]
+    balances = [event['new_amount'] for event in events if event['entity'] == 'customer' and event['action'] == 'update']
+    assert balances == [100, 300, 600]
+    assert client.get(f'/api/v1/events?after={cursor}').get_json() == {'data': [], 'next_cursor': cursor,
+                                                                       'has_more': False}
+
+
+def test_feed_rejects_malformed_cursor(client):
+    assert client.get('/api/v1/events?after=abc').status_code == 400
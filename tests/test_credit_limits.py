@@ -0,0 +1,72 @@
+import app as app_module
+from app import db, Customer, SalesInvoice, SequenceBlockAllocator
+
+
+def post_invoice(client, customer_id, amount, invoice_number=''):
+    return client.post('/add_sales_invoice', data={'customer_id': str(customer_id), 'amount': str(amount),
+                                                   'invoice_date': '2025-03-01', 'invoice_number': invoice_number})
+
+
+def customer_invoices(customer_id):
+    return db.session.scalars(db.select(SalesInvoice.invoice_number)
+                              .where(SalesInvoice.customer_id == customer_id)).all()
+
+
+def test_invoice_within_limit_is_posted(client, add_customer):
+    customer_id = add_customer('Within limit', credit_limit='500')
+
+    response = post_invoice(client, customer_id, 400)
+
+    assert response.location.endswith('/sales_invoices')
+    db.session.expire_all()
+    assert db.session.get(Customer, customer_id).balance == 400
+    assert len(customer_invoices(customer_id)) == 1
+
+
+def test_invoice_over_limit_is_refused(client, add_customer):
+    customer_id = add_customer('Over limit', credit_limit='500')
+    post_invoice(client, customer_id, 400)
+
+    response = post_invoice(client, customer_id, 200)
+
+    assert response.location.endswith('/add_sales_invoice')
+    db.session.expire_all()
+    assert db.session.get(Customer, customer_id).balance == 400
+    assert len(customer_invoices(customer_id)) == 1
+
+
+def test_invoice_numbered_from_blocks(client, add_customer, monkeypatch):
+    # Block reservations run in their own transaction; the posting must not hold the
+    # SQLite write lock (taken by the balance UPDATE) when it asks for a number
+    monkeypatch.setattr(app_module, 'SEQUENCE_BLOCK_SIZE', 10)
+    monkeypatch.setattr(app_module, 'sequence_blocks', SequenceBlockAllocator(10))
+    customer_id = add_customer('Block numbering', credit_limit='1000')
+
+    for _ in range(3):
+        assert post_invoice(client, customer_id, 100).location.endswith('/sales_invoices')
+    refused = post_invoice(client, customer_id, 5000)
+
+    assert refused.location.endswith('/add_sales_invoice')
+    numbers = sorted(customer_invoices(customer_id))
+    assert len(numbers) == 3
+    assert len(set(numbers)) == 3
+    db.session.expire_all()
+    assert db.session.get(Customer, customer_id).balance == 300
+
+
+def test_api_posting_over_limit_is_refused(client, add_customer):
+    customer_id = add_customer('API limit', credit_limit='500')
+    assert client.post('/api/v1/sales_invoices', json={'customer_id': customer_id, 'amount': 300,
+                                                       'invoice_date': '2025-03-01'}).status_code == 201
+
+    response = client.post('/api/v1/sales_invoices', json={'customer_id': customer_id, 'amount': 300,
+                                                            'invoice_date': '2025-03-01'})
+    bulk = client.post('/api/v1/sales_invoices/bulk', json=[
+        {'customer_id': customer_id, 'amount': 150, 'invoice_date': '2025-03-01'},
+        {'customer_id': customer_id, 'amount': 150, 'invoice_date': '2025-03-01'}])
+
+    assert response.status_code == 422
+    assert bulk.status_code == 422 and 'credit limit' in bulk.get_json()['error']
+    db.session.expire_all()
+    assert db.session.get(Customer, customer_id).balance == 300
+    assert len(customer_invoices(customer_id)) == 1
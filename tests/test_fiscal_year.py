@@ -0,0 +1,97 @@
+from datetime import date
+
+import pytest
+
+import app as app_module
+from app import (db, Customer, Supplier, SalesInvoice, Collection, PurchaseInvoice, Payment, FiscalYearClose,
+                 FiscalYearCloseProgress, close_fiscal_year, party_totals)
+
+
+def seed_year(year, parties=4):
+    """parties customers and suppliers with documents dated in year and the year after."""
+    customers = [Customer(name=f'Close customer {year}-{index}', balance=0.0) for index in range(parties)]
+    suppliers = [Supplier(name=f'Close supplier {year}-{index}', balance=0.0) for index in range(parties)]
+    db.session.add_all(customers + suppliers)
+    db.session.flush()
+    for index, (customer, supplier) in enumerate(zip(customers, suppliers)):
+        for day in (date(year, 3, 1), date(year, 11, 1), date(year + 1, 1, 15)):
+            db.session.add_all([
+                SalesInvoice(invoice_number=f'FY-S-{customer.id}-{day}', customer_id=customer.id,
+                             amount=100 + index, invoice_date=day),
+                Collection(customer_id=customer.id, amount=40, collection_date=day),
+                PurchaseInvoice(invoice_number=f'FY-P-{supplier.id}-{day}', supplier_id=supplier.id,
+                                amount=70 + index, invoice_date=day),
+                Payment(supplier_id=supplier.id, amount=30, payment_date=day),
+            ])
+    db.session.commit()
+    return [customer.id for customer in customers], [supplier.id for supplier in suppliers]
+
+
+def ledger_totals(customer_ids, supplier_ids):
+    """Totals per party including what closed years carried forward, as the reports show them."""
+    totals = {'sales': party_totals(SalesInvoice, 'customer_id'), 'collections': party_totals(Collection, 'customer_id'),
+              'purchases': party_totals(PurchaseInvoice, 'supplier_id'), 'payments': party_totals(Payment, 'supplier_id')}
+    return {name: {party_id: values.get(party_id) for party_id in (supplier_ids if name in ('purchases', 'payments')
+                                                                   else customer_ids)}
+            for name, values in totals.items()}
+
+
+def documents_through(year):
+    """Live documents of every kind dated up to the end of year, which its close archives."""
+    year_end = date(year, 12, 31)
+    return sum(db.session.query(model).filter(getattr(model, date_column) <= year_end).count()
+               for model, date_column in ((SalesInvoice, 'invoice_date'), (Collection, 'collection_date'),
+                                          (PurchaseInvoice, 'invoice_date'), (Payment, 'payment_date')))
+
+
+def live_documents(customer_ids):
+    return db.session.query(SalesInvoice).filter(SalesInvoice.customer_id.in_(customer_ids)).count()
+
+
+def test_close_in_batches(app):
+    customer_ids, supplier_ids = seed_year(2020)
+    before = ledger_totals(customer_ids, supplier_ids)
+    expected = documents_through(2020)
+
+    archived = close_fiscal_year(2020, batch_size=3)
+
+    assert archived == expected
+    assert live_documents(customer_ids) == 4
+    assert ledger_totals(customer_ids, supplier_ids) == before
+    assert db.session.get(FiscalYearClose, 2020).archived_rows == archived
+    assert FiscalYearCloseProgress.query.count() == 0
+
+
+def test_interrupted_close_resumes(app, monkeypatch):
+    customer_ids, supplier_ids = seed_year(2021)
+    before = ledger_totals(customer_ids, supplier_ids)
+    expected = documents_through(2021)
+    close_party_batches = app_module.close_party_batches
+
+    def interrupted_batches(party_ids, counts, batch_size):
+        # Stops before the batch of the third customer, as a crash after a commit would
+        for batch in close_party_batches(party_ids, counts, batch_size):
+            if customer_ids[2] in batch:
+                raise RuntimeError('interrupted')
+            yield batch
+
+    monkeypatch.setattr(app_module, 'close_party_batches', interrupted_batches)
+    with pytest.raises(RuntimeError):
+        close_fiscal_year(2021, batch_size=3)
+    db.session.rollback()
+
+    # The committed batches are visible and statements still add up
+    assert FiscalYearCloseProgress.query.count() == 1
+    assert 4 < live_documents(customer_ids) < 12
+    assert ledger_totals(customer_ids, supplier_ids) == before
+    assert db.session.get(FiscalYearClose, 2021) is None
+    with pytest.raises(ValueError, match='2021 has not finished'):
+        close_fiscal_year(2022)
+
+    monkeypatch.setattr(app_module, 'close_party_batches', close_party_batches)
+    archived = close_fiscal_year(2021, batch_size=3)
+
+    assert archived == expected
+    assert live_documents(customer_ids) == 4
+    assert ledger_totals(customer_ids, supplier_ids) == before
+    assert FiscalYearCloseProgress.query.count() == 0
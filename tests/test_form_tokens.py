@@ -0,0 +1,35 @@
+import re
+
+import app as app_module
+from app import db, Collection, Customer, ExpiringStore
+
+
+def collection_form(client, customer_id):
+    page = client.get('/add_collection').get_data(as_text=True)
+    token = re.search(r'name="form_token" value="([^"]+)"', page).group(1)
+    return {'form_token': token, 'customer_id': str(customer_id), 'amount': '25',
+            'collection_date': '2025-03-01', 'notes': 'double submit'}
+
+
+def customer_collections(customer_id):
+    db.session.expire_all()
+    return db.session.scalars(db.select(Collection.amount).where(Collection.customer_id == customer_id)).all()
+
+
+def test_resubmitted_form_is_posted_once(client, add_customer, monkeypatch):
+    customer_id = add_customer('Double submit')
+    form = collection_form(client, customer_id)
+
+    first = client.post('/add_collection', data=form)
+    second = client.post('/add_collection', data=form)
+    # A worker that did not process the first submission finds its token in the database
+    monkeypatch.setattr(app_module, 'form_results', ExpiringStore(app_module.IDEMPOTENCY_TTL))
+    third = client.post('/add_collection', data=form)
+
+    assert first.location == second.location == third.location == '/collections'
+    assert customer_collections(customer_id) == [25]
+    assert db.session.get(Customer, customer_id).balance == -25
+
+    # A new form gets a new token and posts again
+    client.post('/add_collection', data=collection_form(client, customer_id))
+    assert customer_collections(customer_id) == [25, 25]
@@ -0,0 +1,22 @@
+def post_invoice(client, customer_id, amount):
+    response = client.post('/api/v1/sales_invoices', json={'customer_id': customer_id, 'amount': amount,
+                                                           'invoice_date': '2025-03-01'})
+    assert response.status_code == 201
+
+
+def test_unchanged_page_is_not_modified_until_a_posting(client, add_customer):
+    customer_id = add_customer('Conditional customer')
+    client.get('/login')  # drop the flash message, which is always rendered
+    first = client.get(f'/view_customer/{customer_id}')
+    etag = first.headers['ETag']
+
+    repeat = client.get(f'/view_customer/{customer_id}', headers={'If-None-Match': etag})
+    post_invoice(client, customer_id, 75)
+    after_posting = client.get(f'/view_customer/{customer_id}', headers={'If-None-Match': etag})
+
+    assert first.status_code == 200
+    assert repeat.status_code == 304 and repeat.data == b''
+    assert after_posting.status_code == 200
+    assert after_posting.headers['ETag'] != etag
+    assert client.get(f'/view_customer/{customer_id}',
+                      headers={'If-None-Match': after_posting.headers['ETag']}).status_code == 304
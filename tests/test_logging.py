@@ -0,0 +1,51 @@
+import logging
+import queue
+
+import app as app_module
+from app import DropReportingQueueListener, NonBlockingQueueHandler
+
+
+class CollectingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def log_with_full_queue(count):
+    """Log count records through a two-record queue and drain it; returns the listener's output."""
+    handler = NonBlockingQueueHandler(queue.Queue(2))
+    output = CollectingHandler()
+    listener = DropReportingQueueListener(handler.queue, output)
+    logger = logging.getLogger('tests.dropped')
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for index in range(count):
+            logger.warning('record %d', index)
+        listener.start()
+        listener.stop()
+    finally:
+        logger.removeHandler(handler)
+    return output.records
+
+
+def test_dropped_records_are_reported():
+    records = log_with_full_queue(5)
+
+    kept = [record.getMessage() for record in records if record.name == 'tests.dropped']
+    reports = [record for record in records if record.name == 'app.logging']
+    assert kept == ['record 0', 'record 1']
+    assert [record.dropped for record in reports] == [3]
+    assert reports[0].levelno == logging.WARNING
+
+
+def test_dropped_records_are_reported_when_the_listener_stops(monkeypatch):
+    monkeypatch.setattr(app_module, 'LOG_DROP_REPORT_SECONDS', float('inf'))
+
+    records = log_with_full_queue(4)
+
+    assert [record.dropped for record in records if record.name == 'app.logging'] == [2]
+    assert records[-1].name == 'app.logging'
@@ -0,0 +1,126 @@
+import pytest
+import sqlalchemy as sa
+
+import migrate_db
+from migrate_db import Migrator
+
+INVOICES = 250
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """A populated database from before migration 1, with the cancellation columns."""
+    engine = migrate_db.connect(f'sqlite:///{tmp_path}/old.db')
+    metadata = sa.MetaData()
+    sa.Table('customer', metadata, sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('name', sa.String(100), nullable=False), sa.Column('balance', sa.Float))
+    sa.Table('sales_invoice', metadata, sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('invoice_number', sa.String(50), nullable=False, unique=True),
+             sa.Column('customer_id', sa.Integer, sa.ForeignKey('customer.id'), nullable=False, index=True),
+             sa.Column('amount', sa.Float, sa.CheckConstraint('amount >= 0', name='ck_amount'), nullable=False),
+             sa.Column('invoice_date', sa.Date), sa.Column('is_cancelled', sa.Boolean, server_default='0'))
+    sa.Table('change_event', metadata, sa.Column('sequence', sa.Integer, primary_key=True),
+             sa.Column('entity', sa.String(30)), sa.Column('entity_id', sa.Integer))
+    sa.Table('user', metadata, sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('username', sa.String(80)), sa.Column('is_cancelled', sa.Boolean))
+    metadata.create_all(engine)
+    migrate_db.bookkeeping.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(metadata.tables['customer'].insert(), [{'id': 1, 'name': 'A', 'balance': 0.0}])
+        connection.execute(metadata.tables['sales_invoice'].insert(), [
+            {'id': id, 'invoice_number': f'INV-{id:05d}', 'customer_id': 1, 'amount': float(id),
+             'is_cancelled': False} for id in range(1, INVOICES + 1)])
+    return engine
+
+
+def invoices(engine):
+    with engine.connect() as connection:
+        return dict(connection.execute(sa.text('SELECT id, amount FROM sales_invoice')).all())
+
+
+def test_rebuild_table_names_the_dialect_outside_sqlite():
+    migrator = Migrator(sa.create_mock_engine('postgresql://', lambda *args, **kwargs: None))
+    with pytest.raises(RuntimeError, match='SQLite-only; on postgresql'):
+        migrator.rebuild_table('customer', drop_columns=['notes'])
+
+
+def test_rebuild_keeps_rows_indexes_and_constraints(engine):
+    migrator = Migrator(engine, batch_size=40, pause=0)
+    migrator.version = 1
+
+    migrator.rebuild_table('sales_invoice', drop_columns=['is_cancelled'])
+
+    inspector = sa.inspect(engine)
+    assert 'is_cancelled' not in {column['name'] for column in inspector.get_columns('sales_invoice')}
+    assert invoices(engine) == {id: float(id) for id in range(1, INVOICES + 1)}
+    assert 'ix_sales_invoice_customer_id' in {index['name'] for index in inspector.get_indexes('sales_invoice')}
+    assert inspector.get_foreign_keys('sales_invoice')[0]['referred_table'] == 'customer'
+    for statement in ("INSERT INTO sales_invoice (invoice_number, customer_id, amount) VALUES ('INV-00001', 1, 5)",
+                      "INSERT INTO sales_invoice (invoice_number, customer_id, amount) VALUES ('X', 1, -5)"):
+        with pytest.raises(sa.exc.IntegrityError), engine.begin() as connection:
+            connection.execute(sa.text(statement))
+
+
+def test_migrations_are_recorded_and_skipped_on_rerun(engine):
+    applied = migrate_db.migrate(engine, batch_size=40, pause=0, offline=True)
+
+    assert applied == sorted(migrate_db.MIGRATIONS)
+    with engine.connect() as connection:
+        recorded = connection.execute(sa.select(migrate_db.schema_migrations.c.version)).scalars().all()
+    assert sorted(recorded) == applied
+    assert migrate_db.migrate(engine) == []
+
+
+def test_interrupted_rebuild_resumes(engine, monkeypatch):
+    batches = []
+
+    def interrupt(seconds):
+        batches.append(seconds)
+        if len(batches) == 3:
+            raise KeyboardInterrupt
+    monkeypatch.setattr(migrate_db.time, 'sleep', interrupt)
+    migrator = Migrator(engine, batch_size=40, pause=0)
+    migrator.version = 1
+    with pytest.raises(KeyboardInterrupt):
+        migrator.rebuild_table('sales_invoice', drop_columns=['is_cancelled'])
+    assert migrator.progress('rebuild:sales_invoice')['last_id'] == 120
+
+    monkeypatch.setattr(migrate_db.time, 'sleep', lambda seconds: None)
+    migrator.rebuild_table('sales_invoice', drop_columns=['is_cancelled'])
+
+    assert invoices(engine) == {id: float(id) for id in range(1, INVOICES + 1)}
+    assert migrator.progress('rebuild:sales_invoice') is None
+
+
+def test_rows_changed_during_the_copy_are_caught_up(engine, monkeypatch):
+    def write_between_batches(seconds):
+        # The app edits and deletes rows already copied and adds new ones, logging each change
+        with engine.begin() as connection:
+            if not connection.execute(sa.text('SELECT count(*) FROM change_event')).scalar():
+                connection.execute(sa.text('UPDATE sales_invoice SET amount = 999 WHERE id = 10'))
+                connection.execute(sa.text('DELETE FROM sales_invoice WHERE id = 20'))
+                connection.execute(sa.text("INSERT INTO change_event (entity, entity_id) "
+                                           "VALUES ('sales_invoice', 10), ('sales_invoice', 20)"))
+                connection.execute(sa.text("INSERT INTO sales_invoice (id, invoice_number, customer_id, amount) "
+                                           "VALUES (1000, 'INV-01000', 1, 1000)"))
+    monkeypatch.setattr(migrate_db.time, 'sleep', write_between_batches)
+    migrator = Migrator(engine, batch_size=40, pause=0)
+    migrator.version = 1
+
+    migrator.rebuild_table('sales_invoice', drop_columns=['is_cancelled'])
+
+    expected = {id: float(id) for id in range(1, INVOICES + 1) if id != 20}
+    expected.update({10: 999.0, 1000: 1000.0})
+    assert invoices(engine) == expected
+
+
+def test_tables_outside_the_change_feed_are_rebuilt_only_offline(engine):
+    migrator = Migrator(engine, batch_size=40, pause=0)
+    migrator.version = 1
+    with pytest.raises(RuntimeError, match='--offline'):
+        migrator.rebuild_table('user', drop_columns=['is_cancelled'])
+
+    migrator.offline = True
+    migrator.rebuild_table('user', drop_columns=['is_cancelled'])
+
+    assert 'is_cancelled' not in {column['name'] for column in sa.inspect(engine).get_columns('user')}
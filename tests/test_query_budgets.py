@@ -0,0 +1,120 @@
+from datetime import date
+
+import pytest
+from flask import g
+
+import app as app_module
+from app import (app, db, select, Customer, Supplier, SalesInvoice, PurchaseInvoice, Collection, Payment,
+                 QUERY_BUDGETS, fan_out_branches)
+
+# Data set sizes compared; the statement count of every budgeted page must not change between them
+SMALL, LARGE = 2, 40
+
+
+def seed(rows):
+    """rows customers and suppliers, each of the first ones with rows documents of every kind."""
+    stamp = f'{rows}-{db.session.scalar(select(db.func.count(Customer.id)))}'
+    customers = [Customer(name=f'Budget customer {stamp}-{index}', balance=0.0) for index in range(rows)]
+    suppliers = [Supplier(name=f'Budget supplier {stamp}-{index}', balance=0.0) for index in range(rows)]
+    db.session.add_all(customers + suppliers)
+    db.session.flush()
+    customer, supplier = customers[0], suppliers[0]
+    today = date.today()
+    documents = {'sales_invoice': [], 'purchase_invoice': [], 'collection': [], 'payment': []}
+    for index in range(rows):
+        documents['sales_invoice'].append(SalesInvoice(invoice_number=f'QB-S-{stamp}-{index}', customer_id=customer.id,
+                                                       amount=100, invoice_date=today, created_by=1))
+        documents['purchase_invoice'].append(PurchaseInvoice(invoice_number=f'QB-P-{stamp}-{index}',
+                                                             supplier_id=supplier.id, amount=80,
+                                                             invoice_date=today, created_by=1))
+        documents['collection'].append(Collection(customer_id=customer.id, amount=30, collection_date=today,
+                                                  created_by=1))
+        documents['payment'].append(Payment(supplier_id=supplier.id, amount=20, payment_date=today, created_by=1))
+    db.session.add_all([document for kind in documents.values() for document in kind])
+    db.session.commit()
+    return customer.id, supplier.id, {kind: items[-1].id for kind, items in documents.items()}
+
+
+def budget_urls(customer_id, supplier_id, documents):
+    return {
+        'dashboard': '/',
+        'customers': '/customers',
+        'suppliers': '/suppliers',
+        'sales_invoices': '/sales_invoices',
+        'purchase_invoices': '/purchase_invoices',
+        'collections': '/collections',
+        'payments': '/payments',
+        'view_customer': f'/view_customer/{customer_id}',
+        'view_supplier': f'/view_supplier/{supplier_id}',
+        'view_sales_invoice': f"/view_sales_invoice/{documents['sales_invoice']}",
+        'view_purchase_invoice': f"/view_purchase_invoice/{documents['purchase_invoice']}",
+        'view_collection': f"/view_collection/{documents['collection']}",
+        'view_payment': f"/view_payment/{documents['payment']}",
+        'print_sales_invoice': f"/print_sales_invoice/{documents['sales_invoice']}",
+        'print_purchase_invoice': f"/print_purchase_invoice/{documents['purchase_invoice']}",
+        'print_collection_receipt': f"/print_collection_receipt/{documents['collection']}",
+        'print_payment_receipt': f"/print_payment_receipt/{documents['payment']}",
+        'customer_statement': f'/customer_statement/{customer_id}',
+        'supplier_statement': f'/supplier_statement/{supplier_id}',
+        'customer_reports': '/customer_reports',
+        'supplier_reports': '/supplier_reports',
+        'analytics': '/analytics',
+        'add_sales_invoice': '/add_sales_invoice',
+        'add_purchase_invoice': '/add_purchase_invoice',
+        'add_collection': '/add_collection',
+        'add_payment': '/add_payment',
+    }
+
+
+@pytest.fixture(scope='module')
+def query_counts():
+    """{rows: {endpoint: statements}} for the budgeted pages at both data set sizes."""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    client.get('/login')  # drop the login flash message
+    counts = {}
+    for rows in (SMALL, LARGE):
+        # Requests run outside this app context: inside it they would share its g and its count
+        with app.app_context():
+            urls = budget_urls(*seed(rows))
+        counts[rows] = {}
+        for endpoint, url in urls.items():
+            try:
+                response = client.get(url)
+            except AssertionError as overrun:
+                # check_query_budget raises under TESTING; fail only that endpoint's test
+                counts[rows][endpoint] = overrun
+                continue
+            assert response.status_code == 200, endpoint
+            counts[rows][endpoint] = int(response.headers['X-Query-Count'])
+    return counts
+
+
+def test_every_budget_is_tested():
+    assert set(QUERY_BUDGETS) == set(budget_urls(1, 1, {'sales_invoice': 1, 'purchase_invoice': 1,
+                                                         'collection': 1, 'payment': 1}))
+
+
+@pytest.mark.parametrize('endpoint', sorted(QUERY_BUDGETS))
+def test_query_count_within_budget_and_flat(query_counts, endpoint):
+    for counts in query_counts.values():
+        if isinstance(counts[endpoint], AssertionError):
+            raise counts[endpoint]
+    assert query_counts[LARGE][endpoint] <= QUERY_BUDGETS[endpoint]
+    assert query_counts[LARGE][endpoint] == query_counts[SMALL][endpoint]
+
+
+def test_fan_out_threads_count_towards_the_request(app, monkeypatch):
+    monkeypatch.setattr(app_module, 'use_branch', lambda branch: None)
+    with app.test_request_context('/customer_reports'):
+        fan_out_branches(lambda: db.session.execute(select(1)).scalar(), ['first', 'second', 'third'])
+        assert g.query_count == 3
+        assert g.query_branches == 3
+
+
+def test_query_count_restarts_with_each_request(client, add_customer):
+    customer_id = add_customer('Budget shared context')
+    counts = [int(client.get(f'/view_customer/{customer_id}').headers['X-Query-Count']) for _ in range(3)]
+    assert max(counts) <= QUERY_BUDGETS['view_customer']
+    assert counts[1] == counts[2]
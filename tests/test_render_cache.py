@@ -0,0 +1,31 @@
+import app as app_module
+from app import render_cache
+
+
+def test_printed_document_is_cached_until_edited(client, add_customer, monkeypatch):
+    customer_id = add_customer('Render cache customer')
+    invoice_id = client.post('/api/v1/sales_invoices', json={
+        'customer_id': customer_id, 'amount': 120, 'invoice_date': '2025-03-01',
+        'invoice_number': 'RENDER-1'}).get_json()['id']
+    rendered = []
+    render_template = app_module.render_template
+
+    def counting(template, **context):
+        rendered.append(template)
+        return render_template(template, **context)
+    monkeypatch.setattr(app_module, 'render_template', counting)
+
+    first = client.get(f'/print_sales_invoice/{invoice_id}').get_data(as_text=True)
+    second = client.get(f'/print_sales_invoice/{invoice_id}').get_data(as_text=True)
+    assert rendered.count('print_sales_invoice.html') == 1
+    assert second == first and 'RENDER-1' in first
+
+    client.post(f'/edit_sales_invoice/{invoice_id}', data={
+        'customer_id': str(customer_id), 'amount': '120', 'invoice_number': 'RENDER-2',
+        'invoice_date': '2025-03-01', 'description': ''})
+    assert render_cache.get('sales_invoice', invoice_id, customer_id, None) is None
+    assert ('sales_invoice', invoice_id, 'html') not in render_cache._entries
+
+    edited = client.get(f'/print_sales_invoice/{invoice_id}').get_data(as_text=True)
+    assert rendered.count('print_sales_invoice.html') == 2
+    assert 'RENDER-2' in edited and 'RENDER-1' not in edited
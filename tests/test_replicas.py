@@ -0,0 +1,34 @@
+import shutil
+
+import sqlalchemy as sa
+
+import app as app_module
+from app import db, Customer
+
+
+def test_reads_use_the_replica_until_the_user_writes(client, add_customer, tmp_path, monkeypatch):
+    customer_id = add_customer('Replica primary')
+    db.session.commit()
+    # The replica is a copy of the primary that has not caught up with one change yet
+    replica_path = tmp_path / 'replica.db'
+    shutil.copy(db.engine.url.database, replica_path)
+    replica = sa.create_engine(f'sqlite:///{replica_path}')
+    with replica.begin() as connection:
+        connection.execute(sa.update(Customer.__table__).where(Customer.__table__.c.id == customer_id)
+                           .values(name='Replica stale'))
+    monkeypatch.setattr(app_module, 'REPLICA_BINDS', ['replica_0'])
+    monkeypatch.setitem(db.engines, 'replica_0', replica)
+
+    assert 'Replica stale' in client.get(f'/view_customer/{customer_id}').get_data(as_text=True)
+    assert 'Replica stale' not in client.get(f'/edit_customer/{customer_id}').get_data(as_text=True)
+
+    client.post(f'/edit_customer/{customer_id}', data={'name': 'Replica edited', 'credit_limit': ''})
+    # The writer reads its own write from the primary for REPLICA_STICKY_SECONDS
+    assert 'Replica edited' in client.get(f'/view_customer/{customer_id}').get_data(as_text=True)
+    with replica.connect() as connection:
+        assert connection.execute(sa.select(Customer.__table__.c.name)
+                                  .where(Customer.__table__.c.id == customer_id)).scalar() == 'Replica stale'
+
+    with client.session_transaction() as session:
+        session['read_primary_until'] = 0
+    assert 'Replica stale' in client.get(f'/view_customer/{customer_id}').get_data(as_text=True)
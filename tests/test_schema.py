@@ -0,0 +1,45 @@
+import pytest
+import sqlalchemy as sa
+
+import migrate_db
+from app import Customer, prepare_schema, read_only_engine_options
+
+
+def test_new_database_is_stamped_with_every_migration(tmp_path):
+    engine = sa.create_engine(f'sqlite:///{tmp_path}/new.db')
+
+    prepare_schema(engine)
+    prepare_schema(engine)  # a second worker starting later finds nothing to do
+
+    assert migrate_db.pending_migrations(engine) == []
+    assert migrate_db.migrate(engine) == []
+
+
+def test_outdated_database_is_refused_until_migrated(tmp_path):
+    engine = sa.create_engine(f'sqlite:///{tmp_path}/old.db')
+    # The customer table as it was before credit limits
+    old = sa.MetaData()
+    sa.Table('customer', old, *[sa.Column(column.name, column.type, primary_key=column.primary_key)
+                                for column in Customer.__table__.columns if column.name != 'credit_limit'])
+    old.create_all(engine)
+
+    with pytest.raises(RuntimeError, match='pending schema migrations'):
+        prepare_schema(engine)
+    migrate_db.migrate(engine, pause=0)
+    prepare_schema(engine)
+
+    assert 'credit_limit' in {column['name'] for column in sa.inspect(engine).get_columns('customer')}
+
+
+def test_read_only_engine_options(tmp_path):
+    path = tmp_path / 'inspected.db'
+    sa.create_engine(f'sqlite:///{path}').connect().close()
+
+    engine = sa.create_engine(read_only_engine_options(f'sqlite:///{path}')['url'])
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql('SELECT 1').scalar() == 1
+        with pytest.raises(sa.exc.OperationalError, match='readonly'):
+            connection.exec_driver_sql('CREATE TABLE probe (id INTEGER)')
+
+    postgres = read_only_engine_options('postgresql://localhost/app')
+    assert postgres['connect_args'] == {'options': '-c default_transaction_read_only=on'}
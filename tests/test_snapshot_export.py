@@ -0,0 +1,32 @@
+import glob
+import os
+
+import pyarrow.parquet as pq
+
+from app import db, export_snapshot, SalesInvoice
+
+
+def exported_ids(output_dir, table_name):
+    paths = glob.glob(os.path.join(output_dir, table_name, 'created_month=*', '*.parquet'))
+    return sorted(id for path in paths for id in pq.read_table(path, columns=['id']).column('id').to_pylist())
+
+
+def test_second_export_writes_only_rows_past_the_watermark(client, add_customer, tmp_path):
+    customer_id = add_customer('Snapshot customer')
+    client.post('/api/v1/sales_invoices', json={'customer_id': customer_id, 'amount': 10, 'invoice_date': '2025-03-01'})
+    output_dir = str(tmp_path / 'snapshot')
+
+    first = export_snapshot(output_dir)
+    new_ids = client.post('/api/v1/sales_invoices/bulk', json=[
+        {'customer_id': customer_id, 'amount': amount, 'invoice_date': '2025-03-02'} for amount in (20, 30)
+    ]).get_json()['ids']
+    second = export_snapshot(output_dir)
+
+    all_ids = sorted(db.session.scalars(db.select(SalesInvoice.id)))
+    assert first['sales_invoice'] == len(all_ids) - 2
+    assert second == {'customer': 0, 'supplier': 0, 'sales_invoice': 2, 'purchase_invoice': 0,
+                      'collection': 0, 'payment': 0}
+    # Every row is in exactly one file
+    assert exported_ids(output_dir, 'sales_invoice') == all_ids
+    assert set(new_ids) <= set(all_ids)
+    assert export_snapshot(output_dir)['sales_invoice'] == 0
@@ -0,0 +1,27 @@
+import os
+import zipfile
+
+from app import db, generate_statements, Supplier
+
+
+def test_a_pdf_statement_per_party(client, tmp_path):
+    supplier_id = client.post('/api/v1/suppliers', json={'name': 'مورد كشف الحساب'}).get_json()['id']
+    client.post('/api/v1/purchase_invoices', json={'supplier_id': supplier_id, 'amount': 500,
+                                                   'invoice_date': '2025-03-01'})
+    supplier_ids = db.session.scalars(db.select(Supplier.id)).all()
+    output_dir, zip_path = str(tmp_path / 'statements'), str(tmp_path / 'statements.zip')
+
+    written, ranges, done_before = generate_statements(output_dir, party_types=('supplier',), file_format='pdf',
+                                                       range_size=5, workers=2, zip_path=zip_path)
+
+    assert (written, done_before) == (len(supplier_ids), 0)
+    assert ranges == -(-len(supplier_ids) // 5)
+    files = sorted(os.listdir(os.path.join(output_dir, 'suppliers')))
+    assert files == sorted(f'supplier_{id}.pdf' for id in supplier_ids)
+    with open(os.path.join(output_dir, 'suppliers', f'supplier_{supplier_id}.pdf'), 'rb') as f:
+        assert f.read(5) == b'%PDF-'
+    with zipfile.ZipFile(zip_path) as archive:
+        assert len(archive.namelist()) == len(supplier_ids)
+    # A rerun finds every range done and writes nothing
+    assert generate_statements(output_dir, party_types=('supplier',), file_format='pdf', range_size=5,
+                               workers=2) == (0, ranges, ranges)